@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+# Load tests the server against a directory of stub ISIS programs that
+# sleep, burn CPU or write large outputs, under each requested gunicorn
+# worker class and count. Reports throughput, p50/p99 latency and peak
+# memory of the server's processes, and compares them with stored baselines.
+#
+# ./load_harness.py --worker-classes sync,gthread --workers 1,4 --save-baseline
+# ./load_harness.py --worker-classes sync,gthread --workers 1,4
+#
+# The "werkzeug" worker class runs the threaded development server instead,
+# for machines without gunicorn.
+
+import json
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os import chmod, environ, listdir, makedirs
+from os.path import dirname, exists as path_exists, join as path_join, realpath
+from signal import SIGTERM
+from socket import socket
+from statistics import median
+from subprocess import Popen, DEVNULL
+from sys import executable, exit as sys_exit, path as sys_path
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter, sleep
+from uuid import uuid4
+
+import numpy as np
+import requests
+
+pkg_dir = dirname(dirname(realpath(__file__)))
+sys_path.insert(0, pkg_dir)
+
+from isis_cloud.cube import Cube
+
+# Fake ISIS programs, called like the real ones with key=value args
+STUB_PROGRAMS = {
+    "sleeper": """
+import sys, time
+args = dict(a.split("=", 1) for a in sys.argv[1:])
+time.sleep(int(args.get("ms", 100)) / 1000)
+""",
+    "burner": """
+import sys, time
+args = dict(a.split("=", 1) for a in sys.argv[1:])
+end = time.perf_counter() + int(args.get("ms", 100)) / 1000
+while time.perf_counter() < end:
+    pass
+""",
+    "writer": """
+import sys
+args = dict(a.split("=", 1) for a in sys.argv[1:])
+chunk = bytes(1024 * 1024)
+with open(args["to"], "wb") as f:
+    for _ in range(int(args.get("mb", 1))):
+        f.write(chunk)
+""",
+}
+
+# Payload for the upload/download scenarios
+FILE_MB = 4
+
+
+def scenario_upload(session, url):
+    r = session.post(
+        "{}/files".format(url),
+        files={"{}.bin".format(uuid4().hex): bytes(FILE_MB * 1024 * 1024)}
+    )
+    return r.ok
+
+
+def scenario_download(session, url):
+    r = session.get("{}/files/bench.bin".format(url))
+    return r.ok and len(r.content) == FILE_MB * 1024 * 1024
+
+
+def scenario_label(session, url):
+    return session.get("{}/files/bench.cub/label".format(url)).ok
+
+
+def run_program(program, **args):
+    def scenario(session, url):
+        r = session.post("{}/isis".format(url), json={
+            "program": program,
+            "args": {k: str(v).format(uuid=uuid4().hex) for k, v in args.items()},
+        })
+        return r.ok
+    return scenario
+
+
+SCENARIOS = {
+    "upload": scenario_upload,
+    "download": scenario_download,
+    "label": scenario_label,
+    "run_sleep": run_program("sleeper", ms=200),
+    "run_cpu": run_program("burner", ms=200),
+    "run_write": run_program("writer", mb=8, to="{uuid}.bin"),
+}
+
+
+def create_stubs(root):
+    isis_bin = path_join(root, "bin")
+    makedirs(isis_bin)
+    for name, source in STUB_PROGRAMS.items():
+        stub = path_join(isis_bin, name)
+        with open(stub, "w") as f:
+            f.write("#!{}\n{}".format(executable, source))
+        chmod(stub, 0o755)
+
+
+def create_files(work_dir):
+    makedirs(work_dir)
+    with open(path_join(work_dir, "bench.bin"), "wb") as f:
+        f.write(bytes(FILE_MB * 1024 * 1024))
+
+    with Cube.create(path_join(work_dir, "bench.cub"), 512, 512) as cube:
+        cube[0] = np.random.rand(512, 512).astype(np.float32)
+
+
+def free_port():
+    with socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(worker_class, workers, port, env):
+    if worker_class == "werkzeug":
+        command = [
+            executable, "-c",
+            "from wsgi import app; app.run(host='127.0.0.1', port={}, threaded=True)".format(port)
+        ]
+    else:
+        command = [
+            "gunicorn", "-c", "gunicorn.conf.py",
+            "--bind", "127.0.0.1:{}".format(port),
+            "--workers", str(workers),
+            "--worker-class", worker_class,
+            "wsgi:app"
+        ]
+
+    server = Popen(command, cwd=pkg_dir, env=env, stdout=DEVNULL, stderr=DEVNULL)
+
+    url = "http://127.0.0.1:{}/api/v1".format(port)
+    for _ in range(300):
+        if server.poll() is not None:
+            raise RuntimeError("Server exited with {}".format(server.returncode))
+        try:
+            if requests.get("{}/programs".format(url)).ok:
+                return server, url
+        except requests.ConnectionError:
+            pass
+        sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError("Server didn't start")
+
+
+def process_tree_rss(pid):
+    # Resident memory of a process and all its descendants, from /proc
+    parents = dict()
+    for entry in listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+
+    tree = {pid}
+    added = True
+    while added:
+        children = {p for p, ppid in parents.items() if ppid in tree} - tree
+        tree |= children
+        added = bool(children)
+
+    rss = 0
+    for p in tree:
+        try:
+            with open("/proc/{}/status".format(p)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return rss
+
+
+def load(scenario, url, concurrency, duration, server_pid):
+    stop = Event()
+    peak_rss = [0]
+
+    def sample_memory():
+        while not stop.is_set():
+            peak_rss[0] = max(peak_rss[0], process_tree_rss(server_pid))
+            stop.wait(0.5)
+
+    def client():
+        latencies = list()
+        errors = 0
+        with requests.Session() as session:
+            while not stop.is_set():
+                start = perf_counter()
+                try:
+                    ok = scenario(session, url)
+                except requests.RequestException:
+                    ok = False
+                latencies.append(perf_counter() - start)
+                errors += not ok
+        return latencies, errors
+
+    sampler = Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        clients = [pool.submit(client) for _ in range(concurrency)]
+        sleep(duration)
+        stop.set()
+        results = [c.result() for c in clients]
+    sampler.join()
+
+    latencies = sorted(l for r in results for l in r[0])
+    return {
+        "requests": len(latencies),
+        "errors": sum(r[1] for r in results),
+        "throughput": len(latencies) / duration,
+        "p50": median(latencies) if latencies else None,
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else None,
+        "peak_rss": peak_rss[0],
+    }
+
+
+def compare(result, baseline, tolerance):
+    # Lower throughput or higher latency/memory than the baseline by more
+    # than the tolerance counts as a regression
+    regressions = list()
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append("throughput")
+    for key in ["p50", "p99", "peak_rss"]:
+        if result[key] is not None and baseline.get(key) and result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--worker-classes", default="gthread", help="Comma-separated gunicorn worker classes")
+    parser.add_argument("--workers", default="4", help="Comma-separated worker counts")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per scenario")
+    parser.add_argument("--baseline", default=path_join(dirname(realpath(__file__)), "baselines.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    baselines = dict()
+    if path_exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    results = dict()
+    regressed = False
+
+    print("{:<16} {:<10} {:>8} {:>8} {:>10} {:>10} {:>10}  {}".format(
+        "config", "scenario", "reqs", "errors", "req/s", "p50 ms", "p99 ms", "peak MB"
+    ))
+    for worker_class in args.worker_classes.split(","):
+        # The development server is always one process
+        counts = ["1"] if worker_class == "werkzeug" else args.workers.split(",")
+        for workers in counts:
+            config = "{}x{}".format(worker_class, workers)
+
+            with TemporaryDirectory() as scratch:
+                create_stubs(path_join(scratch, "isis"))
+                create_files(path_join(scratch, "work"))
+
+                env = dict(environ)
+                env["ISISROOT"] = path_join(scratch, "isis")
+                env["ISISDATA"] = path_join(scratch, "isis", "data")
+                env["DATA_DIR"] = path_join(scratch, "work")
+
+                server, url = start_server(worker_class, int(workers), free_port(), env)
+                try:
+                    for name in args.scenarios.split(","):
+                        key = "{}/{}".format(config, name)
+                        result = load(SCENARIOS[name], url, args.concurrency, args.duration, server.pid)
+                        results[key] = result
+
+                        regressions = list()
+                        if key in baselines and not args.save_baseline:
+                            regressions = compare(result, baselines[key], args.tolerance)
+                            regressed |= bool(regressions)
+
+                        print("{:<16} {:<10} {:>8} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>8.0f}  {}".format(
+                            config,
+                            name,
+                            result["requests"],
+                            result["errors"],
+                            result["throughput"],
+                            (result["p50"] or 0) * 1000,
+                            (result["p99"] or 0) * 1000,
+                            result["peak_rss"] / 1024 / 1024,
+                            "REGRESSED: {}".format(", ".join(regressions)) if regressions else ""
+                        ))
+                finally:
+                    server.send_signal(SIGTERM)
+                    server.wait()
+
+    if args.save_baseline:
+        baselines.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print("Saved baselines to {}".format(args.baseline))
+
+    sys_exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Measures the per-call overhead of short ISIS programs when cold-started
+# the way run_isis used to (resolve and stat the binary, inherit the
+# server's environment) versus through the warmed ISISPrograms registry.
+#
+# ./program_overhead.py some.cub --iterations 20
+
+from argparse import ArgumentParser
+from os import environ
+from os.path import dirname, exists as path_exists, join as path_join, realpath
+from shutil import copy
+from statistics import mean, median
+from subprocess import run as sp_run, DEVNULL, PIPE
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+pkg_dir = dirname(dirname(realpath(__file__)))
+sys_path.insert(0, pkg_dir)
+
+from isis_cloud.server._config import ISISServerConfig
+from isis_cloud.server._programs import ISISPrograms
+
+# Trivial invocations, formatted with the benchmark's cube and scratch dir
+PROGRAMS = {
+    "catlab": ["from={cube}"],
+    "editlab": ["from={cube}", "options=setkey", "grpname=Dimensions", "objname=Core", "keyword=Bands", "value=1"],
+    "maptemplate": ["map={scratch}/bench.map", "projection=Equirectangular", "clat=0.0", "clon=0.0"],
+}
+
+
+def run_cold(program, args):
+    command = path_join(environ["ISISROOT"], "bin", program)
+    if not path_exists(command):
+        raise RuntimeError("{} not found".format(command))
+    return sp_run(
+        [command, *args],
+        cwd=ISISServerConfig.work_dir(),
+        stdout=DEVNULL,
+        stderr=PIPE
+    )
+
+
+def run_warm(program, args):
+    return ISISPrograms.run(ISISPrograms.get(program), args)
+
+
+def time_calls(runner, program, args, iterations):
+    timings = list()
+    for _ in range(iterations):
+        start = perf_counter()
+        proc = runner(program, args)
+        timings.append(perf_counter() - start)
+
+        if proc.returncode != 0:
+            raise RuntimeError("{} failed: {}".format(
+                program,
+                proc.stderr.decode("utf-8")
+            ))
+
+    timings.sort()
+    return {
+        "mean": mean(timings),
+        "p50": median(timings),
+        "p99": timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("cube", help="A small cube for label-only programs")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as scratch:
+        cube = path_join(scratch, "bench.cub")
+        copy(args.cube, cube)
+
+        # Both modes run from the scratch dir so they write to the same place
+        ISISServerConfig._WORK_DIR = scratch
+        ISISPrograms.load()
+
+        print("{:<12} {:>6} {:>10} {:>10} {:>10}".format(
+            "program", "mode", "mean ms", "p50 ms", "p99 ms"
+        ))
+        for program, program_args in PROGRAMS.items():
+            program_args = [a.format(cube=cube, scratch=scratch) for a in program_args]
+
+            for mode, runner in [("cold", run_cold), ("warm", run_warm)]:
+                timings = time_calls(runner, program, program_args, args.iterations)
+                print("{:<12} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                    program,
+                    mode,
+                    timings["mean"] * 1000,
+                    timings["p50"] * 1000,
+                    timings["p99"] * 1000
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Measures the server's cold start, importing the package and building the
+# app, in fresh interpreters, and fails if the median is over budget. With
+# --audit it also lists the slowest imports, to find what to defer.
+#
+# ./startup.py --budget 1.5
+# ./startup.py --audit
+
+import json
+from argparse import ArgumentParser
+from os import environ
+from os.path import dirname, join as path_join, realpath
+from statistics import median
+from subprocess import run, PIPE
+from sys import executable, exit as sys_exit
+from tempfile import TemporaryDirectory
+
+pkg_dir = dirname(dirname(realpath(__file__)))
+
+# Run in the child, prints its timings as JSON
+MEASURE = """
+from time import perf_counter
+start = perf_counter()
+import sys
+sys.path.insert(0, {pkg_dir!r})
+from isis_cloud.server import ISISServer
+imported = perf_counter()
+ISISServer()
+built = perf_counter()
+print(__import__("json").dumps({{
+    "import": imported - start,
+    "build": built - imported,
+    "total": built - start,
+}}))
+"""
+
+
+def child_env(scratch):
+    env = dict(environ)
+    env["ISISROOT"] = path_join(scratch, "isis")
+    env["ISISDATA"] = path_join(scratch, "isis", "data")
+    env["DATA_DIR"] = path_join(scratch, "work")
+    env["SCRATCH_DIR"] = ""
+    return env
+
+
+def measure(env):
+    proc = run(
+        [executable, "-c", MEASURE.format(pkg_dir=pkg_dir)],
+        env=env, stdout=PIPE, stderr=PIPE, check=True
+    )
+    return json.loads(proc.stdout.decode("utf-8").splitlines()[-1])
+
+
+def audit(env, top):
+    # -X importtime writes "self | cumulative | module" lines to stderr
+    proc = run(
+        [executable, "-X", "importtime", "-c", MEASURE.format(pkg_dir=pkg_dir)],
+        env=env, stdout=PIPE, stderr=PIPE, check=True
+    )
+
+    imports = list()
+    for line in proc.stderr.decode("utf-8").splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        # Submodules are counted in their package's cumulative time, so
+        # only packages and the server's own modules are listed
+        module = module.strip()
+        if "." in module and not module.startswith("isis_cloud"):
+            continue
+        imports.append((int(cumulative_us), int(self_us), module))
+
+    print("{:>10} {:>10}  {}".format("cumul ms", "self ms", "module"))
+    for cumulative_us, self_us, module in sorted(imports, reverse=True)[:top]:
+        print("{:>10.1f} {:>10.1f}  {}".format(cumulative_us / 1000, self_us / 1000, module))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.5, help="Seconds allowed for the median cold start")
+    parser.add_argument("--audit", action="store_true", help="List the slowest imports")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as scratch:
+        env = child_env(scratch)
+        run(["mkdir", "-p", path_join(scratch, "isis", "bin"), path_join(scratch, "work")], check=True)
+
+        # The first run writes the spec cache, as the first start after a
+        # deploy would
+        measure(env)
+        results = [measure(env) for _ in range(args.runs)]
+
+        if args.audit:
+            audit(env, args.top)
+            print()
+
+    for key in ["import", "build", "total"]:
+        values = [r[key] for r in results]
+        print("{:<8} median {:>7.3f}s  min {:>7.3f}s  max {:>7.3f}s".format(
+            key,
+            median(values),
+            min(values),
+            max(values)
+        ))
+
+    total = median(r["total"] for r in results)
+    if total > args.budget:
+        print("Cold start {:.3f}s is over the {:.3f}s budget".format(total, args.budget))
+        sys_exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Summarises a trace file written by isis_cloud.tracing (ISIS_TRACE_FILE on
+# the server, tracing.configure in clients) as each trace's span tree and
+# the total time spent in each kind of span, to see where a job's time went
+# between the client, the server and ISIS.
+#
+# ./trace_report.py trace.jsonl
+# ./trace_report.py trace.jsonl --trace 4bf92f3577b34da6a3ce929d0e0e4736
+
+import json
+from argparse import ArgumentParser
+from collections import defaultdict
+
+
+def load_spans(trace_file):
+    spans = list()
+    with open(trace_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource_spans in json.loads(line)["resourceSpans"]:
+                service = "?"
+                for attr in resource_spans["resource"]["attributes"]:
+                    if attr["key"] == "service.name":
+                        service = attr["value"]["stringValue"]
+
+                for scope_spans in resource_spans["scopeSpans"]:
+                    for span in scope_spans["spans"]:
+                        span["service"] = service
+                        span["start"] = int(span["startTimeUnixNano"]) / 1e9
+                        span["seconds"] = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e9
+                        spans.append(span)
+    return spans
+
+
+def print_tree(span, children, trace_start, depth=0):
+    error = span.get("status", dict()).get("message")
+    print("{:>9.3f}s {:>9.3f}s  {}{} [{}]{}".format(
+        span["start"] - trace_start,
+        span["seconds"],
+        "  " * depth,
+        span["name"],
+        span["service"],
+        " ERROR {}".format(error) if error else ""
+    ))
+    for child in sorted(children[span["spanId"]], key=lambda s: s["start"]):
+        print_tree(child, children, trace_start, depth + 1)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("trace_file")
+    parser.add_argument("--trace", help="Only this trace ID")
+    args = parser.parse_args()
+
+    spans = load_spans(args.trace_file)
+    if args.trace is not None:
+        spans = [s for s in spans if s["traceId"] == args.trace]
+
+    by_id = {s["spanId"]: s for s in spans}
+    children = defaultdict(list)
+    roots = defaultdict(list)
+    for span in spans:
+        parent_id = span.get("parentSpanId")
+        # Spans whose parent wasn't recorded, e.g. a client that doesn't
+        # trace calling a server that does, are shown as roots
+        if parent_id in by_id:
+            children[parent_id].append(span)
+        else:
+            roots[span["traceId"]].append(span)
+
+    for trace_id, trace_roots in sorted(roots.items(), key=lambda r: min(s["start"] for s in r[1])):
+        trace_start = min(s["start"] for s in trace_roots)
+        print("Trace {}".format(trace_id))
+        print("{:>10} {:>10}".format("start", "duration"))
+        for root in sorted(trace_roots, key=lambda s: s["start"]):
+            print_tree(root, children, trace_start)
+        print()
+
+    totals = defaultdict(lambda: [0, 0.0])
+    for span in spans:
+        totals[(span["service"], span["name"])][0] += 1
+        totals[(span["service"], span["name"])][1] += span["seconds"]
+
+    print("{:>6} {:>10} {:>10}  {}".format("count", "total", "mean", "span"))
+    for (service, name), (count, seconds) in sorted(totals.items(), key=lambda t: -t[1][1]):
+        print("{:>6} {:>9.3f}s {:>9.3f}s  {} [{}]".format(
+            count,
+            seconds,
+            seconds / count,
+            name,
+            service
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from concurrent.futures import ThreadPoolExecutor
 from sys import path as sys_path
-from os.path import dirname, basename, join as path_join, exists as path_exists, realpath, splitext
+from os.path import dirname, basename, join as path_join, exists as path_exists, realpath
 from uuid import uuid4
 from os import urandom
 from urllib.parse import urlparse
@@ -8,6 +8,7 @@ from urllib.parse import urlparse
 pkg_dir = dirname(dirname(realpath(__file__)))
 sys_path.insert(0, pkg_dir)
 
+from isis_cloud import tracing
 from isis_cloud.client import ISISClient
 
 
@@ -47,8 +48,10 @@ class HiRISEDetectorChannelProcessor:
                 url_parsed = urlparse(channel)
                 file_name = basename(url_parsed.path)
                 out_file = path_join(self._download_dir, file_name)
-                if not path_exists(out_file):
-                    t = pool.submit(ISISClient.fetch, channel, out_file)
+                # A cache revalidates copies that are already there
+                cache = self._isis_client.cache
+                if cache is not None or not path_exists(out_file):
+                    t = pool.submit(tracing.wrap(ISISClient.fetch), channel, out_file, cache)
                     threads.append(t)
                 channel_dls.append(out_file)
 
@@ -62,7 +65,7 @@ class HiRISEDetectorChannelProcessor:
         with ThreadPoolExecutor() as pool:
             for channel in [self.channel0, self.channel1]:
                 t = pool.submit(
-                    HiRISEDetectorChannelProcessor._convert_to_cube,
+                    tracing.wrap(HiRISEDetectorChannelProcessor._convert_to_cube),
                     self._isis_client,
                     channel
                 )
@@ -79,7 +82,7 @@ class HiRISEDetectorChannelProcessor:
         with ThreadPoolExecutor() as pool:
             for channel in [self.channel0, self.channel1]:
                 t = pool.submit(
-                    HiRISEDetectorChannelProcessor._normalize_channel,
+                    tracing.wrap(HiRISEDetectorChannelProcessor._normalize_channel),
                     self._isis_client,
                     channel
                 )
@@ -6,6 +6,7 @@ from uuid import uuid4
 pkg_dir = dirname(dirname(realpath(__file__)))
 sys_path.insert(0, pkg_dir)
 
+from isis_cloud import tracing
 from isis_cloud.client import ISISClient
 from HiRISEDetectorChannelProcessor import HiRISEDetectorChannelProcessor
 
@@ -48,12 +49,17 @@ class HiRISEMultiDetectorProcessor:
         self._bg13_orig_binning = None
 
     def process(self):
-        self._populate_images()
-        self._scale_bgs()
-        self._fix_jitters()
-        self._propagate_red_highfreqs()
-        self._reproject_and_mosaic()
-        self._create_synth_blue()
+        with tracing.span("hirise.process", **{"hirise.product_id": self.product_id}):
+            for stage in [
+                self._populate_images,
+                self._scale_bgs,
+                self._fix_jitters,
+                self._propagate_red_highfreqs,
+                self._reproject_and_mosaic,
+                self._create_synth_blue
+            ]:
+                with tracing.span("hirise.stage", **{"hirise.stage": stage.__name__.lstrip("_")}):
+                    stage()
 
     def _populate_images(self):
         red4_proc = HiRISEDetectorChannelProcessor(
@@ -88,7 +94,7 @@ class HiRISEMultiDetectorProcessor:
         threads = list()
         with ThreadPoolExecutor() as pool:
             for processor in [red4_proc, red5_proc, bg12_proc, bg13_proc]:
-                t = pool.submit(processor.process)
+                t = pool.submit(tracing.wrap(processor.process))
                 threads.append(t)
 
         try:
@@ -105,7 +111,7 @@ class HiRISEMultiDetectorProcessor:
         with ThreadPoolExecutor() as pool:
             for ccd in [self.red4, self.red5, self.bg12, self.bg13]:
                 t = pool.submit(
-                    HiRISEMultiDetectorProcessor._fetch_cube_meta,
+                    tracing.wrap(HiRISEMultiDetectorProcessor._fetch_cube_meta),
                     self._isis_client,
                     ccd
                 )
@@ -126,7 +132,7 @@ class HiRISEMultiDetectorProcessor:
         with ThreadPoolExecutor() as pool:
             for tgt in thread_tgts:
                 t = pool.submit(
-                    HiRISEMultiDetectorProcessor._scale_bg,
+                    tracing.wrap(HiRISEMultiDetectorProcessor._scale_bg),
                     self._isis_client,
                     *tgt
                 )
@@ -143,7 +149,7 @@ class HiRISEMultiDetectorProcessor:
         with ThreadPoolExecutor() as pool:
             for dims in [self._red4_orig_size, self._red5_orig_size]:
                 t = pool.submit(
-                    HiRISEMultiDetectorProcessor._config_autoreg,
+                    tracing.wrap(HiRISEMultiDetectorProcessor._config_autoreg),
                     self._isis_client,
                     dims
                 )
@@ -173,7 +179,7 @@ class HiRISEMultiDetectorProcessor:
         with ThreadPoolExecutor() as pool:
             for autoreg, bg, red in thread_tgts:
                 t = pool.submit(
-                    HiRISEMultiDetectorProcessor._fix_jitter,
+                    tracing.wrap(HiRISEMultiDetectorProcessor._fix_jitter),
                     self._isis_client,
                     autoreg,
                     bg,
@@ -199,7 +205,7 @@ class HiRISEMultiDetectorProcessor:
         with ThreadPoolExecutor() as pool:
             for tgt in thread_tgts:
                 t = pool.submit(
-                    HiRISEMultiDetectorProcessor._propagate_red_highfreq,
+                    tracing.wrap(HiRISEMultiDetectorProcessor._propagate_red_highfreq),
                     self._isis_client,
                     *tgt
                 )
@@ -221,7 +227,7 @@ class HiRISEMultiDetectorProcessor:
         with ThreadPoolExecutor() as pool:
             for tgt in thread_tgts:
                 t = pool.submit(
-                    HiRISEMultiDetectorProcessor._combine,
+                    tracing.wrap(HiRISEMultiDetectorProcessor._combine),
                     self._isis_client,
                     tgt
                 )
@@ -260,7 +266,7 @@ class HiRISEMultiDetectorProcessor:
         with ThreadPoolExecutor() as pool:
             for color_set, binning in thread_tgts:
                 t = pool.submit(
-                    HiRISEMultiDetectorProcessor._reproject,
+                    tracing.wrap(HiRISEMultiDetectorProcessor._reproject),
                     self._isis_client,
                     map_file,
                     color_set,
@@ -460,16 +466,8 @@ class HiRISEMultiDetectorProcessor:
 
     @staticmethod
     def _propagate_red_highfreq(isis_client, red, bg, bg_orig_binning):
-        ratio_img = "{}.cub".format(uuid4())
-        ratio_img_lowpass = "{}.cub".format(uuid4())
         bg_img_filtered = "{}.cub".format(uuid4())
 
-        ratio = isis_client.program("ratio")
-        ratio.add_arg("numerator", bg)
-        ratio.add_arg("denominator", red)
-        ratio.add_arg("to", ratio_img)
-        ratio.send()
-
         if bg_orig_binning == 2:
             boxcar_size = 3
         elif bg_orig_binning == 4:
@@ -481,23 +479,16 @@ class HiRISEMultiDetectorProcessor:
             )
             raise RuntimeError(err)
 
-        lowpass = isis_client.program("lowpass")
-        lowpass.add_arg("from", ratio_img)
-        lowpass.add_arg("samples", boxcar_size)
-        lowpass.add_arg("lines", boxcar_size)
-        lowpass.add_arg("to", ratio_img_lowpass)
-        lowpass.send()
-
-        isis_client.delete(ratio_img)
-
-        fx = isis_client.program("fx")
-        fx.add_arg("f1", ratio_img_lowpass)
-        fx.add_arg("f2", red)
-        fx.add_arg("equation", "f1 * f2")
-        fx.add_arg("to", bg_img_filtered)
-        fx.send()
-
-        isis_client.delete(ratio_img_lowpass)
+        # ratio -> lowpass -> fx in a single pass, without writing the
+        # intermediate cubes
+        isis_client.pixelmath(
+            "smoothed_ratio * red",
+            inputs={"bg": bg, "red": red},
+            define={
+                "smoothed_ratio": "lowpass(bg / red, {0}, {0})".format(boxcar_size)
+            },
+            to=bg_img_filtered
+        )
 
         return bg_img_filtered
 
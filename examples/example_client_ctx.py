@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from sys import path as sys_path
-from os.path import dirname, basename, realpath
+from os.path import dirname, realpath
 from sys import stderr
 from logging import basicConfig as logConfig, getLogger, DEBUG, ERROR
 from concurrent.futures import ThreadPoolExecutor
@@ -128,10 +128,12 @@ try:
     [client.delete(f) for f in lev2_cubs]
 
     equalized_cubs = [get_random_cub_filename() for _ in range(len(norm_cubs))]
+    # Sent once for both equalizer and noseam
+    equalized_list = client.store_list(equalized_cubs)
 
     equalizer = client.program("equalizer")
     equalizer.add_arg("fromlist", norm_cubs)
-    equalizer.add_arg("tolist", equalized_cubs)
+    equalizer.add_arg("tolist", equalized_list)
     equalizer.add_arg("holdlist", [norm_cubs[0]])
     equalizer.send()
 
@@ -140,7 +142,7 @@ try:
     noseam_mos = get_random_cub_filename()
 
     noseam = client.program("noseam")
-    noseam.add_arg("fromlist", equalized_cubs)
+    noseam.add_arg("fromlist", equalized_list)
     noseam.add_arg("to", noseam_mos)
     noseam.add_arg("samples", 3)
     noseam.add_arg("lines", 3)
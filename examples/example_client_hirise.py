@@ -11,7 +11,8 @@ from logging import basicConfig as logConfig, getLogger, DEBUG, ERROR
 pkg_dir = dirname(dirname(realpath(__file__)))
 sys_path.insert(0, pkg_dir)
 
-from isis_cloud.client import ISISClient
+from isis_cloud import tracing
+from isis_cloud.client import ISISClient, ISISDownloadCache
 from HiRISEMultiDetectorProcessor import HiRISEMultiDetectorProcessor
 
 
@@ -30,33 +31,42 @@ pdsimage2_paths = [
     "EDR/ESP/ORB_037100_037199/ESP_037119_1985/ESP_037119_1985"
 ]
 
-client = ISISClient("http://127.0.0.1:8080/api/v1")
+# Spans from this script and the server it calls join up in one trace, see
+# benchmarks/trace_report.py
+tracing.configure(
+    service_name="example_client_hirise",
+    file=path_join(data_dir, "trace.jsonl")
+)
+
+# Re-runs reuse the EDRs and outputs they've already downloaded
+cache = ISISDownloadCache(path_join(data_dir, ".cache"), 50 * 1024 ** 3)
+client = ISISClient("http://127.0.0.1:8080/api/v1", cache=cache)
 processors = list()
 
-threads = list()
-with ThreadPoolExecutor() as pool:
-    for image_path in pdsimage2_paths:
-        detector_proc = HiRISEMultiDetectorProcessor(
-            client,
-            data_dir,
-            image_path
-        )
-        t = pool.submit(detector_proc.process)
-        threads.append(t)
-        processors.append(detector_proc)
-
-# Raise any errors thrown within the threads
-[t.result() for t in threads]
-
-final_mosaic = HiRISEMultiDetectorProcessor.mosaic(
-    client,
-    [p.mosaic for p in processors]
-)
-[client.delete(p.mosaic) for p in processors]
+with tracing.span("example_client_hirise"):
+    threads = list()
+    with ThreadPoolExecutor() as pool:
+        for image_path in pdsimage2_paths:
+            detector_proc = HiRISEMultiDetectorProcessor(
+                client,
+                data_dir,
+                image_path
+            )
+            t = pool.submit(tracing.wrap(detector_proc.process))
+            threads.append(t)
+            processors.append(detector_proc)
 
+    # Raise any errors thrown within the threads
+    [t.result() for t in threads]
 
-client.download(
-    final_mosaic,
-    path_join(output_dir, "jezero.cub")
-)
-client.delete(final_mosaic)
+    final_mosaic = HiRISEMultiDetectorProcessor.mosaic(
+        client,
+        [p.mosaic for p in processors]
+    )
+    [client.delete(p.mosaic) for p in processors]
+
+    client.download(
+        final_mosaic,
+        path_join(output_dir, "jezero.cub")
+    )
+    client.delete(final_mosaic)
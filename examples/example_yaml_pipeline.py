@@ -71,11 +71,15 @@ for input_file in input_files:
 
         cmd_str = command["cmd"]
         parsed_args = parse_pipeline_args(command["args"], current_inputs)
-        outputs = parse_pipeline_outputs(parsed_args, command["outputs"])
 
         cmd = client.program(cmd_str)
         for arg_name, arg_val in parsed_args.items():
             cmd.add_arg(arg_name, arg_val, is_remote=arg_val.startswith("http"))
-        cmd.send()
-
-        current_inputs = outputs
+        result = cmd.send()
+
+        # Without an explicit list, the next step gets whatever the server
+        # saw this one create or modify
+        if "outputs" in command.keys():
+            current_inputs = parse_pipeline_outputs(parsed_args, command["outputs"])
+        else:
+            current_inputs = [output.name for output in result.outputs]
@@ -1,6 +1,41 @@
-from os import cpu_count
+import gc
+from os import cpu_count, getenv
 
 bind = "0.0.0.0:8080"
-workers = min(12, cpu_count() * 2 + 1)
+
+# ISIS runs and slow downloads each hold a thread rather than a whole
+# process, so the process count only needs to track cores and concurrency
+# comes from threads. Idle keep-alive connections don't hold a thread.
+# Connexion 2, which environment.yml pins, is WSGI only, so this is gthread
+# rather than an ASGI server with uvicorn workers.
+worker_class = getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(getenv("GUNICORN_WORKERS", cpu_count()))
+threads = int(getenv("GUNICORN_THREADS", 64))
+worker_connections = int(getenv("GUNICORN_CONNECTIONS", 4096))
+
 loglevel = "info"
-timeout = 24 * 3600
+
+# The app is built once in the master and forked into each worker, sharing
+# its pages copy-on-write, rather than every worker importing everything
+# and parsing the spec again. Building it starts no threads, the workers
+# start the background sweeps once they're forked.
+preload_app = getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# Threaded workers heartbeat independently of their requests, so long ISIS
+# runs don't need a long timeout. Sync workers block on a request and keep
+# the old one.
+timeout = 120 if worker_class == "gthread" else 24 * 3600
+keepalive = 30
+
+
+def when_ready(server):
+    # Objects from the preloaded app are never collected, so collections in
+    # the workers don't write to, and copy, the master's pages. Python 3.6,
+    # which environment.yml pins, has no gc.freeze.
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    # One worker runs the sweeps, the others take over if it exits
+    worker.wsgi.start_background()
@@ -1 +1 @@
-from ._client import ISISClient
+from ._client import ISISClient, ISISDownloadCache, verify_notification
@@ -1,14 +1,37 @@
+import hmac
 import json
+import struct
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+from hashlib import sha256
+from shutil import copyfile, copyfileobj
+from threading import get_ident, Lock, Thread
 from urllib.error import URLError, HTTPError
 from urllib.request import urlretrieve
-from os.path import basename
+from os import getpid, makedirs, remove, replace, scandir, utime
+from os.path import basename, dirname, isabs, join as path_join, normpath
 from time import time
+from uuid import uuid4
 
 import requests
 from urllib.parse import quote_plus as url_quote
 from logging import getLogger
 
+from .. import tracing
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_BOOLEAN_VALUES = {"TRUE", "FALSE", "YES", "NO", "T", "F", "Y", "N"}
+
+# Tailed files are sent as frames of an offset and a length, then that many
+# bytes. See GET /files/{file_name} for the details.
+_TAIL_FRAME = struct.Struct(">QQ")
+_TAIL_ERROR_OFFSET = 2 ** 64 - 1
+
 
 def _catch_err(req):
     if not req.ok:
@@ -25,15 +48,311 @@ def _catch_err(req):
         raise RuntimeError(err)
 
 
+def _check_value(param, value):
+    value = str(value)
+
+    if param["options"] is not None:
+        if value.upper() not in [o.upper() for o in param["options"]]:
+            return "must be one of {}".format(", ".join(param["options"]))
+        return None
+
+    try:
+        if param["type"] == "integer":
+            number = int(value)
+        elif param["type"] == "double":
+            number = float(value)
+        elif param["type"] == "boolean":
+            if value.upper() not in _BOOLEAN_VALUES:
+                return "must be a boolean"
+            return None
+        else:
+            return None
+    except ValueError:
+        return "must be {} {}".format(
+            "an" if param["type"] == "integer" else "a",
+            param["type"]
+        )
+
+    if param["minimum"] is not None and number < float(param["minimum"]):
+        return "must be at least {}".format(param["minimum"])
+    if param["maximum"] is not None and number > float(param["maximum"]):
+        return "must be at most {}".format(param["maximum"])
+
+    return None
+
+
+def _validate_args(definition, arg_names, args):
+    params = {p["name"]: p for p in definition["parameters"]}
+    given = {name.lower() for name in arg_names}
+    errors = list()
+
+    for name in arg_names:
+        if name.lower() not in params:
+            errors.append("unknown parameter '{}'".format(name))
+
+    for name, value in args.items():
+        param = params.get(name.lower())
+        # Lists and list references are sent as listfiles
+        if param is None or isinstance(value, (list, dict)):
+            continue
+
+        err = _check_value(param, value)
+        if err is not None:
+            errors.append("'{}' {}".format(name, err))
+
+    for param in params.values():
+        if param["required"] and param["name"] not in given:
+            errors.append("missing required parameter '{}'".format(param["name"]))
+
+    return errors
+
+
+def _read_exactly(raw, size):
+    data = b""
+    while len(data) < size:
+        chunk = raw.read(size - len(data))
+        if not chunk:
+            raise RuntimeError("Stream ended after {} of {} bytes".format(len(data), size))
+        data += chunk
+    return data
+
+
+def _namespace_headers(namespace, token):
+    headers = dict()
+    if namespace is not None:
+        headers["X-ISIS-Namespace"] = namespace
+    if token is not None:
+        headers["Authorization"] = "Bearer {}".format(token)
+    return headers
+
+
+def verify_notification(body: bytes, timestamp: str, signature: str, secret: str,
+                        max_age: float = 300):
+    """
+    Checks a job completion notification came from a server holding the
+    secret, and isn't a replay older than max_age seconds. Returns the
+    parsed body.
+    """
+    expected = "sha256={}".format(hmac.new(
+        secret.encode("utf-8"),
+        "{}.".format(timestamp).encode("utf-8") + body,
+        sha256
+    ).hexdigest())
+
+    if not hmac.compare_digest(expected, signature):
+        raise ValueError("Invalid notification signature")
+    if abs(time() - int(timestamp)) > max_age:
+        raise ValueError("Notification timestamp is too old")
+
+    return json.loads(body)
+
+
+class _ProgramDefinitions:
+    # Cached definitions are revalidated against the server's ETag after
+    # this many seconds
+    _MAX_AGE = 300
+
+    def __init__(self, server_addr: str, headers: dict = None):
+        self._server_addr = server_addr
+        self._headers = headers or dict()
+        self._definitions = dict()
+
+    def get(self, program: str):
+        etag, definition, fetched_at = self._definitions.get(
+            program,
+            (None, None, None)
+        )
+        if fetched_at is not None and time() - fetched_at < _ProgramDefinitions._MAX_AGE:
+            return definition
+
+        headers = tracing.inject(self._headers)
+        if etag is not None:
+            headers["If-None-Match"] = etag
+
+        r = requests.get(
+            "/".join([self._server_addr, "programs", url_quote(program)]),
+            headers=headers
+        )
+
+        # Not an ISIS application, or a server without /programs
+        if r.status_code == 404:
+            definition = None
+        elif r.status_code != 304:
+            _catch_err(r)
+            definition = r.json()
+
+        self._definitions[program] = (r.headers.get("ETag"), definition, time())
+        return definition
+
+
+class ISISDownloadCache:
+    """
+    An on-disk cache of downloaded files, shared by ISISClient.download and
+    ISISClient.fetch. Files are stored by content hash, and each URL maps to
+    the hash and validators of its last download, so a current copy costs
+    a conditional GET and no transfer. The least recently used files are
+    evicted to keep the cache within max_bytes.
+    """
+    logger = getLogger("ISISDownloadCache")
+
+    # 64KiB
+    _DL_CHUNK_SIZE = 64000
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        self._blob_dir = path_join(cache_dir, "blobs")
+        self._index_dir = path_join(cache_dir, "index")
+        makedirs(self._blob_dir, exist_ok=True)
+        makedirs(self._index_dir, exist_ok=True)
+
+        self._evict_lock = Lock()
+
+    @staticmethod
+    def _tmp_path(file_path):
+        # Unique per process and thread, so concurrent downloads of the same
+        # URL don't write over each other
+        return "{}.{}.{}.tmp".format(file_path, getpid(), get_ident())
+
+    def _index_path(self, url, headers):
+        # Namespaces can hold different files under the same URL
+        key = json.dumps([url, sorted(headers.items())])
+        return path_join(
+            self._index_dir,
+            "{}.json".format(sha256(key.encode("utf-8")).hexdigest())
+        )
+
+    def _copy_out(self, content_sha256, local_path):
+        # Copied rather than linked, so programs changing the local file in
+        # place don't change the cached one. Touching it marks it as used.
+        blob = path_join(self._blob_dir, content_sha256)
+        try:
+            utime(blob)
+            copyfile(blob, local_path)
+        except FileNotFoundError:
+            # Evicted since it was looked up
+            return False
+        return True
+
+    def _store(self, r, index_path):
+        digest = sha256()
+        tmp_blob = ISISDownloadCache._tmp_path(path_join(self._blob_dir, "download"))
+        try:
+            with open(tmp_blob, "wb") as f:
+                for chunk in r.iter_content(ISISDownloadCache._DL_CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+            replace(tmp_blob, path_join(self._blob_dir, digest.hexdigest()))
+        except BaseException:
+            remove(tmp_blob)
+            raise
+
+        tmp_index = ISISDownloadCache._tmp_path(index_path)
+        with open(tmp_index, "w") as f:
+            json.dump({
+                "sha256": digest.hexdigest(),
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+            }, f)
+        replace(tmp_index, index_path)
+
+        return digest.hexdigest()
+
+    def evict(self):
+        # Removes the least recently used files until the cache fits
+        with self._evict_lock:
+            blobs = list()
+            for entry in scandir(self._blob_dir):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stats = entry.stat()
+                    blobs.append((stats.st_mtime, stats.st_size, entry.path))
+
+            total = sum(size for _, size, _ in blobs)
+            for _, size, blob in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    remove(blob)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def download(self, url: str, local_path: str, headers: dict = None,
+                 content_sha256: str = None):
+        """
+        Puts the file at url in local_path, from the cache if it's current.
+        A known content hash lets a cached copy be used without asking the
+        server at all. Returns whether the transfer was skipped.
+        """
+        headers = headers or dict()
+        if content_sha256 is not None and self._copy_out(content_sha256, local_path):
+            ISISDownloadCache.logger.debug("{} served from cache".format(url))
+            return True
+
+        index_path = self._index_path(url, headers)
+        try:
+            with open(index_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        request_headers = dict(headers)
+        if entry is not None and entry["etag"] is not None:
+            request_headers["If-None-Match"] = entry["etag"]
+        elif entry is not None and entry["last_modified"] is not None:
+            request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        r = requests.get(url, headers=tracing.inject(request_headers), stream=True)
+        with closing(r):
+            if r.status_code == 304:
+                if self._copy_out(entry["sha256"], local_path):
+                    ISISDownloadCache.logger.debug("{} is current in cache".format(url))
+                    return True
+
+                # Still current, but evicted in the meantime
+                try:
+                    remove(index_path)
+                except FileNotFoundError:
+                    pass
+                return self.download(url, local_path, headers)
+
+            _catch_err(r)
+            digest = self._store(r, index_path)
+
+        copyfile(path_join(self._blob_dir, digest), local_path)
+        self.evict()
+        return False
+
+
 class ISISClient:
     logger = getLogger("ISISClient")
 
     # 64KiB
     _DL_CHUNK_SIZE = 64000
 
-    def __init__(self, server_addr: str):
+    def __init__(self, server_addr: str, validate_args: bool = True,
+                 namespace: str = None, token: str = None,
+                 cache: ISISDownloadCache = None, client_id: str = None):
         self._server_addr = server_addr
 
+        # Opt in, downloads are reused from it while they're current
+        self.cache = cache
+
+        # Selects the server namespace files and jobs live in. With a token
+        # the server decides the namespace.
+        self._headers = _namespace_headers(namespace, token)
+
+        # Divides the namespace's, or host's, share of the server's job
+        # slots between its clients
+        if client_id is not None:
+            self._headers["X-ISIS-Client"] = client_id
+
+        # Program definitions used to check args before anything is uploaded
+        self._definitions = None
+        if validate_args:
+            self._definitions = _ProgramDefinitions(server_addr, self._headers)
+
     def _file_url(self, file_path):
         file_path = url_quote(file_path)
         return "/".join([self._server_addr, "files", file_path])
@@ -42,34 +361,293 @@ class ISISClient:
         return "/".join([self._file_url(file_path), "label"])
 
     def program(self, command: str):
-        return ISISRequest(self._server_addr, command)
+        return ISISRequest(self._server_addr, command, self._definitions, self._headers, self.cache)
+
+    def pixelmath(self, equation: str, inputs: dict, to: str, define: dict = None):
+        ISISClient.logger.debug("Evaluating '{}'...".format(equation))
+        start_time = time()
+
+        with tracing.span("client.pixelmath", **{"isis.pixelmath.to": to}):
+            r = requests.post(
+                "/".join([self._server_addr, "pixelmath"]),
+                json={
+                    "equation": equation,
+                    "inputs": inputs,
+                    "define": define or dict(),
+                    "to": to
+                },
+                headers=tracing.inject(self._headers)
+            )
+            _catch_err(r)
+
+        ISISClient.logger.debug("'{}' took {:.1f}s".format(
+            equation,
+            time() - start_time
+        ))
+
+    def hirise_color(self, observation: str, to: str, ttl: int = None, callback: dict = None,
+                     priority: str = None):
+        # Runs the whole RED/BG color mosaic workflow on the server. The
+        # result's stages hold each stage's timing.
+        ISISClient.logger.debug("Building color product for {}...".format(observation))
+        start_time = time()
+
+        body = {"observation": observation, "to": to}
+        if ttl is not None:
+            body["ttl"] = ttl
+        if callback is not None:
+            body["callback"] = callback
+        if priority is not None:
+            body["priority"] = priority
+
+        with tracing.span("client.hirise_color", **{"hirise.observation": observation}):
+            r = requests.post(
+                "/".join([self._server_addr, "workflows", "hirise-color"]),
+                json=body,
+                headers=tracing.inject(self._headers)
+            )
+            _catch_err(r)
+
+        ISISClient.logger.debug("{} took {:.1f}s".format(
+            observation,
+            time() - start_time
+        ))
+        return ISISResult(self._server_addr, r.json(), self._headers, self.cache)
+
+    def store_list(self, items: list):
+        """
+        Stores a list of file names on the server, unless it already is, and
+        returns a reference to pass as a list arg in its place. Jobs given
+        the same list don't send it again.
+        """
+        list_id = sha256("".join("{}\n".format(i) for i in items).encode("utf-8")).hexdigest()
+        list_url = "/".join([self._server_addr, "lists", list_id])
+
+        r = requests.head(list_url, headers=tracing.inject(self._headers))
+        if r.status_code == 404:
+            r = requests.post(
+                "/".join([self._server_addr, "lists"]),
+                json={"items": items},
+                headers=tracing.inject(self._headers)
+            )
+            _catch_err(r)
+            list_id = r.json()["list_id"]
+        else:
+            _catch_err(r)
+
+        return {"list": list_id}
+
+    def download(self, remote_path, local_path, content_sha256: str = None):
+        remote_url = self._file_url(remote_path)
+        ISISClient.logger.debug("Downloading {}...".format(remote_url))
+        start_time = time()
+
+        with tracing.span("client.download", **{"http.url": remote_url}) as span:
+            if self.cache is not None:
+                span.set_attribute("cache.hit", self.cache.download(
+                    remote_url,
+                    local_path,
+                    self._headers,
+                    content_sha256
+                ))
+            else:
+                r = requests.get(remote_url, headers=tracing.inject(self._headers), stream=True)
+                _catch_err(r)
+                with closing(r), open(local_path, "wb") as f:
+                    for chunk in r.iter_content(ISISClient._DL_CHUNK_SIZE):
+                        f.write(chunk)
+
+        ISISClient.logger.debug("{} downloaded to {} (took {:.1f}s)".format(
+            remote_url,
+            local_path,
+            time() - start_time
+        ))
+
+    def tail(self, remote_path, local_path, wait: float = None, job_id: str = None):
+        """
+        Downloads a file while a job is still writing it, and returns once
+        the job's finished, so the transfer overlaps with the job. Parts the
+        job rewrites, e.g. a cube's label, are patched as it finishes.
+        The server waits up to wait seconds for a job writing it to appear.
+        Given the job_id of the job that writes it, the server waits while
+        that job is pending or running instead, and once it's finished sends
+        the file as it left it.
+        """
+        remote_url = self._file_url(remote_path)
+        ISISClient.logger.debug("Tailing {}...".format(remote_url))
+        start_time = time()
+
+        params = {"tail": "true"}
+        if wait is not None:
+            params["wait"] = wait
+        if job_id is not None:
+            params["job"] = job_id
+
+        with tracing.span("client.tail", **{"http.url": remote_url}) as span:
+            r = requests.get(
+                remote_url,
+                params=params,
+                headers=tracing.inject(self._headers),
+                stream=True
+            )
+            _catch_err(r)
+
+            frames = 0
+            with closing(r), open(local_path, "wb") as f:
+                while True:
+                    offset, length = _TAIL_FRAME.unpack(_read_exactly(r.raw, _TAIL_FRAME.size))
+                    data = _read_exactly(r.raw, length)
+                    if offset == _TAIL_ERROR_OFFSET:
+                        raise RuntimeError("Tailing {} failed: {}".format(
+                            remote_path,
+                            data.decode("utf-8")
+                        ))
+                    if length == 0:
+                        # The end, offset is the final size
+                        f.truncate(offset)
+                        break
+
+                    f.seek(offset)
+                    f.write(data)
+                    frames += 1
+            span.set_attribute("tail.frames", frames)
+
+        ISISClient.logger.debug("{} tailed to {} (took {:.1f}s)".format(
+            remote_url,
+            local_path,
+            time() - start_time
+        ))
+
+    def list_files(self, prefix: str = None, older_than: float = None, min_size: int = None):
+        params = {"prefix": prefix, "older_than": older_than, "min_size": min_size}
+        params = {k: v for k, v in params.items() if v is not None}
+
+        # Pages are fetched as the caller iterates
+        while True:
+            r = requests.get(
+                "/".join([self._server_addr, "files"]),
+                params=params,
+                headers=tracing.inject(self._headers)
+            )
+            _catch_err(r)
+            page = r.json()
 
-    def download(self, remote_path, local_path):
-        return ISISClient.fetch(self._file_url(remote_path), local_path)
+            yield from page["files"]
+
+            if page["next"] is None:
+                return
+            params["after"] = page["next"]
+
+    def job(self, job_id: str):
+        r = requests.get(
+            "/".join([self._server_addr, "jobs", job_id]),
+            headers=tracing.inject(self._headers)
+        )
+        _catch_err(r)
+        return ISISResult(self._server_addr, {"job": r.json()}, self._headers, self.cache)
+
+    def usage(self):
+        r = requests.get(
+            "/".join([self._server_addr, "usage"]),
+            headers=tracing.inject(self._headers)
+        )
+        _catch_err(r)
+        return r.json()
+
+    def download_bundle(self, local_dir: str, remote_paths: list = None,
+                        pattern: str = None, compression: str = None):
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError("zstd bundles require the zstandard package")
+
+        ISISClient.logger.debug("Downloading bundle of {}...".format(
+            remote_paths or pattern
+        ))
+        start_time = time()
+
+        body = {"files": remote_paths or list()}
+        if pattern is not None:
+            body["pattern"] = pattern
+        if compression is not None:
+            body["compression"] = compression
+
+        r = requests.post(
+            "/".join([self._server_addr, "files:bundle"]),
+            json=body,
+            headers=tracing.inject(self._headers),
+            stream=True
+        )
+        _catch_err(r)
+
+        # Files are unpacked as the archive arrives, nothing is spooled
+        stream = r.raw
+        if compression == "zstd":
+            stream = zstandard.ZstdDecompressor().stream_reader(r.raw)
+        mode = "r|gz" if compression == "gzip" else "r|"
+
+        local_paths = list()
+        with closing(r), tarfile.open(fileobj=stream, mode=mode) as tar:
+            for member in tar:
+                name = normpath(member.name)
+                if not member.isfile() or isabs(name) or name.startswith(".."):
+                    continue
+
+                local_path = path_join(local_dir, name)
+                makedirs(dirname(local_path) or ".", exist_ok=True)
+                with tar.extractfile(member) as src, open(local_path, "wb") as dst:
+                    copyfileobj(src, dst, ISISClient._DL_CHUNK_SIZE)
+                local_paths.append(local_path)
+
+        ISISClient.logger.debug("Bundle of {} files downloaded to {} (took {:.1f}s)".format(
+            len(local_paths),
+            local_dir,
+            time() - start_time
+        ))
+        return local_paths
+
+    def retain(self, remote_path):
+        # Moves the file to durable storage and exempts it from job TTLs
+        r = requests.put(
+            "/".join([self._file_url(remote_path), "retain"]),
+            headers=tracing.inject(self._headers)
+        )
+        _catch_err(r)
 
     def delete(self, remote_path):
         remote_url = self._file_url(remote_path)
         ISISClient.logger.debug("Deleting {}...".format(remote_url))
-        r = requests.delete(remote_url)
+        r = requests.delete(remote_url, headers=tracing.inject(self._headers))
         _catch_err(r)
         ISISClient.logger.debug("{} deleted successfully".format(remote_url))
 
     def label(self, remote_path):
         remote_url = self._label_url(remote_path)
         ISISClient.logger.debug("Retrieving label for {}...".format(remote_url))
-        r = requests.get(remote_url)
+        r = requests.get(remote_url, headers=tracing.inject(self._headers))
         _catch_err(r)
         ISISClient.logger.debug("Label for {} retrieved successfully".format(remote_url))
         return r.json()
 
+    def compare(self, remote_path, other_path, tolerance: float = None):
+        # Compared on the server, only the differences come back
+        remote_url = "/".join([self._file_url(remote_path), "compare", url_quote(other_path)])
+        ISISClient.logger.debug("Comparing {}...".format(remote_url))
+        params = {"tolerance": tolerance} if tolerance is not None else None
+        r = requests.get(remote_url, params=params, headers=tracing.inject(self._headers))
+        _catch_err(r)
+        return r.json()
+
     @staticmethod
-    def fetch(remote_url, download_path):
+    def fetch(remote_url, download_path, cache: ISISDownloadCache = None):
         ISISClient.logger.debug("Downloading {}...".format(remote_url))
         start_time = time()
 
-        # urlretrieve can do both http & ftp
+        # urlretrieve can do both http & ftp, the cache only http
         try:
-            urlretrieve(remote_url, download_path)
+            with tracing.span("client.fetch", **{"http.url": remote_url}):
+                if cache is not None and remote_url.startswith(("http://", "https://")):
+                    cache.download(remote_url, download_path)
+                else:
+                    urlretrieve(remote_url, download_path)
         except HTTPError as e:
             err_msg = "Server returned {}: {}".format(e.code, e.reason)
             raise RuntimeError(err_msg)
@@ -85,13 +663,106 @@ class ISISClient:
         ISISClient.logger.debug(log_msg)
 
 
+class ISISOutput:
+    def __init__(self, manifest_entry: dict):
+        self.name = manifest_entry["name"]
+        self.status = manifest_entry["status"]
+        self.size = manifest_entry["size"]
+        self.sha256 = manifest_entry["sha256"]
+
+    def __repr__(self):
+        return "ISISOutput({!r}, {})".format(self.name, self.status)
+
+
+class ISISResult:
+    # 1MiB
+    _HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, server_url: str, response: dict, headers: dict = None,
+                 cache: ISISDownloadCache = None):
+        self._server_url = server_url
+        self._headers = headers or dict()
+        self._cache = cache
+
+        # Jobs sent with a callback are only accepted, and have nothing but
+        # their ID until they finish
+        job = response.get("job") or dict()
+        self.job_id = job.get("job_id", response.get("job_id"))
+        self.started = job.get("started")
+        self.finished = job.get("finished")
+
+        # The files the job created or modified
+        self.outputs = [ISISOutput(o) for o in job.get("outputs", list())]
+
+        # Timings of each stage, for workflows
+        self.stages = response.get("stages", list())
+
+    def _client(self):
+        client = ISISClient(self._server_url, validate_args=False, cache=self._cache)
+        client._headers = self._headers
+        return client
+
+    @staticmethod
+    def _verify(output: ISISOutput, local_path: str):
+        digest = sha256()
+        with open(local_path, "rb") as f:
+            for chunk in iter(lambda: f.read(ISISResult._HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+        if digest.hexdigest() != output.sha256:
+            raise RuntimeError("Checksum mismatch downloading {}".format(output.name))
+
+    def _download_output(self, output: ISISOutput, local_dir: str):
+        local_path = path_join(local_dir, output.name)
+        makedirs(dirname(local_path) or ".", exist_ok=True)
+        self._client().download(
+            output.name,
+            local_path,
+            output.sha256
+        )
+
+        ISISResult._verify(output, local_path)
+        return local_path
+
+    def download(self, local_dir: str, max_workers: int = 4, bundle: bool = False):
+        if bundle:
+            # One streamed archive instead of a request per output
+            self._client().download_bundle(
+                local_dir,
+                [o.name for o in self.outputs]
+            )
+            local_paths = list()
+            for output in self.outputs:
+                local_paths.append(path_join(local_dir, output.name))
+                ISISResult._verify(output, local_paths[-1])
+            return local_paths
+
+        with tracing.span("client.result.download", **{"isis.job_id": self.job_id}), \
+                ThreadPoolExecutor(max_workers=max_workers) as pool:
+            threads = [
+                pool.submit(tracing.wrap(self._download_output), output, local_dir)
+                for output in self.outputs
+            ]
+
+        return [t.result() for t in threads]
+
+
 class ISISRequest:
-    def __init__(self, server_url: str, program: str):
+    def __init__(self, server_url: str, program: str, definitions=None, headers: dict = None,
+                 cache: ISISDownloadCache = None):
         self._server_url = server_url
+        self._headers = headers or dict()
+        self._cache = cache
         self._program = program
+        self._definitions = definitions
         self._args = dict()
         self._files = dict()
         self._remotes = list()
+        self._callback = None
+        self._ttl = None
+        self._retain = False
+        self._priority = None
+        self._tails = dict()
         self._logger = getLogger(program)
 
     def add_arg(self, arg_name, arg_value, is_remote=False):
@@ -106,40 +777,170 @@ class ISISRequest:
         self._files[arg_name] = file_path
         return self
 
+    def ttl(self, seconds: int):
+        # Outputs are deleted this long after the job, and short lived ones
+        # are written to the server's scratch tier
+        self._ttl = seconds
+        return self
+
+    def retain(self):
+        # Outputs go to durable storage whatever the TTL
+        self._retain = True
+        return self
+
+    def priority(self, lane: str):
+        # "interactive" or "batch". Interactive jobs are started first when
+        # the server is busy, and callback jobs default to batch.
+        self._priority = lane
+        return self
+
+    def tail(self, arg_name, local_path):
+        # Download an output arg's file while the program writes it. send()
+        # returns once it's downloaded.
+        self._tails[arg_name] = local_path
+        return self
+
+    def callback(self, url: str, secret: str = None):
+        # Run in the background and notify url when done, see
+        # verify_notification
+        self._callback = {"url": url}
+        if secret is not None:
+            self._callback["secret"] = secret
+        return self
+
+    def validate(self):
+        if self._definitions is None:
+            return
+
+        definition = self._definitions.get(self._program)
+        if definition is None:
+            return
+
+        errors = _validate_args(
+            definition,
+            [*self._args.keys(), *self._files.keys()],
+            self._args
+        )
+        if len(errors) > 0:
+            raise ValueError("Invalid args for {}: {}".format(
+                self._program,
+                "; ".join(errors)
+            ))
+
     def send(self):
         self._logger.debug("Starting...")
         start_time = time()
 
+        self.validate()
+
         file_uploads = dict()
         command_args = {**self._args}
 
         for arg_name, file_path in self._files.items():
             file_name = basename(file_path)
-            file_uploads[file_name] = open(self._files[arg_name], 'rb')
+            file_uploads[file_name] = file_path
             command_args[arg_name] = file_name
 
-        if len(file_uploads.keys()) > 0:
-            r = requests.post(
-                "/".join([self._server_url, "files"]),
-                files=file_uploads
-            )
-            _catch_err(r)
-
         cmd_req = {
             "program": self._program,
             "args": command_args,
             "remotes": self._remotes
         }
+        if self._ttl is not None:
+            cmd_req["ttl"] = self._ttl
+        if self._retain:
+            cmd_req["retain"] = True
+        if self._callback is not None:
+            cmd_req["callback"] = self._callback
+        if self._priority is not None:
+            cmd_req["priority"] = self._priority
+
+        # With files to upload the job is created first, so the server
+        # fetches its remotes while they upload and runs it once they land
+        if len(file_uploads.keys()) > 0:
+            cmd_req["uploads"] = list(self._files.keys())
 
-        r = requests.post(
-            "/".join([self._server_url, "isis"]),
-            json=cmd_req
-        )
+        # Tails name the job, so they know when it's finished
+        if self._tails:
+            cmd_req["job_id"] = uuid4().hex
 
-        try:
-            _catch_err(r)
-        except RuntimeError as e:
-            self._logger.error(json.dumps(cmd_req))
-            raise e
+        with tracing.span("client.send", **{"isis.program": self._program}) as span:
+            tails = self._start_tails(cmd_req.get("job_id"))
+
+            r = requests.post(
+                "/".join([self._server_url, "isis"]),
+                json=cmd_req,
+                headers=tracing.inject(self._headers)
+            )
+
+            if r.ok and len(file_uploads.keys()) > 0:
+                span.set_attribute("isis.job_id", r.json()["job_id"])
+                files = {name: open(path, "rb") for name, path in file_uploads.items()}
+                try:
+                    with tracing.span("client.upload", **{"upload.files": len(files)}):
+                        r = requests.post(
+                            "/".join([self._server_url, "isis", r.json()["job_id"], "inputs"]),
+                            files=files,
+                            headers=tracing.inject(self._headers)
+                        )
+                finally:
+                    [f.close() for f in files.values()]
+
+            # Tails of a job that failed are left to the server to end
+            try:
+                _catch_err(r)
+            except RuntimeError as e:
+                self._logger.error(json.dumps(cmd_req))
+                raise e
+
+            self._finish_tails(tails)
 
         self._logger.debug("Took {:.1f}s".format(time() - start_time))
+
+        return ISISResult(self._server_url, r.json(), self._headers, self._cache)
+
+    def _client(self):
+        client = ISISClient(self._server_url, validate_args=False, cache=self._cache)
+        client._headers = self._headers
+        return client
+
+    def _start_tails(self, job_id):
+        # Each output is tailed in a thread while the job runs. Tails that
+        # fail, e.g. because the job's outputs were moved, are downloaded
+        # once it's done instead.
+        tails = list()
+        for arg_name, local_path in self._tails.items():
+            # Without ISIS cube attributes, e.g. out.cub+8bit
+            remote_path = str(self._args[arg_name]).split("+")[0]
+            tail = {
+                "remote_path": remote_path,
+                "local_path": local_path,
+                "job_id": job_id,
+                "error": None
+            }
+            tail["thread"] = Thread(
+                target=tracing.wrap(self._tail),
+                args=(tail,),
+                daemon=True
+            )
+            tail["thread"].start()
+            tails.append(tail)
+        return tails
+
+    def _tail(self, tail):
+        try:
+            # The server waits on the job while it's queued, and ends the
+            # tail once it's finished
+            self._client().tail(tail["remote_path"], tail["local_path"], job_id=tail["job_id"])
+        except (RuntimeError, requests.RequestException) as e:
+            tail["error"] = e
+
+    def _finish_tails(self, tails):
+        for tail in tails:
+            tail["thread"].join()
+            if tail["error"] is not None:
+                self._logger.debug("Tailing {} failed ({}), downloading it".format(
+                    tail["remote_path"],
+                    tail["error"]
+                ))
+                self._client().download(tail["remote_path"], tail["local_path"])
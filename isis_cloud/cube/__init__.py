@@ -0,0 +1 @@
+from ._cube import Cube, Core, read_label
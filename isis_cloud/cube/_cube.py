@@ -0,0 +1,456 @@
+import re
+from operator import index as as_index
+
+import numpy as np
+
+from .. import tracing
+
+_PIXEL_TYPES = {
+    "UnsignedByte": "u1",
+    "SignedWord": "i2",
+    "UnsignedWord": "u2",
+    "SignedInteger": "i4",
+    "Real": "f4",
+}
+
+_BYTE_ORDERS = {
+    "Lsb": "<",
+    "Msb": ">",
+}
+
+# Raw special pixel values in the order Null, Lrs, Lis, His, Hrs. Real
+# specials are compared as their bit patterns.
+_SPECIAL_PIXELS = {
+    "UnsignedByte": (0, 0, 0, 255, 255),
+    "SignedWord": (-32768, -32767, -32766, -32765, -32764),
+    "UnsignedWord": (0, 1, 2, 65534, 65535),
+    "SignedInteger": (-8388613, -8388612, -8388611, -8388610, -8388609),
+    "Real": (0xFF7FFFFB, 0xFF7FFFFC, 0xFF7FFFFD, 0xFF7FFFFE, 0xFF7FFFFF),
+}
+
+# Pixels per chunk when streaming BandSequential cores
+_CHUNK_PIXELS = 1024 * 1024
+
+# Layout of cubes created by Cube.create, matching ISIS defaults
+_LABEL_BYTES = 65536
+_TILE_SIZE = 128
+
+# The line ending an attached label, which is followed by padding or pixels
+_LABEL_END = re.compile(rb"^End(?=\W)", re.MULTILINE | re.IGNORECASE)
+
+
+def read_label(file_path):
+    with tracing.span("cube.read_label"):
+        return _read_label(file_path)
+
+
+def _read_label(file_path):
+    # pvl is imported where it's used, as it's slow to import and most
+    # users of this module only need it on their first label
+    from pvl import load as pvl_load, loads as pvl_loads
+
+    # Only reads up to the end of the label rather than the whole cube
+    with open(file_path, "rb") as f:
+        text = b""
+        for chunk in iter(lambda: f.read(_LABEL_BYTES), b""):
+            # Overlap the previous chunk in case End was split across them
+            start = max(0, len(text) - 8)
+            text += chunk
+            end = _LABEL_END.search(text, start)
+            if end is not None:
+                return pvl_loads(text[:end.end()].decode("utf-8"))
+
+            # Binary data before any End, not an attached label
+            if b"\0" in chunk:
+                break
+
+    return pvl_load(file_path)
+
+
+def _axis_index(key, size):
+    # Returns the indices selected along one axis and whether an integer
+    # key dropped the axis
+    if isinstance(key, slice):
+        return np.arange(*key.indices(size)), False
+
+    idx = as_index(key)
+    if idx < 0:
+        idx += size
+    if not 0 <= idx < size:
+        raise IndexError("index {} out of range for size {}".format(key, size))
+
+    return np.array([idx]), True
+
+
+def _is_contiguous(indices):
+    return indices.size > 0 and indices[-1] - indices[0] == indices.size - 1
+
+
+def _normalize_key(key, shape):
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) > 3:
+        raise IndexError("cubes are indexed by [band, lines, samples]")
+    key = key + (slice(None),) * (3 - len(key))
+
+    return [_axis_index(k, size) for k, size in zip(key, shape)]
+
+
+def _blobs(label):
+    # Tables, History, OriginalLabel etc. are stored as byte ranges outside
+    # the label and core
+    return [
+        (name, value)
+        for name, value in label.items()
+        if isinstance(value, dict) and "StartByte" in value and "Bytes" in value
+    ]
+
+
+def _create_label(samples, lines, bands, template, label_bytes):
+    from pvl import PVLGroup, PVLModule, PVLObject
+
+    core_bytes = (
+        bands *
+        -(-lines // _TILE_SIZE) * _TILE_SIZE *
+        -(-samples // _TILE_SIZE) * _TILE_SIZE *
+        4
+    )
+
+    isis_cube = PVLObject([
+        ("Core", PVLObject([
+            ("StartByte", label_bytes + 1),
+            ("Format", "Tile"),
+            ("TileSamples", _TILE_SIZE),
+            ("TileLines", _TILE_SIZE),
+            ("Dimensions", PVLGroup([
+                ("Samples", samples),
+                ("Lines", lines),
+                ("Bands", bands),
+            ])),
+            ("Pixels", PVLGroup([
+                ("Type", "Real"),
+                ("ByteOrder", "Lsb"),
+                ("Base", 0.0),
+                ("Multiplier", 1.0),
+            ])),
+        ]))
+    ])
+    label = PVLModule([("IsisCube", isis_cube)])
+
+    if template is not None:
+        for name, value in template.label["IsisCube"].items():
+            if name != "Core":
+                isis_cube.append(name, value)
+
+        next_byte = label_bytes + core_bytes + 1
+        for name, blob in _blobs(template.label):
+            blob = PVLObject(blob)
+            blob["StartByte"] = next_byte
+            next_byte += int(blob["Bytes"])
+            label.append(name, blob)
+
+    label.append("Label", PVLObject([("Bytes", label_bytes)]))
+
+    return label, core_bytes
+
+
+class Core:
+    def __init__(self, label):
+        try:
+            core = label["IsisCube"]["Core"]
+            dims = core["Dimensions"]
+            pixels = core["Pixels"]
+            self.pixel_type = pixels["Type"]
+            self.byte_order = pixels["ByteOrder"]
+            self.dtype = np.dtype(
+                _BYTE_ORDERS[self.byte_order] + _PIXEL_TYPES[self.pixel_type]
+            )
+        except KeyError as e:
+            raise ValueError("Unsupported cube core: missing {}".format(e))
+
+        if "StartByte" not in core.keys():
+            raise ValueError("Detached cube cores are not supported")
+
+        self.samples = int(dims["Samples"])
+        self.lines = int(dims["Lines"])
+        self.bands = int(dims["Bands"])
+        self.base = float(pixels["Base"])
+        self.multiplier = float(pixels["Multiplier"])
+        self.format = core["Format"]
+
+        # StartByte is 1-based
+        self.offset = int(core["StartByte"]) - 1
+
+        if self.format == "Tile":
+            self.tile_samples = int(core["TileSamples"])
+            self.tile_lines = int(core["TileLines"])
+        elif self.format == "BandSequential":
+            self.tile_samples = self.samples
+            self.tile_lines = 1
+        else:
+            raise ValueError("Unsupported cube format '{}'".format(self.format))
+
+    @property
+    def shape(self):
+        return self.bands, self.lines, self.samples
+
+    @property
+    def storage_shape(self):
+        # Tiled cores are stored band by band, then row by row of whole
+        # tiles, with the last row/column of tiles padded out
+        if self.format == "Tile":
+            return (
+                self.bands,
+                -(-self.lines // self.tile_lines),
+                -(-self.samples // self.tile_samples),
+                self.tile_lines,
+                self.tile_samples
+            )
+
+        return self.bands, self.lines, self.samples
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.storage_shape)) * self.dtype.itemsize
+
+
+class _RawPixels:
+    def __init__(self, cube):
+        self._cube = cube
+
+    def __getitem__(self, key):
+        return self._cube._read_raw(key)
+
+
+class Cube:
+    # Special pixel codes returned by special_codes
+    VALID = 0
+    NULL = 1
+    LRS = 2
+    LIS = 3
+    HIS = 4
+    HRS = 5
+
+    def __init__(self, file_path, label=None, writable=False):
+        self.file_path = file_path
+        self.label = read_label(file_path) if label is None else label
+        self.core = Core(self.label)
+
+        self._pixels = np.memmap(
+            file_path,
+            dtype=self.core.dtype,
+            mode="r+" if writable else "r",
+            offset=self.core.offset,
+            shape=self.core.storage_shape
+        )
+
+        # cube.raw[band, lines, samples] gives unscaled DNs in native byte
+        # order, cube[band, lines, samples] gives scaled values
+        self.raw = _RawPixels(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getitem__(self, key):
+        return self.to_float(self._read_raw(key))
+
+    def __setitem__(self, key, values):
+        if self.core.pixel_type != "Real":
+            raise ValueError("Only Real cubes can be written")
+
+        (bands, _), (rows, _), (cols, _) = _normalize_key(key, self.shape)
+        if not (_is_contiguous(rows) and _is_contiguous(cols)):
+            raise IndexError("Only contiguous windows can be written")
+
+        raw = self.from_float(np.broadcast_to(
+            values,
+            (bands.size, rows.size, cols.size)
+        ))
+        for band, band_raw in zip(bands, raw):
+            self._write_band(band, rows, cols, band_raw)
+
+    @property
+    def shape(self):
+        return self.core.shape
+
+    def flush(self):
+        if self._pixels.mode == "r+":
+            self._pixels.flush()
+
+    def close(self):
+        if self._pixels is not None:
+            self.flush()
+        self._pixels = None
+
+    @staticmethod
+    def create(file_path, samples, lines, bands=1, template=None):
+        # Creates a Real, tiled cube and opens it for writing. Everything in
+        # the template cube's label except the core, and any tables/blobs it
+        # carries, are copied to the new cube.
+        from pvl import dumps as pvl_dumps
+        from pvl.encoder import ISISEncoder
+
+        label_bytes = _LABEL_BYTES
+        while True:
+            label, core_bytes = _create_label(
+                samples,
+                lines,
+                bands,
+                template,
+                label_bytes
+            )
+            label_text = pvl_dumps(label, encoder=ISISEncoder()).encode("utf-8")
+            if len(label_text) <= label_bytes:
+                break
+            label_bytes = -(-len(label_text) // _LABEL_BYTES) * _LABEL_BYTES
+
+        with open(file_path, "wb") as f:
+            f.write(label_text)
+            f.truncate(label_bytes + core_bytes)
+            f.seek(label_bytes + core_bytes)
+
+            if template is not None:
+                with open(template.file_path, "rb") as template_file:
+                    for _, blob in _blobs(template.label):
+                        template_file.seek(int(blob["StartByte"]) - 1)
+                        f.write(template_file.read(int(blob["Bytes"])))
+
+        return Cube(file_path, writable=True)
+
+    def _read_band(self, band, rows, cols):
+        core = self.core
+
+        if rows.size == 0 or cols.size == 0:
+            return np.empty((rows.size, cols.size), dtype=core.dtype)
+
+        if core.format == "BandSequential":
+            if _is_contiguous(rows) and _is_contiguous(cols):
+                return np.array(self._pixels[
+                    band,
+                    rows[0]:rows[-1] + 1,
+                    cols[0]:cols[-1] + 1
+                ])
+            return self._pixels[band, rows[:, None], cols[None, :]]
+
+        if not (_is_contiguous(rows) and _is_contiguous(cols)):
+            # Gather individual pixels so strided reads only touch the tile
+            # lines they need
+            return self._pixels[
+                band,
+                (rows // core.tile_lines)[:, None],
+                (cols // core.tile_samples)[None, :],
+                (rows % core.tile_lines)[:, None],
+                (cols % core.tile_samples)[None, :]
+            ]
+
+        # Copy the whole tiles covering the block, then crop to it
+        first_row, last_row = rows[0] // core.tile_lines, rows[-1] // core.tile_lines
+        first_col, last_col = cols[0] // core.tile_samples, cols[-1] // core.tile_samples
+        tiles = self._pixels[band, first_row:last_row + 1, first_col:last_col + 1]
+        block = tiles.transpose(0, 2, 1, 3).reshape(
+            tiles.shape[0] * core.tile_lines,
+            tiles.shape[1] * core.tile_samples
+        )
+
+        line_start = rows[0] - first_row * core.tile_lines
+        sample_start = cols[0] - first_col * core.tile_samples
+        return np.array(block[
+            line_start:line_start + rows.size,
+            sample_start:sample_start + cols.size
+        ])
+
+    def _write_band(self, band, rows, cols, raw):
+        core = self.core
+
+        if core.format == "BandSequential":
+            self._pixels[
+                band,
+                rows[0]:rows[-1] + 1,
+                cols[0]:cols[-1] + 1
+            ] = raw
+            return
+
+        # Read-modify-write the whole tiles covering the block so pixels
+        # outside it are preserved
+        first_row, last_row = rows[0] // core.tile_lines, rows[-1] // core.tile_lines
+        first_col, last_col = cols[0] // core.tile_samples, cols[-1] // core.tile_samples
+        tiles = self._pixels[band, first_row:last_row + 1, first_col:last_col + 1]
+        block = tiles.transpose(0, 2, 1, 3).reshape(
+            tiles.shape[0] * core.tile_lines,
+            tiles.shape[1] * core.tile_samples
+        )
+
+        line_start = rows[0] - first_row * core.tile_lines
+        sample_start = cols[0] - first_col * core.tile_samples
+        block[
+            line_start:line_start + rows.size,
+            sample_start:sample_start + cols.size
+        ] = raw
+
+        tiles[...] = block.reshape(
+            tiles.shape[0],
+            core.tile_lines,
+            tiles.shape[1],
+            core.tile_samples
+        ).transpose(0, 2, 1, 3)
+
+    def _read_raw(self, key):
+        bands, rows, cols = _normalize_key(key, self.shape)
+
+        raw = np.stack([self._read_band(b, rows[0], cols[0]) for b in bands[0]])
+        raw = raw.astype(self.core.dtype.newbyteorder("="), copy=False)
+
+        drop = tuple(
+            axis
+            for axis, (_, dropped) in enumerate([bands, rows, cols])
+            if dropped
+        )
+        return raw.squeeze(axis=drop) if drop else raw
+
+    def iter_chunks(self, band):
+        # Raw DNs one row of tiles at a time, or roughly as many pixels of
+        # BandSequential lines, so memory use doesn't grow with the cube
+        if self.core.format == "Tile":
+            chunk_lines = self.core.tile_lines
+        else:
+            chunk_lines = max(1, _CHUNK_PIXELS // self.core.samples)
+
+        for line in range(0, self.core.lines, chunk_lines):
+            yield self.raw[band, line:line + chunk_lines]
+
+    def special_codes(self, raw):
+        if self.core.pixel_type == "Real":
+            raw = raw.view(raw.dtype.str.replace("f", "u")).astype(np.uint32)
+
+        codes = np.zeros(raw.shape, dtype=np.uint8)
+        for code, value in enumerate(_SPECIAL_PIXELS[self.core.pixel_type], 1):
+            codes[(codes == Cube.VALID) & (raw == value)] = code
+
+        return codes
+
+    def from_float(self, values):
+        # The inverse of to_float for Real cores
+        null, lrs, _, _, hrs = _SPECIAL_PIXELS["Real"]
+        values = np.asarray(values, dtype=np.float64)
+
+        with np.errstate(invalid="ignore"):
+            raw = ((values - self.core.base) / self.core.multiplier).astype(np.float32)
+
+        bits = raw.view(np.uint32)
+        bits[np.isnan(values)] = null
+        bits[values == -np.inf] = lrs
+        bits[values == np.inf] = hrs
+        return raw
+
+    def to_float(self, raw):
+        # Base/Multiplier scaled values with Null as NaN and low/high
+        # saturation as -inf/+inf
+        codes = self.special_codes(raw)
+        values = raw.astype(np.float32) * self.core.multiplier + self.core.base
+        values[codes == Cube.NULL] = np.nan
+        values[(codes == Cube.LRS) | (codes == Cube.LIS)] = -np.inf
+        values[(codes == Cube.HIS) | (codes == Cube.HRS)] = np.inf
+        return values
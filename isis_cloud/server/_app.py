@@ -1,10 +1,64 @@
+import json
+from hashlib import sha256
 from logging import getLogger
 
 import connexion
+import yaml
+from flask import g, request
+from fcntl import flock, LOCK_EX
+from threading import Lock, Thread
 from time import sleep, time
-from os import listdir, stat as file_stat, remove, removedirs
-from os.path import join as path_join, basename, isdir
+from os import getpid, listdir, makedirs, stat as file_stat, remove, removedirs
+from os.path import join as path_join, basename, dirname, isdir
+from .. import tracing
+from ._cache import atomic_writer, sidecar_path
 from ._config import ISISServerConfig
+from ._jobs import ISISJobs
+from ._lists import ISISLists
+from ._namespaces import ISISNamespaces, QuotaExceeded
+from ._pending import ISISPendingJobs
+from ._programs import ISISPrograms
+from ._scheduler import ISISScheduler
+from ._spice import ISISSpiceCache
+from ._storage import ISISStorage
+from ._tail import expire_producers
+from ._webhooks import ISISWebhooks
+
+
+_SPEC_FILE = path_join(dirname(__file__), "openapi", "main.yml")
+
+# libyaml's loader when PyYAML was built with it
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Held by the process running the background sweeps
+_BACKGROUND_LOCK_FILE = ".background.lock"
+
+
+def _load_spec():
+    # Connexion parses the spec with the pure Python YAML loader, which is
+    # most of the app's startup. The parse is cached as JSON next to it.
+    with open(_SPEC_FILE, "rb") as f:
+        text = f.read()
+    digest = sha256(text).hexdigest()
+
+    cache_file = sidecar_path(_SPEC_FILE, "json")
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached["sha256"] == digest:
+            return cached["spec"]
+    except (OSError, KeyError, ValueError):
+        pass
+
+    spec = yaml.load(text, Loader=_YAML_LOADER)
+    try:
+        with atomic_writer(cache_file, "w") as f:
+            json.dump({"sha256": digest, "spec": spec}, f)
+    except (OSError, TypeError):
+        # A read-only install just parses it every time
+        pass
+
+    return spec
 
 
 class ISISServer(connexion.FlaskApp):
@@ -12,13 +66,144 @@ class ISISServer(connexion.FlaskApp):
     # Remove stale files once per day
     _DELETE_FILES_AFTER = 3600 * 24
 
+    # The process that started the background sweeps
+    _background_pid = None
+    _background_started = Lock()
+    _background_lock = None
+
     def __init__(self):
         super().__init__(
             __name__,
             specification_dir="openapi",
             options={"swagger_url": "/docs"}
         )
-        self.add_api("main.yml")
+        self.add_api(_load_spec())
+        self.app.before_request(ISISServer._start_trace)
+        self.app.after_request(ISISServer._trace_response)
+        self.app.teardown_request(ISISServer._end_trace)
+        self.app.before_request(ISISNamespaces.resolve)
+        self.add_error_handler(QuotaExceeded, ISISServer._quota_exceeded)
+        self.app.before_request(ISISServer.start_background)
+
+        # Nothing here starts a thread, so a preloaded app forks safely
+        ISISPrograms.load()
+
+    @staticmethod
+    def start_background():
+        """
+        Starts the background sweeps, and warms ISISDATA, in this process.
+        Threads don't survive a fork, so workers call this once they're
+        forked (gunicorn.conf.py), and failing that on their first request.
+        Only one process runs them at a time, the others wait on a lock in
+        the data dir to take over if it exits.
+        """
+        if ISISServer._background_pid == getpid():
+            return
+        with ISISServer._background_started:
+            if ISISServer._background_pid == getpid():
+                return
+            ISISServer._background_pid = getpid()
+        Thread(target=ISISServer._background, daemon=True).start()
+
+    @staticmethod
+    def _background():
+        makedirs(ISISServerConfig.data_dir(), exist_ok=True)
+        # Kept open, and so held, until the process exits
+        ISISServer._background_lock = open(
+            path_join(ISISServerConfig.data_dir(), _BACKGROUND_LOCK_FILE),
+            "a"
+        )
+        flock(ISISServer._background_lock, LOCK_EX)
+        ISISServer._CLEANUP_LOGGER.info("Running background sweeps in {}".format(getpid()))
+
+        ISISPrograms.warm()
+        Thread(target=ISISServer._output_expiry, daemon=True).start()
+        Thread(target=ISISServer._webhook_retries, daemon=True).start()
+
+    @staticmethod
+    def _start_trace():
+        # Each request is a span, continuing the client's trace if it sent
+        # one
+        g.span = tracing.start_span(
+            "{} {}".format(request.method, request.url_rule or request.path),
+            tracing.extract(request.headers),
+            **{"http.method": request.method, "http.target": request.path}
+        )
+
+    @staticmethod
+    def _trace_response(response):
+        g.span.set_attributes(**{
+            "http.status_code": response.status_code,
+            "isis.namespace": g.get("namespace"),
+        })
+        return response
+
+    @staticmethod
+    def _end_trace(error):
+        if "span" in g:
+            tracing.end_span(g.span, error)
+
+    @staticmethod
+    def _quota_exceeded(e):
+        return {"message": str(e)}, 507
+
+    @staticmethod
+    def _output_expiry():
+        while True:
+            try:
+                ISISJobs.expire()
+            except Exception as e:
+                ISISServer._CLEANUP_LOGGER.error(
+                    "Expiring job outputs failed: {}".format(e)
+                )
+            try:
+                ISISPendingJobs.expire()
+            except Exception as e:
+                ISISServer._CLEANUP_LOGGER.error(
+                    "Dropping abandoned jobs failed: {}".format(e)
+                )
+            try:
+                ISISLists.expire()
+            except Exception as e:
+                ISISServer._CLEANUP_LOGGER.error(
+                    "Expiring stored lists failed: {}".format(e)
+                )
+            try:
+                ISISScheduler.prune()
+            except Exception as e:
+                ISISServer._CLEANUP_LOGGER.error(
+                    "Pruning the job queue failed: {}".format(e)
+                )
+            try:
+                expire_producers(ISISServerConfig.work_dirs())
+            except Exception as e:
+                ISISServer._CLEANUP_LOGGER.error(
+                    "Dropping stale tail marks failed: {}".format(e)
+                )
+            try:
+                ISISSpiceCache.prune()
+            except Exception as e:
+                ISISServer._CLEANUP_LOGGER.error(
+                    "Pruning the SPICE cache failed: {}".format(e)
+                )
+            try:
+                ISISStorage.rebalance()
+            except Exception as e:
+                ISISServer._CLEANUP_LOGGER.error(
+                    "Rebalancing scratch storage failed: {}".format(e)
+                )
+            sleep(ISISJobs.EXPIRE_INTERVAL)
+
+    @staticmethod
+    def _webhook_retries():
+        while True:
+            try:
+                ISISWebhooks.deliver_pending()
+            except Exception as e:
+                ISISServer._CLEANUP_LOGGER.error(
+                    "Retrying webhooks failed: {}".format(e)
+                )
+            sleep(ISISWebhooks.RETRY_INTERVAL)
 
     @staticmethod
     def _file_cleanup():
@@ -0,0 +1,129 @@
+from io import BytesIO
+from logging import getLogger
+
+import numpy as np
+
+from ..cube import Cube
+from ._cache import atomic_writer, file_identity, sidecar_path
+
+logger = getLogger("Browse")
+
+# The largest pyramid level is a strided read that fits within this many
+# pixels on a side, and levels are halved until they fit within the smallest
+_BASE_LEVEL_SIZE = 4096
+_MIN_LEVEL_SIZE = 64
+
+_STRETCH_PERCENTILES = (0.5, 99.5)
+
+
+def _reduce_level(level):
+    # Pad to an even size so the level splits into 2x2 blocks
+    pad = ((0, level.shape[0] % 2), (0, level.shape[1] % 2))
+    level = np.pad(level, pad, mode="constant", constant_values=np.nan)
+    blocks = level.reshape(
+        level.shape[0] // 2, 2,
+        level.shape[1] // 2, 2
+    )
+
+    valid = np.isfinite(blocks)
+    counts = valid.sum(axis=(1, 3))
+    sums = np.where(valid, blocks, 0).sum(axis=(1, 3))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        reduced = (sums / counts).astype(np.float32)
+
+    # Blocks without valid pixels keep any saturation, otherwise they're Null
+    specials = np.fmax.reduce(np.fmax.reduce(blocks, axis=3), axis=1)
+    return np.where(counts > 0, reduced, specials)
+
+
+def _build_pyramid(cube, band):
+    stride = 1
+    while max(cube.core.lines, cube.core.samples) > _BASE_LEVEL_SIZE * stride:
+        stride *= 2
+
+    levels = [cube[band, ::stride, ::stride]]
+    while max(levels[-1].shape) > _MIN_LEVEL_SIZE:
+        levels.append(_reduce_level(levels[-1]))
+
+    return levels
+
+
+def _load_pyramid(file_path, band):
+    pyramid_file = sidecar_path(file_path, "band{}.pyramid.npz".format(band))
+    identity = np.array(file_identity(file_path)[2:])
+
+    try:
+        with np.load(pyramid_file) as pyramid:
+            if np.array_equal(pyramid["identity"], identity):
+                return [
+                    pyramid["level{}".format(i)]
+                    for i in range(int(pyramid["levels"]))
+                ]
+    except (OSError, KeyError, ValueError):
+        pass
+
+    logger.info("Building band {} pyramid for {}".format(band, file_path))
+    with Cube(file_path) as cube:
+        levels = _build_pyramid(cube, band - 1)
+
+    with atomic_writer(pyramid_file) as f:
+        np.savez(
+            f,
+            identity=identity,
+            levels=len(levels),
+            **{"level{}".format(i): lvl for i, lvl in enumerate(levels)}
+        )
+
+    return levels
+
+
+def _stretch(image):
+    valid = image[np.isfinite(image)]
+    if valid.size == 0:
+        return np.zeros(image.shape, dtype=np.uint8)
+
+    low, high = np.percentile(valid, _STRETCH_PERCENTILES)
+    if high <= low:
+        high = low + 1
+
+    with np.errstate(invalid="ignore"):
+        stretched = (image - low) / (high - low) * 254 + 1
+
+    # Valid pixels get 1-255 so they never collide with Null/Lrs/Lis
+    stretched = np.clip(np.nan_to_num(stretched, nan=0.0), 1, 255)
+    stretched[image == -np.inf] = 0
+    stretched[np.isnan(image)] = 0
+    return stretched.astype(np.uint8)
+
+
+def render_browse(file_path, band, max_size, image_format):
+    # Only browse needs Pillow, so it isn't imported at startup
+    from PIL import Image
+
+    levels = _load_pyramid(file_path, band)
+
+    # The smallest level that still covers max_size, then sample down to fit
+    level = levels[0]
+    for candidate in levels:
+        if max(candidate.shape) >= max_size:
+            level = candidate
+
+    scale = min(1.0, max_size / max(level.shape))
+    rows = (np.arange(max(1, int(level.shape[0] * scale))) / scale).astype(int)
+    cols = (np.arange(max(1, int(level.shape[1] * scale))) / scale).astype(int)
+    level = level[rows[:, None], cols[None, :]]
+
+    pixels = _stretch(level)
+    if image_format == "png":
+        alpha = np.where(np.isnan(level), 0, 255).astype(np.uint8)
+        image = Image.fromarray(np.dstack([pixels, alpha]))
+        mimetype = "image/png"
+    else:
+        image = Image.fromarray(pixels)
+        mimetype = "image/jpeg"
+
+    buf = BytesIO()
+    image.save(buf, format=image_format.upper())
+    buf.seek(0)
+    return buf, mimetype
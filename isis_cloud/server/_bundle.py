@@ -0,0 +1,87 @@
+import tarfile
+import zlib
+from logging import getLogger
+from os import stat as file_stat
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = getLogger("Bundle")
+
+# 1MiB
+_READ_CHUNK_SIZE = 1024 * 1024
+
+MIMETYPES = {
+    None: "application/x-tar",
+    "gzip": "application/gzip",
+    "zstd": "application/zstd",
+}
+
+
+def available_compressions():
+    return [c for c in MIMETYPES if c != "zstd" or zstandard is not None]
+
+
+def _tar_header(name, file_path):
+    stats = file_stat(file_path)
+    info = tarfile.TarInfo(name)
+    info.size = stats.st_size
+    info.mtime = int(stats.st_mtime)
+    info.mode = 0o644
+    return info, info.tobuf(format=tarfile.GNU_FORMAT)
+
+
+def _tar_stream(files):
+    # Headers and data are written by hand so each file is streamed in
+    # chunks instead of being buffered whole by tarfile
+    for name, file_path in files:
+        info, header = _tar_header(name, file_path)
+        yield header
+
+        remaining = info.size
+        with open(file_path, "rb") as f:
+            while remaining > 0:
+                chunk = f.read(min(_READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    # The file shrank while streaming, keep the archive valid
+                    logger.warning("{} shrank while bundling".format(file_path))
+                    chunk = bytes(min(_READ_CHUNK_SIZE, remaining))
+                remaining -= len(chunk)
+                yield chunk
+
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield bytes(padding)
+
+    yield bytes(tarfile.BLOCKSIZE * 2)
+
+
+def tar_size(files):
+    # The uncompressed length, for Content-Length
+    size = tarfile.BLOCKSIZE * 2
+    for name, file_path in files:
+        info, header = _tar_header(name, file_path)
+        size += len(header) + info.size + (-info.size % tarfile.BLOCKSIZE)
+    return size
+
+
+def bundle_stream(files, compression=None):
+    stream = _tar_stream(files)
+    if compression is None:
+        return stream
+
+    if compression == "gzip":
+        compressor = zlib.compressobj(wbits=31)
+    else:
+        compressor = zstandard.ZstdCompressor().compressobj()
+
+    def compressed():
+        for chunk in stream:
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+        yield compressor.flush()
+
+    return compressed()
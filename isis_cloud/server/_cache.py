@@ -0,0 +1,43 @@
+from contextlib import contextmanager
+from glob import glob, escape as glob_escape
+from os import getpid, remove, replace, stat as file_stat
+from threading import get_ident
+from os.path import basename, dirname, join as path_join
+
+
+def file_identity(file_path):
+    stats = file_stat(file_path)
+    return stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns
+
+
+def sidecar_path(file_path, suffix):
+    # Derived data lives next to the file it was computed from as a dotfile,
+    # so it is swept up by the same cleanup as its source
+    return path_join(
+        dirname(file_path),
+        ".{}.{}".format(basename(file_path), suffix)
+    )
+
+
+def remove_sidecars(file_path):
+    pattern = path_join(
+        dirname(file_path),
+        ".{}.*".format(glob_escape(basename(file_path)))
+    )
+    for sidecar in glob(pattern):
+        remove(sidecar)
+
+
+@contextmanager
+def atomic_writer(file_path, mode="wb"):
+    # Written under a temporary name first so concurrent readers in other
+    # workers never see a partial file. The name is unique per thread so
+    # threads in one worker don't write over each other.
+    tmp_file = "{}.{}.{}.tmp".format(file_path, getpid(), get_ident())
+    try:
+        with open(tmp_file, mode) as f:
+            yield f
+        replace(tmp_file, file_path)
+    except BaseException:
+        remove(tmp_file)
+        raise
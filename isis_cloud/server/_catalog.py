@@ -0,0 +1,179 @@
+import re
+import sqlite3
+from logging import getLogger
+from os import getpid, stat as file_stat, walk
+from os.path import join as path_join, relpath
+from threading import local
+from time import time
+
+from ..cube import Core, read_label
+from ._config import ISISServerConfig
+
+# Kept in each work dir, next to the files it indexes
+_CATALOG_FILE = ".catalog.sqlite"
+
+# ISIS cubes start with their label
+_CUBE_MAGIC = b"Object = IsisCube"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    samples INTEGER,
+    lines INTEGER,
+    bands INTEGER,
+    pixel_type TEXT
+);
+CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns);
+CREATE INDEX IF NOT EXISTS files_size ON files (size);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+_COLUMNS = ["name", "size", "mtime_ns", "samples", "lines", "bands", "pixel_type"]
+
+
+def _cube_summary(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            if f.read(len(_CUBE_MAGIC)) != _CUBE_MAGIC:
+                return None, None, None, None
+        core = Core(read_label(file_path))
+    except Exception:
+        return None, None, None, None
+
+    return core.samples, core.lines, core.bands, core.pixel_type
+
+
+def _entry(work_dir, name):
+    file_path = path_join(work_dir, name)
+    stats = file_stat(file_path)
+    return (name, stats.st_size, stats.st_mtime_ns, *_cube_summary(file_path))
+
+
+def _prefix_end(prefix):
+    # The first string after every string starting with prefix, so prefix
+    # queries are a range scan on the primary key
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class ISISCatalog:
+    """
+    An SQLite index of the files in each work dir, kept up to date as files
+    are uploaded, written by jobs and deleted, so listing and searching
+    never walk the directory.
+    """
+    _LOGGER = getLogger("ISISCatalog")
+
+    # One connection per thread, worker and catalog
+    _LOCAL = local()
+
+    @staticmethod
+    def _connect(work_dir=None):
+        work_dir = work_dir or ISISServerConfig.work_dir()
+        # Connections aren't shared with a forked worker
+        if getattr(ISISCatalog._LOCAL, "pid", None) != getpid():
+            ISISCatalog._LOCAL.connections = dict()
+            ISISCatalog._LOCAL.pid = getpid()
+        connections = ISISCatalog._LOCAL.connections
+
+        if work_dir not in connections:
+            db = sqlite3.connect(path_join(work_dir, _CATALOG_FILE), timeout=30)
+            # WAL lets readers in other workers carry on during writes
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            connections[work_dir] = db
+
+            if db.execute("SELECT value FROM meta WHERE key = 'built'").fetchone() is None:
+                ISISCatalog._build(db, work_dir)
+
+        return connections[work_dir]
+
+    @staticmethod
+    def _build(db, work_dir):
+        # Only done once per work dir, for files that predate the catalog
+        start_time = time()
+        entries = list()
+        for root, dirs, files in walk(work_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for file in files:
+                if file.startswith("."):
+                    continue
+                try:
+                    entries.append(_entry(work_dir, relpath(path_join(root, file), work_dir)))
+                except OSError:
+                    continue
+
+        with db:
+            db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", entries)
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('built', ?)", (str(time()),))
+
+        ISISCatalog._LOGGER.info("Cataloged {} files in {} ({:.1f}s)".format(
+            len(entries),
+            work_dir,
+            time() - start_time
+        ))
+
+    @staticmethod
+    def record(name, work_dir=None):
+        work_dir = work_dir or ISISServerConfig.work_dir()
+        try:
+            entry = _entry(work_dir, name)
+        except OSError:
+            return ISISCatalog.forget(name, work_dir)
+
+        db = ISISCatalog._connect(work_dir)
+        with db:
+            db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", entry)
+
+    @staticmethod
+    def forget(name, work_dir=None):
+        db = ISISCatalog._connect(work_dir)
+        with db:
+            db.execute("DELETE FROM files WHERE name = ?", (name,))
+
+    @staticmethod
+    def search(prefix=None, older_than=None, min_size=None, after=None, limit=100):
+        conditions = list()
+        params = list()
+        if prefix:
+            conditions.append("name >= ? AND name < ?")
+            params.extend([prefix, _prefix_end(prefix)])
+        if after is not None:
+            conditions.append("name > ?")
+            params.append(after)
+        if older_than is not None:
+            conditions.append("mtime_ns < ?")
+            params.append(int((time() - older_than) * 1e9))
+        if min_size is not None:
+            conditions.append("size >= ?")
+            params.append(min_size)
+
+        query = "SELECT * FROM files {} ORDER BY name LIMIT ?".format(
+            "WHERE " + " AND ".join(conditions) if conditions else ""
+        )
+        rows = ISISCatalog._connect().execute(query, [*params, limit]).fetchall()
+
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+    @staticmethod
+    def names(prefix=None, pattern=None):
+        # Every name with the prefix and matching the glob pattern, for list
+        # args given as a query rather than spelled out
+        conditions = list()
+        params = list()
+
+        # The pattern's literal start narrows the scan like a prefix does
+        literal = re.match(r"[^*?\[]*", pattern or "").group(0)
+        for start in [prefix, literal]:
+            if start:
+                conditions.append("name >= ? AND name < ?")
+                params.extend([start, _prefix_end(start)])
+        if pattern:
+            conditions.append("name GLOB ?")
+            params.append(pattern)
+
+        query = "SELECT name FROM files {} ORDER BY name".format(
+            "WHERE " + " AND ".join(conditions) if conditions else ""
+        )
+        return [row[0] for row in ISISCatalog._connect().execute(query, params)]
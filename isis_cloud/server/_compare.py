@@ -0,0 +1,178 @@
+import json
+from hashlib import blake2b
+from logging import getLogger
+
+import numpy as np
+
+from ..cube import Cube
+from ._cache import atomic_writer, file_identity, sidecar_path
+
+logger = getLogger("Compare")
+
+# Lines and samples per digested tile. Fixed rather than following each
+# cube's own tiling, so cubes with different layouts can still be compared.
+TILE_SIZE = 128
+
+
+def _digest(*parts):
+    h = blake2b(digest_size=16)
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+
+def _scaled(cube, raw):
+    # Scaled values with specials zeroed, and their special pixel codes, so
+    # equal pixels hash the same whatever their raw type or scaling
+    codes = cube.special_codes(raw)
+    values = raw.astype(np.float64) * cube.core.multiplier + cube.core.base
+    values[codes != Cube.VALID] = 0.0
+    # Adding zero turns -0.0 into 0.0
+    values += 0.0
+    return values, codes
+
+
+def _tiles(cube, band):
+    # Each tile's position and raw DNs, a row of tiles at a time
+    for line in range(0, cube.core.lines, TILE_SIZE):
+        raw = cube.raw[band, line:line + TILE_SIZE]
+        for sample in range(0, cube.core.samples, TILE_SIZE):
+            yield line, sample, raw[:, sample:sample + TILE_SIZE]
+
+
+def _compute_digests(cube):
+    bands = list()
+    for band in range(cube.core.bands):
+        tiles = list()
+        valid = list()
+        for _, _, raw in _tiles(cube, band):
+            values, codes = _scaled(cube, raw)
+            tiles.append(_digest(values.tobytes(), codes.tobytes()))
+            valid.append(int(np.count_nonzero(codes == Cube.VALID)))
+
+        bands.append({
+            "digest": _digest(*tiles).hex(),
+            "tiles": [t.hex() for t in tiles],
+            "valid": valid,
+        })
+
+    return {
+        "shape": list(cube.shape),
+        "tile_size": TILE_SIZE,
+        # Tiles hash into their band's digest, and bands into the cube's
+        "digest": _digest(*[bytes.fromhex(b["digest"]) for b in bands]).hex(),
+        "bands": bands,
+    }
+
+
+def cube_digests(file_path, label):
+    digests_file = sidecar_path(file_path, "digests.json")
+    identity = list(file_identity(file_path))
+
+    try:
+        with open(digests_file) as f:
+            cached = json.load(f)
+        if cached["identity"] == identity and cached["digests"]["tile_size"] == TILE_SIZE:
+            return cached["digests"]
+    except (OSError, KeyError, ValueError):
+        pass
+
+    logger.info("Computing tile digests for {}".format(file_path))
+    with Cube(file_path, label) as cube:
+        digests = _compute_digests(cube)
+
+    with atomic_writer(digests_file, mode="w") as f:
+        json.dump({"identity": identity, "digests": digests}, f)
+
+    return digests
+
+
+def _compare_tile(cube_a, cube_b, band, line, sample, tolerance):
+    window = (band, slice(line, line + TILE_SIZE), slice(sample, sample + TILE_SIZE))
+    values_a, codes_a = _scaled(cube_a, cube_a.raw[window])
+    values_b, codes_b = _scaled(cube_b, cube_b.raw[window])
+
+    mismatched = codes_a != codes_b
+    both_valid = (codes_a == Cube.VALID) & (codes_b == Cube.VALID)
+    diff = np.abs(values_a - values_b)[both_valid]
+
+    return {
+        "lines": values_a.shape[0],
+        "samples": values_a.shape[1],
+        "valid_pairs": diff.size,
+        "sum_squares": float(np.square(diff).sum()),
+        "max_abs_diff": float(diff.max()) if diff.size else 0.0,
+        "differing_pixels": int(np.count_nonzero(diff > tolerance) + np.count_nonzero(mismatched)),
+        "special_mismatches": int(np.count_nonzero(mismatched)),
+    }
+
+
+def compare_cubes(file_a, label_a, file_b, label_b, tolerance=0.0, max_tiles=100):
+    """
+    Compares two cubes pixel by pixel. Only tiles whose digests differ are
+    read, so comparing against an unchanged baseline reads no pixels at all
+    once both cubes' digests are cached. RMS and the maximum difference are
+    over pixels valid in both cubes.
+    """
+    digests_a = cube_digests(file_a, label_a)
+    digests_b = cube_digests(file_b, label_b)
+    if digests_a["shape"] != digests_b["shape"]:
+        raise ValueError("Cubes differ in shape, {} and {}".format(
+            digests_a["shape"],
+            digests_b["shape"]
+        ))
+
+    bands, lines, samples = digests_a["shape"]
+    tile_cols = -(-samples // TILE_SIZE)
+
+    result = {
+        "identical": digests_a["digest"] == digests_b["digest"],
+        "digests": {"a": digests_a["digest"], "b": digests_b["digest"]},
+        "tile_size": TILE_SIZE,
+        "total_pixels": bands * lines * samples,
+        "differing_pixels": 0,
+        "special_mismatches": 0,
+        "max_abs_diff": 0.0,
+        "rms": 0.0,
+        "differing_tiles": 0,
+        "tiles": list(),
+    }
+    if result["identical"]:
+        return result
+
+    valid_pairs = 0
+    sum_squares = 0.0
+    with Cube(file_a, label_a) as cube_a, Cube(file_b, label_b) as cube_b:
+        for band, (band_a, band_b) in enumerate(zip(digests_a["bands"], digests_b["bands"])):
+            if band_a["digest"] == band_b["digest"]:
+                valid_pairs += sum(band_a["valid"])
+                continue
+
+            for i, (tile_a, tile_b) in enumerate(zip(band_a["tiles"], band_b["tiles"])):
+                if tile_a == tile_b:
+                    valid_pairs += band_a["valid"][i]
+                    continue
+
+                line = i // tile_cols * TILE_SIZE
+                sample = i % tile_cols * TILE_SIZE
+                tile = _compare_tile(cube_a, cube_b, band, line, sample, tolerance)
+
+                valid_pairs += tile.pop("valid_pairs")
+                sum_squares += tile.pop("sum_squares")
+                result["differing_pixels"] += tile["differing_pixels"]
+                result["special_mismatches"] += tile["special_mismatches"]
+                result["max_abs_diff"] = max(result["max_abs_diff"], tile["max_abs_diff"])
+                result["differing_tiles"] += 1
+
+                if len(result["tiles"]) < max_tiles:
+                    tile.update({
+                        "band": band + 1,
+                        "line": line + 1,
+                        "sample": sample + 1,
+                        "digests": {"a": tile_a, "b": tile_b},
+                    })
+                    result["tiles"].append(tile)
+
+    if valid_pairs:
+        result["rms"] = float(np.sqrt(sum_squares / valid_pairs))
+    return result
@@ -1,10 +1,216 @@
-from os import getenv, getcwd
+import json
+from glob import glob
+from os import cpu_count, getenv, getcwd
 from os.path import join as path_join
 
+from flask import g, has_request_context
+
 
 class ISISServerConfig:
     _WORK_DIR = getenv("DATA_DIR", path_join(getcwd(), ".work"))
 
+    # Defaults to one per CPU
+    _PIXELMATH_WORKERS = getenv("PIXELMATH_WORKERS")
+
+    # Comma-separated globs under ISISDATA to pull into the page cache at
+    # startup
+    _ISIS_DATA_PRELOAD = getenv(
+        "ISISDATA_PRELOAD",
+        "base/kernels/lsk/*.tls,base/kernels/pck/*.tpc"
+    )
+
+    # A JSON file mapping API tokens to namespaces. When set, every request
+    # must carry a token and the namespace header is ignored.
+    _NAMESPACE_TOKENS = getenv("NAMESPACE_TOKENS")
+    _NAMESPACE_TOKENS_CACHE = None
+
+    # Per-namespace quotas, unlimited if unset
+    _NAMESPACE_MAX_BYTES = getenv("NAMESPACE_MAX_BYTES")
+    _NAMESPACE_MAX_FILES = getenv("NAMESPACE_MAX_FILES")
+
+    # Signs job completion callbacks that don't bring their own secret
+    _WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+
+    # Job completion callbacks only go to these comma-separated hosts over
+    # http(s), and to unix sockets in WEBHOOK_SOCKET_DIR. Neither is allowed
+    # unless set.
+    _WEBHOOK_HOSTS = getenv("WEBHOOK_HOSTS", "")
+    _WEBHOOK_SOCKET_DIR = getenv("WEBHOOK_SOCKET_DIR")
+
+    # Where the HiRISE workflow finds EDRs, laid out like the PDS archive.
+    # Any remote scheme works, e.g. mirror:// for a local copy of it.
+    _HIRISE_EDR_URL = getenv(
+        "HIRISE_EDR_URL",
+        "https://pdsimage2.wr.usgs.gov/Missions/Mars_Reconnaissance_Orbiter/HiRISE/EDR"
+    )
+
+    # Local mirrors that file:// and mirror://<name>/ remotes are linked in
+    # from rather than copied, unless the program writes to them, as
+    # comma-separated name=path pairs. Remotes outside them are refused.
+    _REMOTE_MIRRORS = getenv("REMOTE_MIRRORS", "")
+
+    # An S3 compatible store for s3://<bucket>/<key> remotes, fetched as
+    # parallel range requests. Credentials are optional for public buckets.
+    _S3_ENDPOINT_URL = getenv("S3_ENDPOINT_URL", "https://s3.amazonaws.com")
+    _S3_REGION = getenv("S3_REGION", "us-east-1")
+    _S3_ACCESS_KEY_ID = getenv("AWS_ACCESS_KEY_ID")
+    _S3_SECRET_ACCESS_KEY = getenv("AWS_SECRET_ACCESS_KEY")
+    _S3_SESSION_TOKEN = getenv("AWS_SESSION_TOKEN")
+    _S3_PART_SIZE = getenv("S3_PART_SIZE", str(8 * 1024 * 1024))
+    _S3_CONCURRENCY = getenv("S3_CONCURRENCY", "8")
+
+    # A fast local tier (tmpfs or SSD) for workflow intermediates and the
+    # outputs of jobs whose TTL is at most SCRATCH_MAX_TTL, e.g. /dev/shm.
+    # Off unless set. It's only used while more than SCRATCH_MIN_FREE of it
+    # would stay free.
+    _SCRATCH_DIR = getenv("SCRATCH_DIR")
+    _SCRATCH_MAX_TTL = getenv("SCRATCH_MAX_TTL", "3600")
+    _SCRATCH_MIN_FREE = getenv("SCRATCH_MIN_FREE", "0.2")
+
+    # How many ISIS programs run at once across every worker, one per CPU
+    # by default. Jobs beyond that are queued by lane and fair share.
+    _JOB_SLOTS = getenv("JOB_SLOTS")
+
+    # Further interactive jobs from a client that already has this many
+    # queued or running go to the batch lane. Unlimited if unset.
+    _INTERACTIVE_LIMIT = getenv("INTERACTIVE_LIMIT")
+
+    # Each client's share of the slots relative to the others, as
+    # comma-separated client=weight pairs. Clients not listed weigh 1.
+    _CLIENT_WEIGHTS = getenv("CLIENT_WEIGHTS", "")
+
     @staticmethod
     def work_dir():
+        # Requests that selected a namespace work in its own sub-store
+        if has_request_context() and g.get("namespace") is not None:
+            return ISISServerConfig.namespace_dir(g.namespace)
+        return ISISServerConfig._WORK_DIR
+
+    @staticmethod
+    def namespace_dir(namespace):
+        return path_join(ISISServerConfig._WORK_DIR, ".namespaces", namespace)
+
+    @staticmethod
+    def work_dirs():
+        # The default work dir and every namespace's, for background sweeps
+        return [
+            ISISServerConfig._WORK_DIR,
+            *sorted(glob(ISISServerConfig.namespace_dir("*")))
+        ]
+
+    @staticmethod
+    def pixelmath_workers():
+        workers = ISISServerConfig._PIXELMATH_WORKERS
+        return int(workers) if workers else None
+
+    @staticmethod
+    def isis_data_preload():
+        return [p for p in ISISServerConfig._ISIS_DATA_PRELOAD.split(",") if p]
+
+    @staticmethod
+    def namespace_tokens():
+        if ISISServerConfig._NAMESPACE_TOKENS is None:
+            return None
+
+        if ISISServerConfig._NAMESPACE_TOKENS_CACHE is None:
+            with open(ISISServerConfig._NAMESPACE_TOKENS) as f:
+                ISISServerConfig._NAMESPACE_TOKENS_CACHE = json.load(f)
+        return ISISServerConfig._NAMESPACE_TOKENS_CACHE
+
+    @staticmethod
+    def namespace_max_bytes():
+        max_bytes = ISISServerConfig._NAMESPACE_MAX_BYTES
+        return int(max_bytes) if max_bytes else None
+
+    @staticmethod
+    def namespace_max_files():
+        max_files = ISISServerConfig._NAMESPACE_MAX_FILES
+        return int(max_files) if max_files else None
+
+    @staticmethod
+    def webhook_secret():
+        return ISISServerConfig._WEBHOOK_SECRET or None
+
+    @staticmethod
+    def webhook_hosts():
+        return {h.strip().lower() for h in ISISServerConfig._WEBHOOK_HOSTS.split(",") if h.strip()}
+
+    @staticmethod
+    def webhook_socket_dir():
+        return ISISServerConfig._WEBHOOK_SOCKET_DIR or None
+
+    @staticmethod
+    def hirise_edr_url():
+        return ISISServerConfig._HIRISE_EDR_URL.rstrip("/")
+
+    @staticmethod
+    def data_dir():
+        # The durable tier, which every work dir lives in
         return ISISServerConfig._WORK_DIR
+
+    @staticmethod
+    def scratch_dir():
+        return ISISServerConfig._SCRATCH_DIR or None
+
+    @staticmethod
+    def scratch_max_ttl():
+        return int(ISISServerConfig._SCRATCH_MAX_TTL)
+
+    @staticmethod
+    def scratch_min_free():
+        return float(ISISServerConfig._SCRATCH_MIN_FREE)
+
+    @staticmethod
+    def remote_mirrors():
+        mirrors = dict()
+        for mirror in ISISServerConfig._REMOTE_MIRRORS.split(","):
+            name, _, path = mirror.partition("=")
+            if name and path:
+                mirrors[name.strip()] = path.strip()
+        return mirrors
+
+    @staticmethod
+    def s3_endpoint_url():
+        return ISISServerConfig._S3_ENDPOINT_URL.rstrip("/")
+
+    @staticmethod
+    def s3_region():
+        return ISISServerConfig._S3_REGION
+
+    @staticmethod
+    def s3_credentials():
+        # None for anonymous requests
+        if not (ISISServerConfig._S3_ACCESS_KEY_ID and ISISServerConfig._S3_SECRET_ACCESS_KEY):
+            return None
+        return (
+            ISISServerConfig._S3_ACCESS_KEY_ID,
+            ISISServerConfig._S3_SECRET_ACCESS_KEY,
+            ISISServerConfig._S3_SESSION_TOKEN or None
+        )
+
+    @staticmethod
+    def s3_part_size():
+        return int(ISISServerConfig._S3_PART_SIZE)
+
+    @staticmethod
+    def s3_concurrency():
+        return int(ISISServerConfig._S3_CONCURRENCY)
+
+    @staticmethod
+    def job_slots():
+        slots = ISISServerConfig._JOB_SLOTS
+        return int(slots) if slots else cpu_count() or 1
+
+    @staticmethod
+    def interactive_limit():
+        limit = ISISServerConfig._INTERACTIVE_LIMIT
+        return int(limit) if limit else None
+
+    @staticmethod
+    def client_weights():
+        weights = dict()
+        for pair in ISISServerConfig._CLIENT_WEIGHTS.split(","):
+            client, _, weight = pair.partition("=")
+            if client and weight and float(weight) > 0:
+                weights[client.strip()] = float(weight)
+        return weights
@@ -0,0 +1,374 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from os import makedirs
+from os.path import join as path_join
+from shutil import move, rmtree
+from time import time
+from uuid import uuid4
+
+from .. import tracing
+from ..cube import Core, read_label
+from ._config import ISISServerConfig
+from ._pixelmath import evaluate_pixelmath
+from ._programs import ISISPrograms
+from ._remotes import ISISRemotes
+from ._scheduler import ISISScheduler
+from ._spice import ISISSpiceCache
+from ._storage import ISISStorage
+
+_OBSERVATION_ID = re.compile(r"^([A-Z]{3})_(\d{6})_(\d{4})$")
+
+_REDS = ["RED4", "RED5"]
+_BGS = ["BG12", "BG13"]
+_DETECTORS = _REDS + _BGS
+_CHANNELS = [0, 1]
+
+# Each BG is aligned with and combined into the red it overlaps
+_PAIRS = list(zip(_REDS, _BGS))
+
+_OPTICAL_DISTORTION_CORRECT = 1.0006
+_PROJECTION_TYPE = "EQUIRECTANGULAR"
+
+# Match the first 1/64 x 1/128 of the bg image to some area within the
+# first 1/32 x 1/64 of the red image with at least 90% correlation
+_PATTERN_CHIP_DENOM = (64, 128)
+_SEARCH_CHIP_DENOM = (32, 64)
+
+# Peak scratch space as a multiple of the EDRs' size. Calibrated cubes are
+# 32 bit floats, and a channel's input and output exist at the same time.
+_SCRATCH_FACTOR = 6
+
+
+class WorkflowError(Exception):
+    pass
+
+
+def _dimensions(cube):
+    core = Core(read_label(cube))
+    return core.samples, core.lines
+
+
+def _binning(cube):
+    return int(read_label(cube)["IsisCube"]["Instrument"]["Summing"])
+
+
+class ISISHiRISEColor:
+    """
+    Builds an equalized RED/BG color mosaic with a synthetic blue band for
+    a HiRISE observation, the server side equivalent of the multi detector
+    client example. Every stage runs across detectors in parallel, and
+    intermediates stay in a scratch dir that's removed when the job ends.
+    """
+    _LOGGER = getLogger("ISISHiRISEColor")
+
+    def __init__(self, observation_id, to, lane="interactive", client=("server", "")):
+        match = _OBSERVATION_ID.match(observation_id)
+        if match is None:
+            raise ValueError("Invalid HiRISE observation ID '{}'".format(observation_id))
+
+        phase, orbit, _ = match.groups()
+        orbit_range = int(orbit) // 100 * 100
+        self._edr_dir = "/".join([
+            ISISServerConfig.hirise_edr_url(),
+            phase,
+            "ORB_{:06d}_{:06d}".format(orbit_range, orbit_range + 99),
+            observation_id
+        ])
+
+        self.observation_id = observation_id
+        self.to = to
+
+        # Each of the workflow's programs is queued like a job of its own
+        self._queue = (lane, client)
+
+        # Stage names and durations, in the order they ran
+        self.stages = list()
+
+        self._scratch = None
+
+    def _edr_url(self, detector, channel):
+        return "{}/{}_{}_{}.IMG".format(self._edr_dir, self.observation_id, detector, channel)
+
+    def _file(self, name):
+        return path_join(self._scratch, name)
+
+    def _stage(self, name, func, items):
+        # Runs func over items in parallel and records how long it took
+        start_time = time()
+        with tracing.span("workflow.stage", **{"workflow.stage": name, "workflow.items": len(items)}), \
+                ThreadPoolExecutor(max_workers=len(items)) as pool:
+            results = list(pool.map(tracing.wrap(lambda item: func(*item)), items))
+
+        self.stages.append({"name": name, "seconds": time() - start_time})
+        ISISHiRISEColor._LOGGER.info("{} {} took {:.1f}s".format(
+            self.observation_id,
+            name,
+            self.stages[-1]["seconds"]
+        ))
+        return results
+
+    def _run(self, program_name, **args):
+        program = ISISPrograms.get(program_name)
+        if program is None:
+            raise WorkflowError("{} is not installed".format(program_name))
+
+        command_args = list()
+        for k, v in args.items():
+            if isinstance(v, list):
+                list_file = self._file("{}.lis".format(uuid4()))
+                with open(list_file, "w") as f:
+                    for item in v:
+                        print(item, file=f)
+                v = list_file
+            command_args.append("{}={}".format(k, v))
+
+        with ISISScheduler.slot(*self._queue):
+            proc = ISISPrograms.run(program, command_args)
+        if proc.returncode != 0:
+            raise WorkflowError("{} failed: {}".format(
+                program_name,
+                proc.stderr.decode("utf-8")
+            ))
+
+    def _scratch_needed(self):
+        # What the observation's intermediates take, None if unknown
+        needed = 0
+        try:
+            for detector in _DETECTORS:
+                for channel in _CHANNELS:
+                    needed += ISISRemotes.size(self._edr_url(detector, channel))
+        except (OSError, TypeError, ValueError):
+            return None
+        return needed * _SCRATCH_FACTOR
+
+    def run(self):
+        # Intermediates go to the scratch tier when they fit, with the space
+        # held until they're removed so concurrent workflows can't overfill
+        # it, and to the work dir's disk otherwise
+        with ISISStorage.reserve(self._scratch_needed()) as reserved:
+            if reserved:
+                scratch = path_join(ISISStorage.scratch_dir(), ".workflows")
+            else:
+                scratch = path_join(ISISServerConfig.work_dir(), ".scratch")
+
+            self._scratch = path_join(scratch, "hirise-{}".format(uuid4().hex))
+            makedirs(self._scratch, exist_ok=True)
+            try:
+                self._process()
+            finally:
+                rmtree(self._scratch, ignore_errors=True)
+
+        return self.stages
+
+    def _process(self):
+        channels = [(d, c) for d in _DETECTORS for c in _CHANNELS]
+
+        def fetch(detector, channel):
+            edr = self._file("{}_{}.IMG".format(detector, channel))
+            ISISRemotes.fetch(self._edr_url(detector, channel), edr)
+        self._stage("fetch", fetch, channels)
+
+        def hi2isis(detector, channel):
+            self._run(
+                "hi2isis",
+                **{"from": self._file("{}_{}.IMG".format(detector, channel))},
+                to=self._file("{}_{}.cub".format(detector, channel))
+            )
+        self._stage("hi2isis", hi2isis, channels)
+
+        def spiceinit(detector, channel):
+            args = {"from": self._file("{}_{}.cub".format(detector, channel))}
+            spice_cache = ISISSpiceCache(args)
+            if not spice_cache.attach():
+                self._run("spiceinit", **args)
+                spice_cache.store()
+        self._stage("spiceinit", spiceinit, channels)
+
+        def hical(detector, channel):
+            self._run(
+                "hical",
+                **{"from": self._file("{}_{}.cub".format(detector, channel))},
+                to=self._file("{}_{}.cal.cub".format(detector, channel))
+            )
+        self._stage("hical", hical, channels)
+
+        def cubenorm(detector, channel):
+            self._run(
+                "cubenorm",
+                **{"from": self._file("{}_{}.cal.cub".format(detector, channel))},
+                to=self._file("{}_{}.norm.cub".format(detector, channel))
+            )
+        self._stage("cubenorm", cubenorm, channels)
+
+        def histitch(detector):
+            self._run(
+                "histitch",
+                from1=self._file("{}_0.norm.cub".format(detector)),
+                from2=self._file("{}_1.norm.cub".format(detector)),
+                to=self._file("{}.cub".format(detector))
+            )
+        self._stage("histitch", histitch, [(d,) for d in _DETECTORS])
+
+        sizes = {d: _dimensions(self._file("{}.cub".format(d))) for d in _DETECTORS}
+        binnings = {d: _binning(self._file("{}.cub".format(d))) for d in _DETECTORS}
+
+        def scale(red, bg):
+            scale_factor = binnings[bg] / binnings[red] * _OPTICAL_DISTORTION_CORRECT
+            scaled = self._file("{}.scaled.cub".format(bg))
+            self._run(
+                "enlarge" if scale_factor > 1 else "reduce",
+                **{"from": self._file("{}.cub".format(bg))},
+                interp="bilinear",
+                sscale=scale_factor,
+                lscale=scale_factor,
+                to=scaled
+            )
+
+            if scale_factor > 1:
+                cropped = self._file("{}.cropped.cub".format(bg))
+                self._run(
+                    "crop",
+                    **{"from": scaled},
+                    nsamples=sizes[red][0],
+                    nlines=sizes[red][1],
+                    to=cropped
+                )
+                scaled = cropped
+
+            self._run(
+                "editlab",
+                **{"from": scaled},
+                grpname="Instrument",
+                keyword="Summing",
+                value=binnings[red]
+            )
+            move(scaled, self._file("{}.cub".format(bg)))
+        self._stage("scale", scale, _PAIRS)
+
+        def autoregtemplate(red):
+            self._run(
+                "autoregtemplate",
+                algorithm="MaximumCorrelation",
+                tolerance=0.9,
+                psamp=sizes[red][0] // _PATTERN_CHIP_DENOM[0],
+                pline=sizes[red][1] // _PATTERN_CHIP_DENOM[1],
+                ssamp=sizes[red][0] // _SEARCH_CHIP_DENOM[0],
+                sline=sizes[red][1] // _SEARCH_CHIP_DENOM[1],
+                topvl=self._file("{}.autoreg".format(red))
+            )
+        self._stage("autoregtemplate", autoregtemplate, [(r,) for r in _REDS])
+
+        def fix_jitter(red, image):
+            # Replaces image with a copy aligned to red
+            cnet = self._file("{}.cnet".format(image))
+            slithered = self._file("{}.slithered.cub".format(image))
+            self._run(
+                "hijitreg",
+                **{"from": self._file("{}.cub".format(image))},
+                match=self._file("{}.cub".format(red)),
+                regdef=self._file("{}.autoreg".format(red)),
+                cnetfile=cnet
+            )
+            self._run(
+                "slither",
+                **{"from": self._file("{}.cub".format(image))},
+                control=cnet,
+                to=slithered
+            )
+            move(slithered, self._file("{}.cub".format(image)))
+
+        # The BGs are aligned with the reds after the reds with each other
+        self._stage("align_reds", fix_jitter, [tuple(_REDS)])
+        self._stage("align_bgs", fix_jitter, _PAIRS)
+
+        def propagate_highfreq(red, bg):
+            # Smoothed color ratio times the full resolution red, in one pass
+            boxcar_size = {2: 3, 4: 5}.get(binnings[bg])
+            if boxcar_size is None:
+                raise WorkflowError("Invalid binning for {} (got {}, expected 2 or 4)".format(
+                    bg,
+                    binnings[bg]
+                ))
+
+            with ISISScheduler.slot(*self._queue):
+                evaluate_pixelmath(
+                    "smoothed_ratio * red",
+                    {"bg": self._file("{}.cub".format(bg)), "red": self._file("{}.cub".format(red))},
+                    self._file("{}.color.cub".format(bg)),
+                    define={"smoothed_ratio": "lowpass(bg / red, {0}, {0})".format(boxcar_size)},
+                    workers=ISISServerConfig.pixelmath_workers()
+                )
+        self._stage("highfreq", propagate_highfreq, _PAIRS)
+
+        def combine(red, bg):
+            self._run(
+                "cubeit",
+                fromlist=[self._file("{}.cub".format(red)), self._file("{}.color.cub".format(bg))],
+                to=self._file("{}_{}.cub".format(red, bg))
+            )
+        self._stage("cubeit", combine, _PAIRS)
+
+        map_file = self._file("color.map")
+        self._stage("maptemplate", lambda: self._run(
+            "maptemplate",
+            projection=_PROJECTION_TYPE,
+            clat=0.0,
+            clon=0.0,
+            map=map_file
+        ), [()])
+
+        def cam2map(red, bg):
+            resolution = {1: 0.25, 2: 0.5, 4: 1.0}.get(binnings[red])
+            if resolution is None:
+                raise WorkflowError("Invalid binning for {} (got {}, expected 1, 2 or 4)".format(
+                    red,
+                    binnings[red]
+                ))
+
+            self._run(
+                "cam2map",
+                **{"from": self._file("{}_{}.cub".format(red, bg))},
+                map=map_file,
+                pixres="mpp",
+                resolution=resolution,
+                to=self._file("{}_{}.map.cub".format(red, bg))
+            )
+        self._stage("cam2map", cam2map, _PAIRS)
+
+        mapped = [self._file("{}_{}.map.cub".format(r, b)) for r, b in _PAIRS]
+        equalized = [self._file("{}_{}.eq.cub".format(r, b)) for r, b in _PAIRS]
+        mosaic = self._file("mosaic.cub")
+
+        def equalize():
+            self._run("equalizer", fromlist=mapped, holdlist=mapped[:1], tolist=equalized)
+        self._stage("equalizer", equalize, [()])
+
+        def noseam():
+            # Odd filter sizes, a fraction of the first cube's
+            samples, lines = _dimensions(mapped[0])
+            self._run(
+                "noseam",
+                fromlist=equalized,
+                samples=samples // 16 | 1,
+                lines=lines // 32 | 1,
+                to=mosaic
+            )
+        self._stage("noseam", noseam, [()])
+
+        def synth_blue():
+            blue = self._file("blue.cub")
+            with ISISScheduler.slot(*self._queue):
+                evaluate_pixelmath(
+                    "2 * green - 0.3 * red",
+                    {"red": "{}+1".format(mosaic), "green": "{}+2".format(mosaic)},
+                    blue,
+                    workers=ISISServerConfig.pixelmath_workers()
+                )
+            self._run("cubenorm", **{"from": blue}, to=self._file("blue.norm.cub"))
+            self._run(
+                "cubeit",
+                fromlist=["{}+1".format(mosaic), "{}+2".format(mosaic), self._file("blue.norm.cub")],
+                to=path_join(ISISServerConfig.work_dir(), self.to)
+            )
+        self._stage("synth_blue", synth_blue, [()])
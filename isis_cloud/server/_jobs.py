@@ -0,0 +1,231 @@
+import json
+from glob import glob
+from hashlib import sha256
+from logging import getLogger
+from os import makedirs, remove, stat as file_stat
+from os.path import join as path_join, normpath, splitext
+from time import time
+
+from .. import tracing
+from ._cache import atomic_writer, remove_sidecars
+from ._catalog import ISISCatalog
+from ._config import ISISServerConfig
+from ._namespaces import ISISNamespaces
+from ._storage import ISISStorage
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_file(file_path):
+    digest = sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _candidate_files(args):
+    # Jobs share the work dir, so only files named by a job's own args can
+    # be attributed to it
+    values = list()
+    for value in args.values():
+        values.extend(value if isinstance(value, list) else [value])
+
+    candidates = set()
+    for value in values:
+        # Drop ISIS cube attributes, e.g. out.cub+8bit
+        name = normpath(str(value).split("+")[0])
+        if name.startswith(("/", "..")) or name in (".", ""):
+            continue
+
+        candidates.add(name)
+        # ISIS adds .cub to cube names given without an extension
+        if splitext(name)[1] == "":
+            candidates.add("{}.cub".format(name))
+
+    return candidates
+
+
+def _snapshot(names):
+    snapshot = dict()
+    for name in names:
+        try:
+            stats = file_stat(path_join(ISISServerConfig.work_dir(), name))
+        except OSError:
+            continue
+        snapshot[name] = (stats.st_size, stats.st_mtime_ns)
+    return snapshot
+
+
+class ISISJob:
+    def __init__(self, job_id, program, args):
+        self.job_id = job_id
+        self.program = program
+        self._candidates = _candidate_files(args)
+        self._before = None
+        self.started = None
+
+    def start(self):
+        self.started = time()
+        self._before = _snapshot(self._candidates)
+
+    def finish(self, ttl=None):
+        with tracing.span("isis.job.finish", **{"isis.job_id": self.job_id}):
+            return self._finish(ttl)
+
+    def _finish(self, ttl):
+        # Hashes the job's outputs and registers its manifest
+        finished = time()
+        after = _snapshot(self._candidates)
+
+        outputs = list()
+        bytes_delta = 0
+        for name in sorted(after):
+            if name not in self._before:
+                status = "created"
+                bytes_delta += after[name][0]
+            elif after[name] != self._before[name]:
+                status = "modified"
+                bytes_delta += after[name][0] - self._before[name][0]
+            else:
+                continue
+
+            outputs.append({
+                "name": name,
+                "status": status,
+                "size": after[name][0],
+                "mtime_ns": after[name][1],
+                "sha256": _hash_file(path_join(ISISServerConfig.work_dir(), name)),
+            })
+
+        manifest = {
+            "job_id": self.job_id,
+            "program": self.program,
+            "started": self.started,
+            "finished": finished,
+            "expires": finished + ttl if ttl is not None else None,
+            "outputs": outputs,
+        }
+        ISISJobs.register(manifest)
+        for output in outputs:
+            ISISCatalog.record(output["name"])
+        ISISNamespaces.charge(
+            bytes_delta,
+            len([o for o in outputs if o["status"] == "created"])
+        )
+        return manifest
+
+
+class ISISJobs:
+    _LOGGER = getLogger("ISISJobs")
+
+    # How often registered outputs are checked for expiry
+    EXPIRE_INTERVAL = 600
+
+    # Manifests of jobs without a TTL are dropped after this long, but their
+    # outputs are left alone
+    _MANIFEST_MAX_AGE = 7 * 24 * 3600
+
+    @staticmethod
+    def _jobs_dir(work_dir=None):
+        return path_join(work_dir or ISISServerConfig.work_dir(), ".jobs")
+
+    @staticmethod
+    def _manifest_path(job_id):
+        return path_join(ISISJobs._jobs_dir(), "{}.json".format(job_id))
+
+    @staticmethod
+    def register(manifest):
+        makedirs(ISISJobs._jobs_dir(), mode=0o700, exist_ok=True)
+        with atomic_writer(ISISJobs._manifest_path(manifest["job_id"]), "w") as f:
+            json.dump(manifest, f)
+
+    @staticmethod
+    def get(job_id):
+        try:
+            with open(ISISJobs._manifest_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _remove_outputs(work_dir, manifest):
+        bytes_removed = 0
+        files_removed = 0
+        for output in manifest["outputs"]:
+            # Files modified in place belong to whichever job created them
+            if output["status"] != "created":
+                continue
+
+            file_path = path_join(work_dir, output["name"])
+
+            # Leave files that were rewritten since the job finished
+            try:
+                stats = file_stat(file_path)
+                if (stats.st_size, stats.st_mtime_ns) != (output["size"], output["mtime_ns"]):
+                    continue
+                ISISStorage.remove(file_path)
+                remove_sidecars(file_path)
+            except OSError:
+                continue
+
+            ISISCatalog.forget(output["name"], work_dir)
+            bytes_removed += output["size"]
+            files_removed += 1
+            ISISJobs._LOGGER.info("Removed {} from job {}".format(
+                output["name"],
+                manifest["job_id"]
+            ))
+
+        ISISNamespaces.charge(-bytes_removed, -files_removed, work_dir)
+
+    @staticmethod
+    def retain(name):
+        # Drops a file from the outputs of any job that would expire it
+        for manifest_file in glob(path_join(ISISJobs._jobs_dir(), "*.json")):
+            try:
+                with open(manifest_file) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            outputs = [o for o in manifest["outputs"] if o["name"] != name]
+            if len(outputs) != len(manifest["outputs"]):
+                manifest["outputs"] = outputs
+                ISISJobs.register(manifest)
+
+    @staticmethod
+    def discard(manifest):
+        # Undoes a job whose outputs can't be kept
+        ISISJobs._remove_outputs(ISISServerConfig.work_dir(), manifest)
+        try:
+            remove(ISISJobs._manifest_path(manifest["job_id"]))
+        except OSError:
+            pass
+
+    @staticmethod
+    def expire():
+        now = time()
+        for work_dir in ISISServerConfig.work_dirs():
+            for manifest_file in glob(path_join(ISISJobs._jobs_dir(work_dir), "*.json")):
+                try:
+                    with open(manifest_file) as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    continue
+
+                if manifest["expires"] is None:
+                    if now - manifest["finished"] > ISISJobs._MANIFEST_MAX_AGE:
+                        manifest["outputs"] = list()
+                    else:
+                        continue
+                elif manifest["expires"] > now:
+                    continue
+
+                ISISJobs._remove_outputs(work_dir, manifest)
+
+                # Another worker may have expired it first
+                try:
+                    remove(manifest_file)
+                except OSError:
+                    pass
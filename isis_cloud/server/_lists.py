@@ -0,0 +1,134 @@
+import re
+from glob import glob
+from hashlib import sha256
+from logging import getLogger
+from os import makedirs, remove, stat as file_stat, utime
+from os.path import join as path_join
+from time import time
+
+from ._cache import atomic_writer
+from ._catalog import ISISCatalog
+from ._config import ISISServerConfig
+
+_LIST_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _list_id(items):
+    return sha256("".join("{}\n".format(item) for item in items).encode("utf-8")).hexdigest()
+
+
+class ISISLists:
+    """
+    Lists of file names kept on the server, so list args with thousands of
+    entries are sent once and used by any number of jobs. Lists are stored
+    by their content's hash, which is their ID, and are written in the form
+    ISIS reads listfiles so jobs use them as they are.
+
+    List args can be given as {"list": <id>} for a stored list, or as a
+    query over the file catalog, {"glob": <pattern>} or {"prefix": <prefix>},
+    resolved when the job starts.
+    """
+    _LOGGER = getLogger("ISISLists")
+
+    # Lists no job has used for this long are dropped
+    LIST_TTL = 7 * 24 * 3600
+
+    @staticmethod
+    def _lists_dir(work_dir=None):
+        return path_join(work_dir or ISISServerConfig.work_dir(), ".lists")
+
+    @staticmethod
+    def _list_path(list_id):
+        if not isinstance(list_id, str) or _LIST_ID.match(list_id) is None:
+            raise ValueError("Invalid list ID '{}'".format(list_id))
+        return path_join(ISISLists._lists_dir(), "{}.lis".format(list_id))
+
+    @staticmethod
+    def store(items):
+        # The list's ID, and whether it was already stored
+        if not isinstance(items, list) or not items:
+            raise ValueError("Lists must be a non-empty array of names")
+        if not all(isinstance(item, str) and item and "\n" not in item for item in items):
+            raise ValueError("List items must be names without line breaks")
+
+        list_id = _list_id(items)
+        list_file = ISISLists._list_path(list_id)
+        try:
+            # Stored lists are in use again
+            utime(list_file)
+            return list_id, True
+        except FileNotFoundError:
+            pass
+
+        makedirs(ISISLists._lists_dir(), exist_ok=True)
+        with atomic_writer(list_file, "w") as f:
+            for item in items:
+                print(item, file=f)
+
+        ISISLists._LOGGER.info("Stored list {} of {} names".format(list_id, len(items)))
+        return list_id, False
+
+    @staticmethod
+    def items(list_id):
+        # None if there's no such list
+        try:
+            with open(ISISLists._list_path(list_id)) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def delete(list_id):
+        try:
+            remove(ISISLists._list_path(list_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def is_reference(value):
+        return isinstance(value, dict)
+
+    @staticmethod
+    def resolve(reference, list_dir):
+        """
+        The listfile for a list arg given as a reference, and the names in
+        it. Stored lists are used in place, and queries are written to a
+        listfile in list_dir. Raises ValueError for bad references and
+        queries that match nothing.
+        """
+        if set(reference) == {"list"}:
+            list_file = ISISLists._list_path(reference["list"])
+            items = ISISLists.items(reference["list"])
+            if items is None:
+                raise ValueError("List '{}' not found".format(reference["list"]))
+            utime(list_file)
+            return list_file, items
+
+        if not reference or not set(reference) <= {"glob", "prefix"}:
+            raise ValueError(
+                "List args must be an array, {\"list\": <id>} or a query with "
+                "\"glob\" and/or \"prefix\""
+            )
+
+        items = ISISCatalog.names(reference.get("prefix"), reference.get("glob"))
+        if not items:
+            raise ValueError("No files match {}".format(reference))
+
+        makedirs(list_dir, exist_ok=True)
+        list_file = path_join(list_dir, "{}.lis".format(_list_id(items)))
+        with open(list_file, "w") as f:
+            for item in items:
+                print(item, file=f)
+        return list_file, items
+
+    @staticmethod
+    def expire():
+        now = time()
+        for work_dir in ISISServerConfig.work_dirs():
+            for list_file in glob(path_join(ISISLists._lists_dir(work_dir), "*.lis")):
+                try:
+                    if now - file_stat(list_file).st_mtime > ISISLists.LIST_TTL:
+                        remove(list_file)
+                except OSError:
+                    continue
@@ -0,0 +1,126 @@
+import json
+import re
+from fcntl import flock, LOCK_EX
+from logging import getLogger
+from os import makedirs, walk
+from os.path import getsize, join as path_join
+
+from flask import g, request
+
+from ._config import ISISServerConfig
+
+_NAMESPACE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Kept in each work dir, next to the files it accounts for
+_USAGE_FILE = ".usage.json"
+
+# Work dirs whose usage this process has made sure is counted
+_SEEN = set()
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _walk_usage(work_dir):
+    # Only used the first time a namespace is seen. Dotfiles (sidecars, job
+    # manifests, caches) and other namespaces aren't counted.
+    usage = {"bytes": 0, "files": 0}
+    for root, dirs, files in walk(work_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for file in files:
+            if file.startswith("."):
+                continue
+            try:
+                usage["bytes"] += getsize(path_join(root, file))
+                usage["files"] += 1
+            except OSError:
+                continue
+    return usage
+
+
+class ISISNamespaces:
+    _LOGGER = getLogger("ISISNamespaces")
+
+    HEADER = "X-ISIS-Namespace"
+
+    @staticmethod
+    def resolve():
+        # Runs before every request to pick the namespace its files live in
+        tokens = ISISServerConfig.namespace_tokens()
+        if tokens is not None:
+            auth = request.headers.get("Authorization", "")
+            namespace = tokens.get(auth[len("Bearer "):]) if auth.startswith("Bearer ") else None
+            if namespace is None:
+                return {"message": "Missing or invalid token"}, 401
+        else:
+            namespace = request.headers.get(ISISNamespaces.HEADER)
+
+        if namespace is not None and not _NAMESPACE_PATTERN.match(namespace):
+            return {"message": "Invalid namespace '{}'".format(namespace)}, 400
+
+        g.namespace = namespace
+
+        # Usage is counted once when a namespace is first seen, before any
+        # of this request's changes are charged to it. After that only the
+        # routes that charge quota read it.
+        work_dir = ISISServerConfig.work_dir()
+        if work_dir not in _SEEN:
+            ISISNamespaces._update(work_dir)
+            _SEEN.add(work_dir)
+
+    @staticmethod
+    def _update(work_dir, bytes_delta=0, files_delta=0):
+        makedirs(work_dir, mode=0o700, exist_ok=True)
+
+        # Locked so concurrent workers don't lose each other's updates
+        with open(path_join(work_dir, _USAGE_FILE), "a+") as f:
+            flock(f, LOCK_EX)
+            f.seek(0)
+            try:
+                usage = json.loads(f.read())
+                changed = False
+            except ValueError:
+                usage = _walk_usage(work_dir)
+                changed = True
+
+            if bytes_delta or files_delta:
+                usage["bytes"] = max(0, usage["bytes"] + bytes_delta)
+                usage["files"] = max(0, usage["files"] + files_delta)
+                changed = True
+
+            if changed:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(usage))
+
+        return usage
+
+    @staticmethod
+    def usage():
+        usage = ISISNamespaces._update(ISISServerConfig.work_dir())
+        return {
+            "namespace": g.get("namespace"),
+            "bytes": usage["bytes"],
+            "files": usage["files"],
+            "max_bytes": ISISServerConfig.namespace_max_bytes(),
+            "max_files": ISISServerConfig.namespace_max_files(),
+        }
+
+    @staticmethod
+    def charge(bytes_delta, files_delta, work_dir=None):
+        ISISNamespaces._update(
+            work_dir or ISISServerConfig.work_dir(),
+            bytes_delta,
+            files_delta
+        )
+
+    @staticmethod
+    def check(bytes_delta=0, files_delta=0):
+        usage = ISISNamespaces.usage()
+
+        if usage["max_bytes"] is not None and usage["bytes"] + bytes_delta > usage["max_bytes"]:
+            raise QuotaExceeded("Byte quota of {} exceeded".format(usage["max_bytes"]))
+
+        if usage["max_files"] is not None and usage["files"] + files_delta > usage["max_files"]:
+            raise QuotaExceeded("File quota of {} exceeded".format(usage["max_files"]))
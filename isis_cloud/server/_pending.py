@@ -0,0 +1,163 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from logging import getLogger
+from os import makedirs, remove, rename, stat as file_stat
+from os.path import basename, dirname, join as path_join, lexists
+from shutil import rmtree
+from threading import Thread
+from time import sleep, time
+
+from .. import tracing
+from ._cache import atomic_writer
+from ._config import ISISServerConfig
+from ._remotes import ISISRemotes
+
+
+def _remove(file_path):
+    try:
+        remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+class ISISPendingJobs:
+    """
+    Jobs created before their file args are uploaded. A pending job's
+    remotes are fetched while the client uploads its files, and it runs as
+    soon as both have landed. They're kept on disk in the work dir, so the
+    upload can reach any worker.
+    """
+    _LOGGER = getLogger("ISISPendingJobs")
+
+    # Pending jobs whose uploads haven't arrived by then are dropped
+    PENDING_TIMEOUT = 3600
+
+    # How often an upload checks whether its job's remotes have landed
+    _POLL_INTERVAL = 0.1
+
+    @staticmethod
+    def _pending_dir(work_dir=None):
+        return path_join(work_dir or ISISServerConfig.work_dir(), ".pending")
+
+    @staticmethod
+    def _record_path(job_id):
+        return path_join(ISISPendingJobs._pending_dir(), "{}.json".format(job_id))
+
+    @staticmethod
+    def _fetched_path(job_id):
+        return path_join(ISISPendingJobs._pending_dir(), "{}.fetched.json".format(job_id))
+
+    @staticmethod
+    def create(job_id, body, uploads, remotes):
+        # remotes maps arg names to their URL, the file to fetch them to and
+        # whether the program may write to it
+        makedirs(ISISPendingJobs._pending_dir(), mode=0o700, exist_ok=True)
+        with atomic_writer(ISISPendingJobs._record_path(job_id), "w") as f:
+            json.dump({
+                "body": body,
+                "uploads": uploads,
+                "remotes": {k: file_path for k, (_, file_path, _) in remotes.items()},
+                "created": time(),
+            }, f)
+
+        fetched_file = ISISPendingJobs._fetched_path(job_id)
+        Thread(
+            target=tracing.wrap(ISISPendingJobs._fetch),
+            args=(job_id, remotes, fetched_file),
+            daemon=True
+        ).start()
+
+    @staticmethod
+    def _fetch(job_id, remotes, fetched_file):
+        result = {"status": 200}
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(remotes), 1)) as pool:
+                list(pool.map(tracing.wrap(lambda remote: ISISRemotes.fetch(*remote)), remotes.values()))
+        except ValueError as e:
+            result = {"status": 400, "message": str(e)}
+        except OSError as e:
+            result = {"status": 502, "message": "Couldn't fetch remotes: {}".format(e)}
+        except Exception as e:
+            ISISPendingJobs._LOGGER.exception("Fetching remotes for job {} failed".format(job_id))
+            result = {"status": 500, "message": str(e)}
+
+        with atomic_writer(fetched_file, "w") as f:
+            json.dump(result, f)
+
+    @staticmethod
+    def get(job_id):
+        try:
+            with open(ISISPendingJobs._record_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def exists(job_id):
+        # Whether the job's waiting for its uploads, or has them landing
+        record_file = ISISPendingJobs._record_path(job_id)
+        return lexists(record_file) or lexists("{}.claimed".format(record_file))
+
+    @staticmethod
+    def claim(job_id):
+        # Renaming is atomic, so only one upload runs each job. None if
+        # another got there first.
+        record_file = ISISPendingJobs._record_path(job_id)
+        claimed_file = "{}.claimed".format(record_file)
+        try:
+            rename(record_file, claimed_file)
+            with open(claimed_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def wait_for_remotes(job_id, record):
+        # The fetch's result, once every remote has landed
+        fetched_file = ISISPendingJobs._fetched_path(job_id)
+        with tracing.span("isis.pending.wait", **{"isis.job_id": job_id}):
+            while not lexists(fetched_file):
+                if time() - record["created"] > ISISPendingJobs.PENDING_TIMEOUT:
+                    return {"status": 504, "message": "Remotes weren't fetched in time"}
+                sleep(ISISPendingJobs._POLL_INTERVAL)
+
+        with open(fetched_file) as f:
+            return json.load(f)
+
+    @staticmethod
+    def release(job_id):
+        _remove("{}.claimed".format(ISISPendingJobs._record_path(job_id)))
+        _remove(ISISPendingJobs._fetched_path(job_id))
+
+    @staticmethod
+    def expire():
+        # Drops jobs whose uploads never came, and their fetched remotes
+        now = time()
+        for work_dir in ISISServerConfig.work_dirs():
+            pending_dir = ISISPendingJobs._pending_dir(work_dir)
+            for record_file in glob(path_join(pending_dir, "*.json")):
+                if record_file.endswith(".fetched.json"):
+                    continue
+
+                try:
+                    if now - file_stat(record_file).st_mtime <= ISISPendingJobs.PENDING_TIMEOUT:
+                        continue
+                    # Claimed like an upload would, so the two can't race
+                    claimed_file = "{}.claimed".format(record_file)
+                    rename(record_file, claimed_file)
+                    with open(claimed_file) as f:
+                        record = json.load(f)
+                except (OSError, ValueError):
+                    continue
+
+                for file_path in record["remotes"].values():
+                    _remove(file_path)
+                    # Remotes are fetched into the job's own dir
+                    if basename(dirname(file_path)) == basename(record_file)[:-len(".json")]:
+                        rmtree(dirname(file_path), ignore_errors=True)
+                _remove(claimed_file)
+                _remove("{}.fetched.json".format(record_file[:-len(".json")]))
+                ISISPendingJobs._LOGGER.info("Dropped job {}, its uploads never came".format(
+                    basename(record_file)[:-len(".json")]
+                ))
@@ -0,0 +1,320 @@
+import ast
+from atexit import register as at_exit
+from collections import OrderedDict
+from logging import getLogger
+from multiprocessing import get_context
+from os import getpid
+from threading import Lock
+from uuid import uuid4
+
+import numpy as np
+
+from .. import tracing
+from ..cube import Cube
+
+logger = getLogger("PixelMath")
+
+# Lines evaluated per task are rounded to whole tile rows of the output so
+# no two workers ever write to the same tile
+_TASK_PIXELS = 4 * 1024 * 1024
+
+_BINARY_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+}
+
+_UNARY_OPS = {
+    ast.USub: np.negative,
+    ast.UAdd: np.positive,
+}
+
+_FUNCTIONS = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "exp": np.exp,
+    "log": np.log,
+    "log10": np.log10,
+    "min": np.fmin,
+    "max": np.fmax,
+}
+
+# Cubes opened by each pool worker, reused across a run's tasks. The pool
+# outlives runs, so only the cubes of the last few are kept open.
+_WORKER_CUBES = OrderedDict()
+_WORKER_RUNS = 4
+
+# Pool workers are started fresh rather than forked, as forking a threaded
+# server worker can copy locks other threads hold and deadlock
+_POOL_CONTEXT = get_context("spawn")
+
+# Each server worker starts one pool on first use and shares it between its
+# requests, as starting workers costs more than most evaluations
+_POOL = None
+_POOL_LOCK = Lock()
+
+
+def _parse_input(spec):
+    # ISIS style "file.cub+2" band selection, 1-based
+    file_name, sep, band = spec.rpartition("+")
+    if sep and band.isdigit():
+        return file_name, int(band)
+    return spec, 1
+
+
+class Expression:
+    def __init__(self, equation, inputs, define=None):
+        # Named definitions are substituted into the equation so a chain
+        # like ratio -> lowpass -> multiply is evaluated as one expression
+        # and its intermediates are never written
+        self._inputs = inputs
+        self._define = define or dict()
+        self._tree = self._compile(equation, list())
+        self.halo = self._halo(self._tree)
+
+    def _compile(self, source, resolving):
+        try:
+            node = ast.parse(str(source), mode="eval").body
+        except SyntaxError as e:
+            raise ValueError("Invalid equation '{}': {}".format(source, e.msg))
+
+        return self._compile_node(node, resolving)
+
+    def _compile_node(self, node, resolving):
+        # Numbers parse as ast.Num before Python 3.8
+        if type(node).__name__ in ("Constant", "Num"):
+            value = node.value if hasattr(node, "value") else node.n
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError("Unsupported constant {!r}".format(value))
+            return "const", float(value)
+
+        if isinstance(node, ast.Name):
+            if node.id in self._inputs:
+                return "input", node.id
+            if node.id in self._define:
+                if node.id in resolving:
+                    raise ValueError("'{}' is defined in terms of itself".format(node.id))
+                return self._compile(self._define[node.id], resolving + [node.id])
+            raise ValueError("Unknown name '{}'".format(node.id))
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            return (
+                "binary",
+                _BINARY_OPS[type(node.op)],
+                self._compile_node(node.left, resolving),
+                self._compile_node(node.right, resolving)
+            )
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+            return (
+                "unary",
+                _UNARY_OPS[type(node.op)],
+                self._compile_node(node.operand, resolving)
+            )
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            args = [self._compile_node(arg, resolving) for arg in node.args]
+
+            if node.func.id == "lowpass":
+                return self._compile_lowpass(args)
+
+            if node.func.id in _FUNCTIONS:
+                return ("call", _FUNCTIONS[node.func.id], *args)
+
+            raise ValueError("Unknown function '{}'".format(node.func.id))
+
+        raise ValueError("Unsupported expression '{}'".format(ast.dump(node)))
+
+    @staticmethod
+    def _compile_lowpass(args):
+        if len(args) != 3:
+            raise ValueError("lowpass takes (value, samples, lines)")
+
+        window = list()
+        for arg in args[1:]:
+            if arg[0] != "const" or arg[1] < 1 or arg[1] % 2 != 1:
+                raise ValueError("lowpass windows must be odd positive integers")
+            window.append(int(arg[1]) // 2)
+
+        return "lowpass", args[0], window[0], window[1]
+
+    def _halo(self, node):
+        # The extra (lines, samples) needed around a block to evaluate it
+        if node[0] in ("const", "input"):
+            return 0, 0
+
+        if node[0] == "lowpass":
+            lines, samples = self._halo(node[1])
+            return lines + node[3], samples + node[2]
+
+        halos = [self._halo(child) for child in node[2:]]
+        return max(h[0] for h in halos), max(h[1] for h in halos)
+
+    def evaluate(self, node, values):
+        kind = node[0]
+
+        if kind == "const":
+            return node[1]
+        if kind == "input":
+            return values[node[1]]
+        if kind == "lowpass":
+            return _boxcar_mean(self.evaluate(node[1], values), node[3], node[2])
+
+        args = [self.evaluate(child, values) for child in node[2:]]
+        return node[1](*args)
+
+    def evaluate_block(self, values):
+        with np.errstate(all="ignore"):
+            return self.evaluate(self._tree, values)
+
+
+def _boxcar_mean(values, half_lines, half_samples):
+    # Mean of the valid pixels in each window via summed-area tables, so
+    # the cost doesn't depend on the window size
+    if np.ndim(values) == 0:
+        return values
+
+    valid = np.isfinite(values)
+
+    sums = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    counts = np.zeros(sums.shape)
+    sums[1:, 1:] = np.where(valid, values, 0).cumsum(0, dtype=np.float64).cumsum(1)
+    counts[1:, 1:] = valid.cumsum(0).cumsum(1)
+
+    rows = np.arange(values.shape[0])
+    cols = np.arange(values.shape[1])
+    top = np.clip(rows - half_lines, 0, values.shape[0])[:, None]
+    bottom = np.clip(rows + half_lines + 1, 0, values.shape[0])[:, None]
+    left = np.clip(cols - half_samples, 0, values.shape[1])[None, :]
+    right = np.clip(cols + half_samples + 1, 0, values.shape[1])[None, :]
+
+    def window_total(table):
+        return (
+            table[bottom, right] - table[top, right] -
+            table[bottom, left] + table[top, left]
+        )
+
+    with np.errstate(all="ignore"):
+        return window_total(sums) / window_total(counts)
+
+
+def _pool(workers):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL[0] != getpid():
+            _POOL = (getpid(), _POOL_CONTEXT.Pool(processes=workers))
+            at_exit(_POOL[1].terminate)
+        return _POOL[1]
+
+
+def _worker_cube(run_id, file_path, writable=False):
+    if run_id not in _WORKER_CUBES:
+        _WORKER_CUBES[run_id] = dict()
+        while len(_WORKER_CUBES) > _WORKER_RUNS:
+            _, cubes = _WORKER_CUBES.popitem(last=False)
+            [c.close() for c in cubes.values()]
+
+    cubes = _WORKER_CUBES[run_id]
+    key = (file_path, writable)
+    if key not in cubes:
+        cubes[key] = Cube(file_path, writable=writable)
+    return cubes[key]
+
+
+def _read_with_halo(cube, band, first_line, last_line, halo):
+    # Pixels outside the cube are Null so windows at the edges only
+    # average what's there
+    halo_lines, halo_samples = halo
+    block = np.full(
+        (last_line - first_line + 2 * halo_lines, cube.core.samples + 2 * halo_samples),
+        np.nan,
+        dtype=np.float32
+    )
+
+    start = max(0, first_line - halo_lines)
+    stop = min(cube.core.lines, last_line + halo_lines)
+    values = cube[band, start:stop]
+
+    # Special pixels don't take part in the math, matching ISIS fx/ratio
+    values[~np.isfinite(values)] = np.nan
+
+    offset = start - (first_line - halo_lines)
+    block[offset:offset + values.shape[0], halo_samples:halo_samples + values.shape[1]] = values
+    return block
+
+
+def _evaluate_lines(run_id, expression, inputs, output_path, first_line, last_line):
+    values = {
+        name: _read_with_halo(
+            _worker_cube(run_id, file_path),
+            band - 1,
+            first_line,
+            last_line,
+            expression.halo
+        )
+        for name, (file_path, band) in inputs.items()
+    }
+
+    result = np.broadcast_to(
+        expression.evaluate_block(values),
+        next(iter(values.values())).shape
+    )
+
+    halo_lines, halo_samples = expression.halo
+    result = result[
+        halo_lines:halo_lines + last_line - first_line,
+        halo_samples:result.shape[1] - halo_samples
+    ]
+
+    # Anything the math couldn't produce a value for is written as Null
+    result = np.where(np.isfinite(result), result, np.nan)
+
+    output = _worker_cube(run_id, output_path, writable=True)
+    output[0, first_line:last_line] = result
+    output.flush()
+
+
+def evaluate_pixelmath(equation, inputs, output_path, define=None, workers=None):
+    with tracing.span("isis.pixelmath", **{"pixelmath.equation": equation}):
+        return _evaluate_pixelmath(equation, inputs, output_path, define, workers)
+
+
+def _evaluate_pixelmath(equation, inputs, output_path, define, workers):
+    inputs = {name: _parse_input(spec) for name, spec in inputs.items()}
+    expression = Expression(equation, inputs, define)
+
+    cubes = [Cube(file_path) for file_path, _ in inputs.values()]
+    try:
+        for (file_path, band), cube in zip(inputs.values(), cubes):
+            if not 1 <= band <= cube.core.bands:
+                raise ValueError("'{}' has no band {}".format(file_path, band))
+
+        dims = {(c.core.samples, c.core.lines) for c in cubes}
+        if len(dims) != 1:
+            raise ValueError("Input cubes must have the same dimensions")
+
+        samples, lines = dims.pop()
+        with Cube.create(output_path, samples, lines, template=cubes[0]) as output:
+            tile_lines = output.core.tile_lines
+    finally:
+        [c.close() for c in cubes]
+
+    task_lines = max(1, _TASK_PIXELS // (samples * tile_lines)) * tile_lines
+
+    logger.info("Evaluating '{}' into {}".format(equation, output_path))
+    run_id = uuid4().hex
+    pool = _pool(workers)
+    tasks = [
+        pool.apply_async(_evaluate_lines, (
+            run_id,
+            expression,
+            inputs,
+            output_path,
+            first_line,
+            min(lines, first_line + task_lines)
+        ))
+        for first_line in range(0, lines, task_lines)
+    ]
+    [t.get() for t in tasks]
@@ -0,0 +1,273 @@
+import json
+import re
+from atexit import register as at_exit
+from glob import glob
+from hashlib import sha1
+from logging import getLogger
+from os import X_OK, access, environ, getpid, listdir, makedirs, pathsep
+from os.path import expanduser, isfile, join as path_join
+from shutil import rmtree
+from subprocess import run as sp_run, PIPE, DEVNULL
+from tempfile import mkdtemp
+from threading import Thread
+from xml.etree import ElementTree
+
+from .. import tracing
+from ._config import ISISServerConfig
+
+try:
+    from os import posix_fadvise, POSIX_FADV_WILLNEED
+except ImportError:  # Not available on macOS
+    posix_fadvise = None
+
+# Written as the sandbox user's IsisPreferences. Turning off the session log
+# saves every run from opening and appending to print.prt.
+_SANDBOX_PREFERENCES = """Group = SessionLog
+  TerminalOutput = Off
+  FileOutput     = Off
+End_Group
+End
+"""
+
+_SESSION_LOG_GROUP = re.compile(r"^\s*Group\s*=\s*SessionLog\s*$", re.IGNORECASE | re.MULTILINE)
+_END_STATEMENT = re.compile(r"^\s*End\s*\Z", re.IGNORECASE | re.MULTILINE)
+
+# Read size when warming files without posix_fadvise
+_WARM_CHUNK_SIZE = 1024 * 1024
+
+
+def _text(element, path):
+    found = element.find(path)
+    if found is None or found.text is None:
+        return None
+    return " ".join(found.text.split())
+
+
+def _parse_parameter(group_name, param):
+    definition = {
+        "name": param.get("name").lower(),
+        "group": group_name,
+        "type": _text(param, "type"),
+        "brief": _text(param, "brief"),
+        "file_mode": _text(param, "fileMode"),
+        "default": _text(param, "default/item"),
+        "internal_default": _text(param, "internalDefault"),
+        "minimum": _text(param, "minimum"),
+        "maximum": _text(param, "maximum"),
+        "options": None,
+        "excludes": [
+            item.text.lower() for item in param.findall("exclusions/item")
+        ],
+    }
+
+    options = param.findall("list/option")
+    if options:
+        definition["options"] = [o.get("value") for o in options]
+        for option in options:
+            definition["excludes"].extend(
+                item.text.lower() for item in option.findall("exclusions/item")
+            )
+
+    return definition
+
+
+class ISISProgram:
+    def __init__(self, name, path, app_xml):
+        self.name = name
+        self.path = path
+
+        # The ISIS application definition, None for non-ISIS executables
+        self.app_xml = app_xml
+
+        self._definition = None
+        self._etag = None
+
+    def _parse_app_xml(self):
+        app = ElementTree.parse(self.app_xml).getroot()
+
+        parameters = list()
+        for group in app.findall("groups/group"):
+            for param in group.findall("parameter"):
+                parameters.append(_parse_parameter(group.get("name"), param))
+
+        # Parameters that another parameter's value can exclude are only
+        # conditionally required
+        excludable = {e for p in parameters for e in p["excludes"]}
+        for param in parameters:
+            param["required"] = (
+                param["default"] is None and
+                param["internal_default"] is None and
+                param["name"] not in excludable
+            )
+
+        return {
+            "name": self.name,
+            "brief": _text(app, "brief"),
+            "category": [_text(c, ".") for c in app.findall("category/*")],
+            "parameters": parameters,
+        }
+
+    @property
+    def definition(self):
+        # Parsed on first use, then kept for the life of the process
+        if self._definition is None and self.app_xml is not None:
+            try:
+                definition = self._parse_app_xml()
+            except ElementTree.ParseError as e:
+                ISISPrograms._LOGGER.warning(
+                    "Invalid application definition {}: {}".format(self.app_xml, e)
+                )
+                self.app_xml = None
+                return None
+
+            # Set before the definition so threads never see one without
+            # the other
+            self._etag = sha1(
+                json.dumps(definition, sort_keys=True).encode("utf-8")
+            ).hexdigest()
+            self._definition = definition
+
+        return self._definition
+
+    @property
+    def etag(self):
+        return self._etag if self.definition is not None else None
+
+    def writes_input(self, arg_name):
+        # Whether the program may write to the file given for arg_name.
+        # Programs without output files, e.g. spiceinit, write to their
+        # input cubes, and anything could without a definition.
+        if self.definition is None:
+            return True
+
+        parameters = self.definition["parameters"]
+        if any(p["file_mode"] == "output" for p in parameters):
+            return False
+        return any(
+            p["name"] == arg_name.lower() and p["file_mode"] == "input"
+            for p in parameters
+        )
+
+
+class ISISPrograms:
+    _LOGGER = getLogger("ISISPrograms")
+
+    _PROGRAMS = None
+    _ENV = None
+
+    @staticmethod
+    def load():
+        isis_bin = path_join(environ["ISISROOT"], "bin")
+        xml_dir = path_join(isis_bin, "xml")
+
+        programs = dict()
+        for name in listdir(isis_bin):
+            path = path_join(isis_bin, name)
+            if not (isfile(path) and access(path, X_OK)):
+                continue
+
+            app_xml = path_join(xml_dir, "{}.xml".format(name))
+            programs[name] = ISISProgram(
+                name,
+                path,
+                app_xml if isfile(app_xml) else None
+            )
+
+        ISISPrograms._PROGRAMS = programs
+        ISISPrograms._ENV = ISISPrograms._create_env(isis_bin)
+        ISISPrograms._LOGGER.info("Found {} programs in {}".format(
+            len(programs),
+            isis_bin
+        ))
+
+    @staticmethod
+    def warm():
+        # Run by the one process running the server's background work
+        Thread(target=ISISPrograms._warm_isis_data, daemon=True).start()
+
+    @staticmethod
+    def _sandbox_preferences():
+        # The operator's preferences, e.g. data area and cache overrides,
+        # with the session log turned off unless they've configured it
+        try:
+            with open(path_join(expanduser("~"), ".Isis", "IsisPreferences")) as f:
+                preferences = f.read()
+        except OSError:
+            return _SANDBOX_PREFERENCES
+
+        if _SESSION_LOG_GROUP.search(preferences) is not None:
+            return preferences
+        return "{}\n\n{}".format(
+            _END_STATEMENT.sub("", preferences).rstrip(),
+            _SANDBOX_PREFERENCES
+        )
+
+    @staticmethod
+    def _create_env(isis_bin):
+        # One sandbox home per server process, reused by every job, so ISIS
+        # finds its preferences and .Isis directory already in place
+        sandbox = mkdtemp(prefix="isis-sandbox-")
+        at_exit(ISISPrograms._remove_sandbox, sandbox, getpid())
+        makedirs(path_join(sandbox, ".Isis"))
+        with open(path_join(sandbox, ".Isis", "IsisPreferences"), "w") as f:
+            f.write(ISISPrograms._sandbox_preferences())
+
+        env = dict(environ)
+        env["HOME"] = sandbox
+        env["PATH"] = pathsep.join([isis_bin, environ.get("PATH", "")])
+        return env
+
+    @staticmethod
+    def _remove_sandbox(sandbox, owner):
+        # Workers forked from a preloaded app share the master's sandbox and
+        # run its exit handlers too, so only the master removes it
+        if getpid() == owner:
+            rmtree(sandbox, ignore_errors=True)
+
+    @staticmethod
+    def _warm_isis_data():
+        # Ask the kernel to pull commonly used ISISDATA files into the page
+        # cache so the first jobs to use them don't wait on the disk
+        for pattern in ISISServerConfig.isis_data_preload():
+            for file in glob(path_join(environ["ISISDATA"], pattern)):
+                try:
+                    with open(file, "rb") as f:
+                        if posix_fadvise is not None:
+                            posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+                        else:
+                            while f.read(_WARM_CHUNK_SIZE):
+                                pass
+                except OSError as e:
+                    ISISPrograms._LOGGER.warning(
+                        "Couldn't warm {}: {}".format(file, e)
+                    )
+
+    @staticmethod
+    def all():
+        if ISISPrograms._PROGRAMS is None:
+            ISISPrograms.load()
+
+        return [ISISPrograms._PROGRAMS[n] for n in sorted(ISISPrograms._PROGRAMS)]
+
+    @staticmethod
+    def get(name):
+        if ISISPrograms._PROGRAMS is None:
+            ISISPrograms.load()
+
+        return ISISPrograms._PROGRAMS.get(name)
+
+    @staticmethod
+    def run(program, args):
+        with tracing.span("isis.program", **{
+            "isis.program": program.name,
+            **{"isis.arg.{}".format(k): v for k, v in (a.split("=", 1) for a in args)}
+        }) as span:
+            proc = sp_run(
+                [program.path, *args],
+                cwd=ISISServerConfig.work_dir(),
+                env=tracing.subprocess_env(ISISPrograms._ENV),
+                stdout=DEVNULL,
+                stderr=PIPE
+            )
+            span.set_attribute("isis.returncode", proc.returncode)
+        return proc
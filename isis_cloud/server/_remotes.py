@@ -0,0 +1,252 @@
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha256
+from logging import getLogger
+from shutil import copyfileobj
+from fcntl import ioctl
+from os import link, pwrite, remove, rename, stat as file_stat
+from os.path import isfile, join as path_join, realpath, sep
+from urllib.parse import quote, unquote, urlparse
+from urllib.request import Request, urlopen, urlretrieve
+
+from .. import tracing
+from ._config import ISISServerConfig
+
+# Seconds to wait on a remote store before giving up on a request
+_REQUEST_TIMEOUT = 60
+
+# 1MiB
+_READ_CHUNK_SIZE = 1024 * 1024
+
+# Linux's FICLONE ioctl, which clones a file's blocks copy-on-write
+_FICLONE = 0x40049409
+
+# The SHA256 of an empty payload, which every S3 GET and HEAD sends
+_EMPTY_SHA256 = sha256(b"").hexdigest()
+
+
+def _http_fetch(url, file_path):
+    urlretrieve(url, file_path)
+
+
+def _http_size(url):
+    with urlopen(Request(url, method="HEAD"), timeout=_REQUEST_TIMEOUT) as r:
+        return int(r.headers["Content-Length"])
+
+
+def _mirror_path(url):
+    # The mirrored file a file:// or mirror:// URL names, which has to be
+    # inside one of the configured mirrors
+    parsed = urlparse(url)
+    mirrors = ISISServerConfig.remote_mirrors()
+
+    if parsed.scheme == "mirror":
+        if parsed.netloc not in mirrors:
+            raise ValueError("Unknown mirror '{}'".format(parsed.netloc))
+        roots = [mirrors[parsed.netloc]]
+        file_path = path_join(mirrors[parsed.netloc], unquote(parsed.path).lstrip("/"))
+    else:
+        roots = list(mirrors.values())
+        file_path = unquote(parsed.path)
+
+    file_path = realpath(file_path)
+    if not any(file_path.startswith(realpath(root) + sep) for root in roots):
+        raise ValueError("'{}' is not in a configured mirror".format(url))
+    if not isfile(file_path):
+        raise FileNotFoundError("'{}' not found".format(url))
+    return file_path
+
+
+def _copy(source, file_path):
+    # Cloned copy-on-write where the filesystem can, e.g. btrfs or xfs,
+    # copied otherwise
+    with open(source, "rb") as src, open(file_path, "wb") as dst:
+        try:
+            ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            copyfileobj(src, dst, _READ_CHUNK_SIZE)
+
+
+def _mirror_fetch(url, file_path):
+    # Hard linked when the mirror shares a filesystem with the download dir,
+    # copied otherwise. ISISRemotes.fetch gives args that programs write to
+    # a copy of their own.
+    source = _mirror_path(url)
+    try:
+        link(source, file_path)
+    except OSError:
+        _copy(source, file_path)
+
+
+def _mirror_size(url):
+    return file_stat(_mirror_path(url)).st_size
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode("utf-8"), sha256).digest()
+
+
+def s3_authorization(method, host, path, headers, amz_date, region, access_key, secret_key):
+    """
+    The AWS Signature Version 4 Authorization header for a request with an
+    empty payload and no query string. Every header given is signed, and
+    must be sent as given along with Host.
+    """
+    signed = dict({k.lower(): str(v).strip() for k, v in headers.items()}, host=host)
+    signed_headers = ";".join(sorted(signed))
+    canonical_request = "\n".join([
+        method,
+        path,
+        "",
+        "".join("{}:{}\n".format(k, signed[k]) for k in sorted(signed)),
+        signed_headers,
+        _EMPTY_SHA256
+    ])
+
+    date = amz_date[:8]
+    scope = "{}/{}/s3/aws4_request".format(date, region)
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256",
+        amz_date,
+        scope,
+        sha256(canonical_request.encode("utf-8")).hexdigest()
+    ])
+
+    key = ("AWS4" + secret_key).encode("utf-8")
+    for part in [date, region, "s3", "aws4_request"]:
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode("utf-8"), sha256).hexdigest()
+
+    return "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+        access_key,
+        scope,
+        signed_headers,
+        signature
+    )
+
+
+def _s3_open(url, method, headers=None):
+    # Path style addressing, which S3 compatible stores all support
+    parsed = urlparse(url)
+    endpoint = urlparse(ISISServerConfig.s3_endpoint_url())
+    path = quote("/{}{}".format(parsed.netloc, unquote(parsed.path)), safe="/~")
+
+    headers = dict(headers or dict())
+    credentials = ISISServerConfig.s3_credentials()
+    if credentials is not None:
+        access_key, secret_key, session_token = credentials
+        amz_date = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+        headers["x-amz-date"] = amz_date
+        headers["x-amz-content-sha256"] = _EMPTY_SHA256
+        if session_token is not None:
+            headers["x-amz-security-token"] = session_token
+        headers["Authorization"] = s3_authorization(
+            method,
+            endpoint.netloc,
+            path,
+            headers,
+            amz_date,
+            ISISServerConfig.s3_region(),
+            access_key,
+            secret_key
+        )
+
+    request = Request(
+        "{}://{}{}".format(endpoint.scheme, endpoint.netloc, path),
+        method=method,
+        headers=headers
+    )
+    return urlopen(request, timeout=_REQUEST_TIMEOUT)
+
+
+def _s3_head(url):
+    with _s3_open(url, "HEAD") as r:
+        return int(r.headers["Content-Length"]), r.headers.get("ETag")
+
+
+def _s3_size(url):
+    return _s3_head(url)[0]
+
+
+def _s3_fetch(url, file_path):
+    size, etag = _s3_head(url)
+    part_size = ISISServerConfig.s3_part_size()
+
+    with open(file_path, "wb") as f:
+        f.truncate(size)
+
+        def fetch_part(start):
+            end = min(start + part_size, size) - 1
+            headers = {"Range": "bytes={}-{}".format(start, end)}
+            # A part from a newer version of the object fails rather than
+            # being mixed in with the rest
+            if etag is not None:
+                headers["If-Match"] = etag
+
+            offset = start
+            with _s3_open(url, "GET", headers) as r:
+                if r.status != 206:
+                    raise OSError("'{}' doesn't support range requests".format(url))
+                for chunk in iter(lambda: r.read(_READ_CHUNK_SIZE), b""):
+                    pwrite(f.fileno(), chunk, offset)
+                    offset += len(chunk)
+
+            if offset != end + 1:
+                raise OSError("Short read of '{}' at byte {}".format(url, offset))
+
+        with ThreadPoolExecutor(max_workers=ISISServerConfig.s3_concurrency()) as pool:
+            list(pool.map(fetch_part, range(0, size, part_size)))
+
+
+class ISISRemotes:
+    """
+    Fetches the remote files named in jobs' args, by URL scheme. Resolvers
+    for other schemes can be added with register.
+    """
+    _LOGGER = getLogger("ISISRemotes")
+
+    _RESOLVERS = dict()
+
+    @staticmethod
+    def register(scheme, fetch, size):
+        # fetch(url, file_path) puts the remote file at file_path, and
+        # size(url) returns its size in bytes. Both raise OSError if the
+        # remote can't be reached and ValueError if the URL isn't allowed.
+        ISISRemotes._RESOLVERS[scheme] = (fetch, size)
+
+    @staticmethod
+    def _resolver(url):
+        scheme = urlparse(url).scheme
+        if scheme not in ISISRemotes._RESOLVERS:
+            raise ValueError("Unsupported remote '{}'".format(url))
+        return ISISRemotes._RESOLVERS[scheme]
+
+    @staticmethod
+    def fetch(url, file_path, writable=False):
+        # writable is for args that the program may write to, which mustn't
+        # share their file with a mirror
+        fetch, _ = ISISRemotes._resolver(url)
+        ISISRemotes._LOGGER.info("Fetching {}".format(url))
+        with tracing.span("isis.remote.fetch", **{"remote.url": url}) as span:
+            fetch(url, file_path)
+            if writable and file_stat(file_path).st_nlink > 1:
+                shared_path = "{}.shared".format(file_path)
+                rename(file_path, shared_path)
+                try:
+                    _copy(shared_path, file_path)
+                finally:
+                    remove(shared_path)
+            span.set_attribute("remote.bytes", file_stat(file_path).st_size)
+
+    @staticmethod
+    def size(url):
+        _, size = ISISRemotes._resolver(url)
+        return size(url)
+
+
+for _scheme in ["http", "https", "ftp"]:
+    ISISRemotes.register(_scheme, _http_fetch, _http_size)
+for _scheme in ["file", "mirror"]:
+    ISISRemotes.register(_scheme, _mirror_fetch, _mirror_size)
+ISISRemotes.register("s3", _s3_fetch, _s3_size)
@@ -0,0 +1,402 @@
+import sqlite3
+from contextlib import contextmanager
+from logging import getLogger
+from os import getpid, kill
+from os.path import join as path_join
+from threading import Condition, Thread, local
+from time import sleep, time
+
+from flask import g, has_request_context, request
+
+from .. import tracing
+from ._config import ISISServerConfig
+
+# Shared by every worker, so slots and shares are server wide
+_SCHEDULER_FILE = ".scheduler.sqlite"
+
+# Lanes in priority order. Interactive jobs start before any batch job,
+# and running jobs are never interrupted.
+LANES = ["interactive", "batch"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    ticket INTEGER PRIMARY KEY AUTOINCREMENT,
+    lane INTEGER NOT NULL,
+    client TEXT NOT NULL,
+    tag REAL NOT NULL,
+    enqueued REAL NOT NULL,
+    admitted REAL,
+    pid INTEGER NOT NULL,
+    member TEXT NOT NULL DEFAULT '',
+    member_tag REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tickets_order ON tickets (admitted, lane, tag, ticket);
+CREATE TABLE IF NOT EXISTS finish_tags (
+    lane INTEGER NOT NULL,
+    client TEXT NOT NULL,
+    tag REAL NOT NULL,
+    PRIMARY KEY (lane, client)
+);
+CREATE TABLE IF NOT EXISTS member_tags (
+    lane INTEGER NOT NULL,
+    client TEXT NOT NULL,
+    member TEXT NOT NULL,
+    tag REAL NOT NULL,
+    PRIMARY KEY (lane, client, member)
+);
+CREATE TABLE IF NOT EXISTS lanes (lane INTEGER PRIMARY KEY, vtime REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS clients (
+    lane INTEGER NOT NULL,
+    client TEXT NOT NULL,
+    vtime REAL NOT NULL,
+    PRIMARY KEY (lane, client)
+);
+CREATE TABLE IF NOT EXISTS waits (lane INTEGER NOT NULL, admitted REAL NOT NULL, seconds REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS waits_admitted ON waits (admitted);
+"""
+
+
+def _alive(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class ISISScheduler:
+    """
+    Queues ISIS programs for a fixed number of slots shared by every worker.
+    Queued jobs start in lane order, and within a lane by start-time fair
+    queuing between clients: each job is tagged with the later of its
+    lane's virtual time and its client's previous tag plus 1/weight, and
+    the lowest tag starts first. A client with thousands of jobs queued
+    only holds its share of the slots while others are waiting.
+
+    Clients are who the server knows a request is from, its namespace when
+    tokens are configured and its host otherwise. Each client's share is
+    divided the same way between the members it names with X-ISIS-Client:
+    when it's a client's turn, its member with the lowest member tag
+    starts, so naming more members doesn't get a client more slots.
+
+    The queue is an SQLite database in the data dir. Each worker runs one
+    thread that polls it while the worker has jobs waiting, and any worker
+    can start any queued job when a slot frees up.
+    """
+    _LOGGER = getLogger("ISISScheduler")
+
+    HEADER = "X-ISIS-Client"
+
+    # How often queued jobs are checked for a free slot
+    POLL_INTERVAL = 0.05
+
+    # Slots held by workers that died are freed this often
+    _REAP_INTERVAL = 5
+
+    # Wait times are reported over this many seconds
+    WAIT_WINDOW = 3600
+
+    # One connection per thread and worker
+    _LOCAL = local()
+
+    # This worker's queued tickets, and those that have been given a slot
+    _cond = Condition()
+    _waiting = set()
+    _admitted = set()
+    _pid = None
+    _reaped = 0
+
+    @staticmethod
+    def _connect():
+        if getattr(ISISScheduler._LOCAL, "pid", None) != getpid():
+            db = sqlite3.connect(
+                path_join(ISISServerConfig.data_dir(), _SCHEDULER_FILE),
+                timeout=30,
+                isolation_level=None
+            )
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            # Queues from before members were tracked
+            columns = {row[1] for row in db.execute("PRAGMA table_info(tickets)")}
+            if "member" not in columns:
+                db.execute("ALTER TABLE tickets ADD COLUMN member TEXT NOT NULL DEFAULT ''")
+                db.execute("ALTER TABLE tickets ADD COLUMN member_tag REAL NOT NULL DEFAULT 0")
+            ISISScheduler._LOCAL.db = db
+            ISISScheduler._LOCAL.pid = getpid()
+        return ISISScheduler._LOCAL.db
+
+    @staticmethod
+    @contextmanager
+    def _transaction():
+        # Immediate, so workers queueing and starting jobs take turns
+        db = ISISScheduler._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    @staticmethod
+    def client():
+        # Who a request's jobs are queued for, and the member of that client
+        # it named. Only a token proves a namespace, so without tokens
+        # clients are told apart by host.
+        if not has_request_context():
+            return "server", ""
+
+        if ISISServerConfig.namespace_tokens() is not None:
+            client = g.get("namespace")
+        else:
+            client = request.remote_addr
+        return client or "anonymous", request.headers.get(ISISScheduler.HEADER) or ""
+
+    @staticmethod
+    def lane(body):
+        # Jobs whose results go to a callback are batch work unless they say
+        # otherwise
+        lane = body.get("priority")
+        if lane is None:
+            return "batch" if body.get("callback") is not None else "interactive"
+        if lane not in LANES:
+            raise ValueError("Unknown priority '{}', expected one of {}".format(
+                lane,
+                ", ".join(LANES)
+            ))
+        return lane
+
+    @staticmethod
+    @contextmanager
+    def slot(lane, client):
+        # Holds one of the slots while the block runs, after waiting its
+        # turn. client is a (client, member) pair from client().
+        client, member = client
+        ticket = ISISScheduler._enqueue(LANES.index(lane), client, member)
+        try:
+            with tracing.span("isis.queue", **{
+                "queue.lane": lane,
+                "queue.client": client,
+                "queue.member": member
+            }):
+                ISISScheduler._wait(ticket)
+            yield
+        finally:
+            ISISScheduler._release(ticket)
+
+    @staticmethod
+    def _next_tag(db, lane, table, key, key_values, vtime, weight):
+        # Start-time fair queuing: the later of the virtual time and the
+        # previous finish tag, which moves on by 1/weight
+        finish = db.execute(
+            "SELECT tag FROM {} WHERE lane = ? AND {}".format(
+                table,
+                " AND ".join("{} = ?".format(k) for k in key)
+            ),
+            (lane, *key_values)
+        ).fetchone()
+        tag = max(vtime, finish[0] if finish else 0.0)
+        db.execute(
+            "INSERT OR REPLACE INTO {} VALUES (?, {}, ?)".format(table, ", ".join("?" for _ in key)),
+            (lane, *key_values, tag + 1 / weight)
+        )
+        return tag
+
+    @staticmethod
+    def _enqueue(lane, client, member):
+        weight = ISISServerConfig.client_weights().get(client, 1.0)
+        with ISISScheduler._transaction() as db:
+            # Servers can keep scripts flooding the interactive lane to their
+            # first few jobs in it
+            interactive_limit = ISISServerConfig.interactive_limit()
+            if lane == 0 and interactive_limit is not None:
+                interactive, = db.execute(
+                    "SELECT COUNT(*) FROM tickets WHERE lane = 0 AND client = ?",
+                    (client,)
+                ).fetchone()
+                if interactive >= interactive_limit:
+                    lane = LANES.index("batch")
+
+            vtime = db.execute("SELECT vtime FROM lanes WHERE lane = ?", (lane,)).fetchone()
+            tag = ISISScheduler._next_tag(
+                db, lane, "finish_tags", ["client"], [client], vtime[0] if vtime else 0.0, weight
+            )
+
+            client_vtime = db.execute(
+                "SELECT vtime FROM clients WHERE lane = ? AND client = ?",
+                (lane, client)
+            ).fetchone()
+            member_tag = ISISScheduler._next_tag(
+                db, lane, "member_tags", ["client", "member"], [client, member],
+                client_vtime[0] if client_vtime else 0.0, 1.0
+            )
+
+            ticket = db.execute(
+                "INSERT INTO tickets (lane, client, tag, enqueued, pid, member, member_tag) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (lane, client, tag, time(), getpid(), member, member_tag)
+            ).lastrowid
+
+        with ISISScheduler._cond:
+            ISISScheduler._waiting.add(ticket)
+            # Threads don't survive a fork, so each worker starts its own
+            if ISISScheduler._pid != getpid():
+                ISISScheduler._pid = getpid()
+                Thread(target=ISISScheduler._poll, daemon=True).start()
+        return ticket
+
+    @staticmethod
+    def _wait(ticket):
+        # Starts straight away if there's a free slot
+        ISISScheduler._dispatch()
+        with ISISScheduler._cond:
+            while ticket not in ISISScheduler._admitted:
+                ISISScheduler._cond.wait()
+            ISISScheduler._admitted.discard(ticket)
+            ISISScheduler._waiting.discard(ticket)
+
+    @staticmethod
+    def _release(ticket):
+        with ISISScheduler._cond:
+            ISISScheduler._waiting.discard(ticket)
+            ISISScheduler._admitted.discard(ticket)
+        with ISISScheduler._transaction() as db:
+            db.execute("DELETE FROM tickets WHERE ticket = ?", (ticket,))
+
+        # The freed slot goes to whoever's next
+        ISISScheduler._dispatch()
+
+    @staticmethod
+    def _poll():
+        while True:
+            sleep(ISISScheduler.POLL_INTERVAL)
+            if not ISISScheduler._waiting:
+                continue
+            try:
+                ISISScheduler._dispatch()
+            except Exception as e:
+                ISISScheduler._LOGGER.error("Dispatching queued jobs failed: {}".format(e))
+
+    @staticmethod
+    def _dispatch():
+        # Gives free slots to the next queued jobs, whichever worker they're
+        # in, then wakes this worker's jobs that were given one
+        now = time()
+        with ISISScheduler._transaction() as db:
+            if now - ISISScheduler._reaped > ISISScheduler._REAP_INTERVAL:
+                ISISScheduler._reaped = now
+                for pid, in db.execute("SELECT DISTINCT pid FROM tickets").fetchall():
+                    if not _alive(pid):
+                        db.execute("DELETE FROM tickets WHERE pid = ?", (pid,))
+                        ISISScheduler._LOGGER.warning("Freed slots held by worker {}".format(pid))
+
+            running, = db.execute("SELECT COUNT(*) FROM tickets WHERE admitted IS NOT NULL").fetchone()
+            for _ in range(ISISServerConfig.job_slots() - running):
+                # The next client's turn goes to its next member, whichever
+                # ticket that is
+                turn = db.execute(
+                    "SELECT ticket, lane, client, tag FROM tickets WHERE admitted IS NULL "
+                    "ORDER BY lane, tag, ticket LIMIT 1"
+                ).fetchone()
+                if turn is None:
+                    break
+                turn_ticket, lane, client, tag = turn
+                ticket, ticket_tag, member_tag, enqueued = db.execute(
+                    "SELECT ticket, tag, member_tag, enqueued FROM tickets "
+                    "WHERE admitted IS NULL AND lane = ? AND client = ? "
+                    "ORDER BY member_tag, ticket LIMIT 1",
+                    (lane, client)
+                ).fetchone()
+
+                # The ticket that started used up the turn, so the one whose
+                # turn it was waits for the started ticket's instead
+                if ticket != turn_ticket:
+                    db.execute("UPDATE tickets SET tag = ? WHERE ticket = ?", (ticket_tag, turn_ticket))
+                db.execute("UPDATE tickets SET admitted = ? WHERE ticket = ?", (now, ticket))
+                db.execute("INSERT OR IGNORE INTO lanes VALUES (?, 0)", (lane,))
+                db.execute("UPDATE lanes SET vtime = MAX(vtime, ?) WHERE lane = ?", (tag, lane))
+                db.execute("INSERT OR IGNORE INTO clients VALUES (?, ?, 0)", (lane, client))
+                db.execute(
+                    "UPDATE clients SET vtime = MAX(vtime, ?) WHERE lane = ? AND client = ?",
+                    (member_tag, lane, client)
+                )
+                db.execute("INSERT INTO waits VALUES (?, ?, ?)", (lane, now, now - enqueued))
+
+            admitted = {
+                ticket for ticket, in db.execute(
+                    "SELECT ticket FROM tickets WHERE pid = ? AND admitted IS NOT NULL",
+                    (getpid(),)
+                )
+            }
+
+        with ISISScheduler._cond:
+            started = (admitted & ISISScheduler._waiting) - ISISScheduler._admitted
+            if started:
+                ISISScheduler._admitted |= started
+                ISISScheduler._cond.notify_all()
+
+    @staticmethod
+    def prune():
+        # Drops wait times outside the window, and finish tags that have
+        # fallen behind their lane, which no longer affect the order
+        with ISISScheduler._transaction() as db:
+            db.execute("DELETE FROM waits WHERE admitted < ?", (time() - ISISScheduler.WAIT_WINDOW,))
+            db.execute(
+                "DELETE FROM finish_tags WHERE tag <= "
+                "(SELECT vtime FROM lanes WHERE lanes.lane = finish_tags.lane)"
+            )
+            db.execute(
+                "DELETE FROM member_tags WHERE tag <= (SELECT vtime FROM clients WHERE "
+                "clients.lane = member_tags.lane AND clients.client = member_tags.client)"
+            )
+            # A client's virtual time only matters while it has jobs or
+            # members ahead of it
+            db.execute(
+                "DELETE FROM clients WHERE NOT EXISTS (SELECT 1 FROM tickets WHERE "
+                "tickets.lane = clients.lane AND tickets.client = clients.client) "
+                "AND NOT EXISTS (SELECT 1 FROM member_tags WHERE "
+                "member_tags.lane = clients.lane AND member_tags.client = clients.client)"
+            )
+
+    @staticmethod
+    def metrics():
+        now = time()
+        db = ISISScheduler._connect()
+        lanes = dict()
+        for lane, name in enumerate(LANES):
+            queued, running, oldest = db.execute(
+                "SELECT COUNT(*) - COUNT(admitted), COUNT(admitted), "
+                "MIN(CASE WHEN admitted IS NULL THEN enqueued END) "
+                "FROM tickets WHERE lane = ?",
+                (lane,)
+            ).fetchone()
+            waits = [row[0] for row in db.execute(
+                "SELECT seconds FROM waits WHERE lane = ? AND admitted >= ? ORDER BY seconds",
+                (lane, now - ISISScheduler.WAIT_WINDOW)
+            )]
+
+            lanes[name] = {
+                "queued": queued,
+                "running": running,
+                "oldest_wait": now - oldest if oldest is not None else 0.0,
+                "wait": {
+                    "jobs": len(waits),
+                    "mean": sum(waits) / len(waits) if waits else 0.0,
+                    "p50": _percentile(waits, 0.5) if waits else 0.0,
+                    "p95": _percentile(waits, 0.95) if waits else 0.0,
+                    "max": waits[-1] if waits else 0.0,
+                },
+            }
+
+        return {
+            "slots": ISISServerConfig.job_slots(),
+            "running": sum(lane["running"] for lane in lanes.values()),
+            "wait_window": ISISScheduler.WAIT_WINDOW,
+            "lanes": lanes,
+        }
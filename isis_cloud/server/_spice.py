@@ -0,0 +1,298 @@
+import json
+from glob import glob
+from hashlib import sha256
+from logging import getLogger
+from os import environ, makedirs, remove, stat as file_stat, utime
+from os.path import basename, join as path_join, normpath
+from time import time
+
+from .. import tracing
+from ..cube import Core, read_label
+from ._cache import atomic_writer
+from ._config import ISISServerConfig
+
+# Kernel databases that decide which kernels spiceinit picks
+_KERNEL_DBS = ["*/kernels/*/*.db", "*/kernels/*.conf"]
+
+# Label groups that identify the raw product a cube was imported from
+_PRODUCT_GROUPS = ["Instrument", "Archive", "BandBin", "Kernels"]
+
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+# Label padding for rewritten cubes, matching ISIS
+_LABEL_BYTES = 65536
+
+
+def _kernel_db_version():
+    digest = sha256()
+    isis_data = environ.get("ISISDATA", "")
+    for pattern in _KERNEL_DBS:
+        for db in sorted(glob(path_join(isis_data, pattern))):
+            stats = file_stat(db)
+            digest.update("{}:{}:{}\n".format(db, stats.st_size, stats.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _object_id(name, value):
+    # Tables are all "Object = Table", told apart by their Name
+    return name, value.get("Name")
+
+
+def _objects(label):
+    return [
+        (name, value)
+        for name, value in label.items()
+        if isinstance(value, dict) and name not in ("IsisCube", "Label")
+    ]
+
+
+def _without_start(value):
+    return {k: v for k, v in value.items() if k != "StartByte"}
+
+
+def _pieces(source, value):
+    # Where an object's blob is read from, as (source, start byte, size)
+    if "StartByte" not in value:
+        return []
+    return [(source, int(value["StartByte"]), int(value["Bytes"]))]
+
+
+def _read_blob(f, value):
+    f.seek(int(value["StartByte"]) - 1)
+    return f.read(int(value["Bytes"]))
+
+
+def _copy_bytes(src, dst, count):
+    while count > 0:
+        chunk = src.read(min(_COPY_CHUNK_SIZE, count))
+        if not chunk:
+            raise ValueError("Unexpected end of cube")
+        dst.write(chunk)
+        count -= len(chunk)
+
+
+class ISISSpiceCache:
+    """
+    Caches what spiceinit attaches to a cube (the Kernels group, NaifKeywords
+    and the SPICE tables) keyed on the raw product, the spiceinit args and
+    the installed kernel databases, so reprocessing the same observation
+    can skip spiceinit. Entries are shared by every namespace. spiceinit's
+    History entry is appended to the cube's own History.
+    """
+    _LOGGER = getLogger("ISISSpiceCache")
+
+    # Entries not used for this long are removed
+    _MAX_AGE = 30 * 24 * 3600
+
+    def __init__(self, args):
+        self.key = None
+        self._file_path = None
+        self._label = None
+        self._digests = dict()
+
+        if "from" not in args or isinstance(args["from"], list):
+            return
+
+        name = normpath(str(args["from"]).split("+")[0])
+        if name.startswith(("/", "..")):
+            return
+
+        self._file_path = path_join(ISISServerConfig.work_dir(), name)
+        try:
+            self._label = read_label(self._file_path)
+            isis_cube = self._label["IsisCube"]
+            Core(self._label)
+        except Exception:
+            return
+
+        if "Instrument" not in isis_cube:
+            return
+
+        product = {g: isis_cube[g] for g in _PRODUCT_GROUPS if g in isis_cube}
+        product["Dimensions"] = isis_cube["Core"]["Dimensions"]
+        product["args"] = {k: v for k, v in args.items() if k != "from"}
+
+        self.key = "{}-{}".format(
+            _kernel_db_version(),
+            sha256(json.dumps(product, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        )
+
+        # Blob contents before spiceinit, to tell which ones it replaced
+        with open(self._file_path, "rb") as f:
+            for name, value in _objects(self._label):
+                if "StartByte" in value:
+                    self._digests[_object_id(name, value)] = sha256(_read_blob(f, value)).digest()
+
+    @staticmethod
+    def _cache_dir():
+        return path_join(ISISServerConfig.data_dir(), ".spice")
+
+    def _entry_path(self, suffix):
+        return path_join(ISISSpiceCache._cache_dir(), "{}.{}".format(self.key, suffix))
+
+    def store(self):
+        if self.key is None:
+            return
+
+        try:
+            with tracing.span("isis.spice.store", **{"cube.file": basename(self._file_path)}):
+                self._store()
+        except (OSError, ValueError) as e:
+            ISISSpiceCache._LOGGER.warning(
+                "Couldn't cache SPICE for {}: {}".format(basename(self._file_path), e)
+            )
+
+    def _store(self):
+        # Deferred like in the cube module, it's only needed once a cube is
+        # spiceinit'd
+        from pvl import PVLModule, PVLObject, dumps as pvl_dumps
+        from pvl.encoder import ISISEncoder
+
+        label = read_label(self._file_path)
+        entry = PVLModule([("IsisCube", PVLObject())])
+        for name, value in label["IsisCube"].items():
+            if name != "Core" and self._label["IsisCube"].get(name) != value:
+                entry["IsisCube"].append(name, value)
+
+        previous = {_object_id(n, v): _without_start(v) for n, v in _objects(self._label)}
+
+        makedirs(ISISSpiceCache._cache_dir(), mode=0o700, exist_ok=True)
+        with open(self._file_path, "rb") as f, atomic_writer(self._entry_path("blobs")) as blobs:
+            next_byte = 1
+            for name, value in _objects(label):
+                object_id = _object_id(name, value)
+                blob = _read_blob(f, value) if "StartByte" in value else None
+
+                unchanged = previous.get(object_id) == _without_start(value) and (
+                    blob is None or
+                    self._digests.get(object_id) == sha256(blob).digest()
+                )
+                if unchanged:
+                    continue
+
+                value = PVLObject(value)
+                if name == "History" and blob is not None:
+                    # Only spiceinit's own entry is kept, for the History of
+                    # the cube it's attached to
+                    if object_id in self._digests:
+                        before = int(previous[object_id]["Bytes"])
+                        if sha256(blob[:before]).digest() != self._digests[object_id]:
+                            raise ValueError("spiceinit rewrote the cube's History")
+                        blob = blob[before:]
+                        value["Bytes"] = len(blob)
+                    value["Appended"] = True
+
+                if blob is not None:
+                    value["StartByte"] = next_byte
+                    next_byte += len(blob)
+                    blobs.write(blob)
+                entry.append(name, value)
+
+        # The label is written last, so an entry only exists once complete
+        with atomic_writer(self._entry_path("lbl"), "w") as f:
+            f.write(pvl_dumps(entry, encoder=ISISEncoder()))
+
+        ISISSpiceCache._LOGGER.info("Cached SPICE for {}".format(basename(self._file_path)))
+
+    def attach(self):
+        if self.key is None:
+            return False
+
+        with tracing.span("isis.spice.attach", **{"cube.file": basename(self._file_path)}) as span:
+            attached = self._attach()
+            span.set_attribute("isis.spice.hit", attached)
+        return attached
+
+    def _attach(self):
+        from pvl import PVLModule, PVLObject, dumps as pvl_dumps
+        from pvl.encoder import ISISEncoder
+
+        try:
+            entry = read_label(self._entry_path("lbl"))
+        except Exception:
+            return False
+
+        label = read_label(self._file_path)
+        for name, value in entry["IsisCube"].items():
+            label["IsisCube"][name] = value
+
+        appended = {_object_id(n, v): v for n, v in _objects(entry) if v.get("Appended")}
+        replaced = {_object_id(n, v) for n, v in _objects(entry) if not v.get("Appended")}
+
+        # Each object and the pieces its blob is made of
+        sources = list()
+        for name, value in _objects(label):
+            object_id = _object_id(name, value)
+            if object_id in replaced:
+                continue
+            pieces = _pieces(None, value)
+            if object_id in appended:
+                pieces += _pieces("entry", appended.pop(object_id))
+            sources.append((name, value, pieces))
+        # With no History of the cube's own, spiceinit's is used as it is
+        sources += [
+            (n, v, _pieces("entry", v)) for n, v in _objects(entry)
+            if not v.get("Appended") or _object_id(n, v) in appended
+        ]
+
+        core = Core(label)
+
+        # Grow the label area until the label fits in front of the core
+        label_bytes = core.offset
+        while True:
+            new_label = PVLModule([("IsisCube", label["IsisCube"])])
+            new_label["IsisCube"]["Core"]["StartByte"] = label_bytes + 1
+
+            blobs = list()
+            next_byte = label_bytes + core.nbytes + 1
+            for name, value, pieces in sources:
+                value = PVLObject((k, v) for k, v in value.items() if k != "Appended")
+                if pieces:
+                    blobs.extend(pieces)
+                    value["StartByte"] = next_byte
+                    value["Bytes"] = sum(size for _, _, size in pieces)
+                    next_byte += value["Bytes"]
+                new_label.append(name, value)
+
+            new_label.append("Label", PVLObject([("Bytes", label_bytes)]))
+            label_text = pvl_dumps(new_label, encoder=ISISEncoder()).encode("utf-8")
+            if len(label_text) <= label_bytes:
+                break
+            label_bytes = -(-len(label_text) // _LABEL_BYTES) * _LABEL_BYTES
+
+        with open(self._file_path, "rb") as cube, \
+                open(self._entry_path("blobs"), "rb") as entry_blobs, \
+                atomic_writer(self._file_path) as f:
+            f.write(label_text)
+            f.write(bytes(label_bytes - len(label_text)))
+
+            cube.seek(core.offset)
+            _copy_bytes(cube, f, core.nbytes)
+
+            for source, start_byte, size in blobs:
+                src = entry_blobs if source == "entry" else cube
+                src.seek(start_byte - 1)
+                _copy_bytes(src, f, size)
+
+        # Entries in use are kept by prune
+        utime(self._entry_path("lbl"))
+
+        ISISSpiceCache._LOGGER.info("Attached cached SPICE to {}".format(basename(self._file_path)))
+        return True
+
+    @staticmethod
+    def prune():
+        # Entries for other kernel databases can no longer be hit
+        version = _kernel_db_version()
+        now = time()
+        for entry in glob(path_join(ISISSpiceCache._cache_dir(), "*.lbl")):
+            try:
+                stale = (
+                    not basename(entry).startswith(version) or
+                    now - file_stat(entry).st_mtime > ISISSpiceCache._MAX_AGE
+                )
+                if stale:
+                    remove(entry)
+                    remove("{}.blobs".format(entry[:-len(".lbl")]))
+            except OSError:
+                continue
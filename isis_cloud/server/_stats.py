@@ -0,0 +1,158 @@
+import json
+from logging import getLogger
+
+import numpy as np
+
+from ..cube import Cube
+from ._cache import atomic_writer, file_identity, sidecar_path
+
+logger = getLogger("Stats")
+
+PERCENTILES = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+
+_SPECIAL_PIXEL_KEYS = (
+    "NullPixels",
+    "LrsPixels",
+    "LisPixels",
+    "HisPixels",
+    "HrsPixels"
+)
+
+
+class _StreamingHistogram:
+    # A fixed number of bins whose range doubles whenever a value falls
+    # outside it. Doubling merges neighbouring bins so the counts stay exact
+    # at the new resolution, which keeps memory constant in a single pass.
+    _BINS = 4096
+
+    def __init__(self):
+        self._counts = np.zeros(_StreamingHistogram._BINS, dtype=np.int64)
+        self._low = None
+        self._width = None
+
+    def _grow(self, downward):
+        merged = self._counts.reshape(-1, 2).sum(axis=1)
+        empty = np.zeros(merged.size, dtype=np.int64)
+
+        if downward:
+            self._counts = np.concatenate([empty, merged])
+            self._low -= self._width
+        else:
+            self._counts = np.concatenate([merged, empty])
+
+        self._width *= 2
+
+    def add(self, values):
+        if values.size == 0:
+            return
+
+        low, high = values.min(), values.max()
+        if self._low is None:
+            self._low = low
+            self._width = (high - low) * 1.001 or max(abs(low), 1.0) * 1e-6
+
+        while low < self._low:
+            self._grow(downward=True)
+        while high >= self._low + self._width:
+            self._grow(downward=False)
+
+        bin_width = self._width / _StreamingHistogram._BINS
+        bins = ((values - self._low) / bin_width).astype(np.int64)
+        np.clip(bins, 0, _StreamingHistogram._BINS - 1, out=bins)
+        self._counts += np.bincount(bins, minlength=_StreamingHistogram._BINS)
+
+    def percentile(self, percent, minimum, maximum):
+        cumulative = np.cumsum(self._counts)
+        target = percent / 100.0 * cumulative[-1]
+        idx = int(np.searchsorted(cumulative, target))
+
+        # Interpolate within the bin the target falls in
+        below = cumulative[idx - 1] if idx > 0 else 0
+        fraction = (target - below) / max(self._counts[idx], 1)
+        bin_width = self._width / _StreamingHistogram._BINS
+        value = self._low + (idx + fraction) * bin_width
+
+        return float(min(max(value, minimum), maximum))
+
+
+def _compute_stats(cube, band):
+    total = 0
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    minimum = np.inf
+    maximum = -np.inf
+    specials = np.zeros(len(_SPECIAL_PIXEL_KEYS) + 1, dtype=np.int64)
+    histogram = _StreamingHistogram()
+
+    for raw in cube.iter_chunks(band):
+        codes = cube.special_codes(raw)
+        specials += np.bincount(codes.ravel(), minlength=specials.size)
+        total += raw.size
+
+        values = raw[codes == Cube.VALID].astype(np.float64)
+        values = values * cube.core.multiplier + cube.core.base
+        if values.size == 0:
+            continue
+
+        # Merge each chunk's moments into the running totals (Chan et al.)
+        chunk_mean = values.mean()
+        chunk_m2 = np.square(values - chunk_mean).sum()
+        delta = chunk_mean - mean
+        merged = count + values.size
+        mean += delta * values.size / merged
+        m2 += chunk_m2 + delta * delta * count * values.size / merged
+        count = merged
+
+        minimum = min(minimum, values.min())
+        maximum = max(maximum, values.max())
+        histogram.add(values)
+
+    stats = {
+        "Band": band + 1,
+        "TotalPixels": total,
+        "ValidPixels": count,
+    }
+    stats.update({
+        key: int(specials[code])
+        for code, key in enumerate(_SPECIAL_PIXEL_KEYS, 1)
+    })
+
+    if count == 0:
+        return stats
+
+    variance = m2 / (count - 1) if count > 1 else 0.0
+    stats.update({
+        "Minimum": float(minimum),
+        "Maximum": float(maximum),
+        "Average": float(mean),
+        "StandardDeviation": float(np.sqrt(variance)),
+        "Variance": float(variance),
+        "Percentiles": {
+            str(p): histogram.percentile(p, minimum, maximum)
+            for p in PERCENTILES
+        }
+    })
+    return stats
+
+
+def cube_stats(file_path, label, band):
+    stats_file = sidecar_path(file_path, "band{}.stats.json".format(band))
+    identity = list(file_identity(file_path))
+
+    try:
+        with open(stats_file) as f:
+            cached = json.load(f)
+        if cached["identity"] == identity:
+            return cached["stats"]
+    except (OSError, KeyError, ValueError):
+        pass
+
+    logger.info("Computing band {} statistics for {}".format(band, file_path))
+    with Cube(file_path, label) as cube:
+        stats = _compute_stats(cube, band - 1)
+
+    with atomic_writer(stats_file, mode="w") as f:
+        json.dump({"identity": identity, "stats": stats}, f)
+
+    return stats
@@ -0,0 +1,317 @@
+import json
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX
+from logging import getLogger
+from os import getpid, kill, makedirs, remove, replace, stat as file_stat, symlink, walk
+from os.path import (
+    dirname, getsize, isabs, isdir, isfile, islink, join as path_join, lexists, normpath,
+    realpath, relpath, sep, splitext
+)
+from shutil import copy2, disk_usage
+from threading import get_ident
+from time import time
+from uuid import uuid4
+
+from ._config import ISISServerConfig
+
+# Scratch files modified more recently than this may still be being written,
+# so they're left alone by the background sweep
+_SETTLE_TIME = 60
+
+# Space held on scratch for files still to be written, by every worker
+_RESERVATIONS_FILE = ".reservations.json"
+
+
+def _alive(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ISISStorage:
+    """
+    Two storage tiers. The work dirs under DATA_DIR are durable, and
+    SCRATCH_DIR is a fast local tier for files that don't outlive their
+    jobs by long. Files on scratch appear in the work dir as symlinks, so
+    they're read, written and listed by name like any other file, and are
+    promoted to the durable tier when retained or when scratch runs low.
+    """
+    _LOGGER = getLogger("ISISStorage")
+
+    @staticmethod
+    def scratch_dir(work_dir=None):
+        # Mirrors the work dir's place under DATA_DIR, so namespaces stay
+        # apart on scratch too
+        root = ISISServerConfig.scratch_dir()
+        if root is None:
+            return None
+
+        work_dir = work_dir or ISISServerConfig.work_dir()
+        return normpath(path_join(
+            root,
+            "isis-scratch",
+            relpath(work_dir, ISISServerConfig.data_dir())
+        ))
+
+    @staticmethod
+    def work_path(name, work_dir=None):
+        """
+        The path of a work dir file by name, on whichever tier it is. None
+        for names outside the work dir or in its hidden dirs, which hold
+        other namespaces and the server's own state.
+        """
+        name = normpath(name.strip("/"))
+        if any(part.startswith(".") for part in name.split(sep)):
+            return None
+
+        work_dir = work_dir or ISISServerConfig.work_dir()
+        file_path = path_join(work_dir, name)
+
+        # Links may only lead to this work dir's files, or their scratch
+        # copies
+        roots = [work_dir]
+        if ISISStorage.scratch_dir(work_dir) is not None:
+            roots.append(ISISStorage.scratch_dir(work_dir))
+        target = realpath(file_path)
+        for root in roots:
+            root = realpath(root)
+            if target.startswith(root + sep) and not any(
+                part.startswith(".") for part in relpath(target, root).split(sep)
+            ):
+                return file_path
+        return None
+
+    @staticmethod
+    @contextmanager
+    def _reservations():
+        # Locked so concurrent workers see each other's reservations
+        root = path_join(ISISServerConfig.scratch_dir(), "isis-scratch")
+        makedirs(root, exist_ok=True)
+        with open(path_join(root, _RESERVATIONS_FILE), "a+") as f:
+            flock(f, LOCK_EX)
+            f.seek(0)
+            try:
+                reservations = json.loads(f.read())
+            except ValueError:
+                reservations = dict()
+
+            # Workers that died don't hold space
+            reservations = {k: v for k, v in reservations.items() if _alive(v["pid"])}
+            yield reservations
+
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(reservations))
+
+    @staticmethod
+    def _fits(needed, reservations):
+        try:
+            usage = disk_usage(ISISServerConfig.scratch_dir())
+        except OSError:
+            return False
+
+        reserved = sum(r["bytes"] for r in reservations.values())
+        return usage.free - reserved - needed > usage.total * ISISServerConfig.scratch_min_free()
+
+    @staticmethod
+    def has_room(needed=0):
+        root = ISISServerConfig.scratch_dir()
+        if root is None or not isdir(root):
+            return False
+
+        with ISISStorage._reservations() as reservations:
+            return ISISStorage._fits(needed, reservations)
+
+    @staticmethod
+    @contextmanager
+    def reserve(needed):
+        """
+        Holds needed bytes of scratch while the block runs, if they fit
+        alongside what's already held, for files that are written a while
+        after the space is checked. Yields whether they were reserved.
+        """
+        root = ISISServerConfig.scratch_dir()
+        if root is None or not isdir(root) or needed is None:
+            yield False
+            return
+
+        reservation = uuid4().hex
+        with ISISStorage._reservations() as reservations:
+            reserved = ISISStorage._fits(needed, reservations)
+            if reserved:
+                reservations[reservation] = {"bytes": needed, "pid": getpid()}
+
+        try:
+            yield reserved
+        finally:
+            if reserved:
+                with ISISStorage._reservations() as reservations:
+                    reservations.pop(reservation, None)
+
+    @staticmethod
+    def is_scratch(file_path):
+        scratch = ISISServerConfig.scratch_dir()
+        return (
+            scratch is not None and
+            islink(file_path) and
+            realpath(file_path).startswith(realpath(scratch) + sep)
+        )
+
+    @staticmethod
+    def _input_size(program, args, work_dir):
+        # What a job's outputs are expected to take: ISIS programs mostly
+        # write cubes about the size of what they read
+        input_params = {
+            p["name"] for p in program.definition["parameters"]
+            if p["file_mode"] == "input"
+        }
+
+        size = 0
+        for k, v in args.items():
+            if k.lower() not in input_params or not isinstance(v, str):
+                continue
+            # Remotes are fetched to absolute paths
+            file_path = v.split("+")[0]
+            if not isabs(file_path):
+                file_path = path_join(work_dir, file_path)
+            if isfile(file_path):
+                size += getsize(file_path)
+        return size
+
+    @staticmethod
+    def redirect_outputs(program, args, ttl, retain=False):
+        """
+        Points a job's output args at scratch when its outputs are short
+        lived and there's room for them, going by the size of its inputs.
+        Returns the args to run with, and the work dir names of the
+        redirected outputs with their scratch paths, to be passed to
+        link_outputs once the job has run.
+        """
+        if (
+            retain or
+            ttl is None or
+            ttl > ISISServerConfig.scratch_max_ttl() or
+            program.definition is None
+        ):
+            return args, dict()
+
+        output_params = {
+            p["name"] for p in program.definition["parameters"]
+            if p["file_mode"] == "output"
+        }
+
+        work_dir = ISISServerConfig.work_dir()
+        outputs = [k for k, v in args.items() if k.lower() in output_params and isinstance(v, str)]
+        if not outputs or not ISISStorage.has_room(
+            len(outputs) * ISISStorage._input_size(program, args, work_dir)
+        ):
+            return args, dict()
+
+        scratch = ISISStorage.scratch_dir()
+        run_args = dict(args)
+        redirected = dict()
+        for k, v in args.items():
+            if k.lower() not in output_params or not isinstance(v, str):
+                continue
+
+            # Keep ISIS cube attributes, e.g. out.cub+8bit
+            name, plus, attributes = v.partition("+")
+            name = normpath(name)
+            if name.startswith(("/", "..")) or lexists(path_join(work_dir, name)):
+                continue
+
+            scratch_path = path_join(scratch, name)
+            makedirs(dirname(scratch_path), exist_ok=True)
+            run_args[k] = scratch_path + plus + attributes
+            redirected[name] = scratch_path
+
+        return run_args, redirected
+
+    @staticmethod
+    def link_outputs(redirected):
+        work_dir = ISISServerConfig.work_dir()
+        for name, scratch_path in redirected.items():
+            targets = [(name, scratch_path)]
+            # ISIS adds .cub to cube names given without an extension
+            if splitext(name)[1] == "":
+                targets.append(("{}.cub".format(name), "{}.cub".format(scratch_path)))
+
+            for target_name, target_path in targets:
+                if lexists(target_path):
+                    ISISStorage._link(path_join(work_dir, target_name), target_path)
+
+    @staticmethod
+    def _link(file_path, target_path):
+        makedirs(dirname(file_path), exist_ok=True)
+        tmp_link = "{}.{}.{}.tmp".format(file_path, getpid(), get_ident())
+        symlink(target_path, tmp_link)
+        replace(tmp_link, file_path)
+
+    @staticmethod
+    def promote(file_path):
+        # Moves a scratch file to the durable tier. Its mtime is kept, so
+        # job expiry still recognises it.
+        if not ISISStorage.is_scratch(file_path):
+            return False
+
+        target_path = realpath(file_path)
+        tmp_file = "{}.{}.{}.tmp".format(file_path, getpid(), get_ident())
+        try:
+            copy2(target_path, tmp_file)
+            replace(tmp_file, file_path)
+        except BaseException:
+            if lexists(tmp_file):
+                remove(tmp_file)
+            raise
+
+        remove(target_path)
+        ISISStorage._LOGGER.info("Promoted {} to durable storage".format(file_path))
+        return True
+
+    @staticmethod
+    def remove(file_path):
+        # Removes a file from whichever tier it's on
+        if ISISStorage.is_scratch(file_path):
+            try:
+                remove(realpath(file_path))
+            except OSError:
+                pass
+        remove(file_path)
+
+    @staticmethod
+    def rebalance():
+        # Removes scratch files no work dir links to, e.g. from failed jobs,
+        # then promotes the oldest linked ones until scratch has room again
+        if ISISServerConfig.scratch_dir() is None:
+            return
+
+        now = time()
+        linked = list()
+        for work_dir in ISISServerConfig.work_dirs():
+            scratch = ISISStorage.scratch_dir(work_dir)
+            for root, dirs, files in walk(scratch):
+                # Skips workflow intermediates and other namespaces
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                for file in files:
+                    scratch_path = path_join(root, file)
+                    link = path_join(work_dir, relpath(scratch_path, scratch))
+                    try:
+                        mtime = file_stat(scratch_path).st_mtime
+                        if islink(link) and realpath(link) == realpath(scratch_path):
+                            linked.append((mtime, link))
+                        elif now - mtime > _SETTLE_TIME:
+                            remove(scratch_path)
+                    except OSError:
+                        continue
+
+        for mtime, link in sorted(linked):
+            if ISISStorage.has_room() or now - mtime < _SETTLE_TIME:
+                break
+            try:
+                ISISStorage.promote(link)
+            except OSError as e:
+                ISISStorage._LOGGER.warning("Couldn't promote {}: {}".format(link, e))
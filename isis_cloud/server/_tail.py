@@ -0,0 +1,224 @@
+import json
+import struct
+from glob import glob
+from contextlib import contextmanager
+from hashlib import blake2b, sha1
+from os import getpid, kill, makedirs, remove
+from os.path import dirname, join as path_join, normpath, splitext
+from time import sleep
+
+from ._cache import atomic_writer
+
+MIMETYPE = "application/x-isis-tail"
+
+# Each frame is an offset and a length, then that many bytes to write at
+# the offset. A frame with no bytes ends the stream, and its offset is the
+# file's final size. The error frame's bytes are a message instead.
+_FRAME = struct.Struct(">QQ")
+ERROR_OFFSET = 2 ** 64 - 1
+
+# Bytes are sent in, and checked against the final file in, blocks of 1MiB
+_BLOCK_SIZE = 1024 * 1024
+
+# How often a file being written is checked for new bytes
+POLL_INTERVAL = 0.2
+
+
+def _producing_dir(work_dir):
+    return path_join(work_dir, ".producing")
+
+
+def _entry_path(work_dir, name):
+    # One entry per name, so looking a file up doesn't scan every job
+    return path_join(
+        _producing_dir(work_dir),
+        "{}.json".format(sha1(name.encode("utf-8")).hexdigest())
+    )
+
+
+def _job_path(work_dir, job_id):
+    return path_join(_producing_dir(work_dir), "jobs", "{}.json".format(job_id))
+
+
+def _alive(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _digest(data):
+    return blake2b(data, digest_size=16).digest()
+
+
+def output_paths(program, args, redirected, work_dir):
+    # The work dir names of a job's outputs, and where they're written
+    if program.definition is None:
+        return dict()
+
+    output_params = {
+        p["name"] for p in program.definition["parameters"]
+        if p["file_mode"] == "output"
+    }
+
+    outputs = dict()
+    for k, v in args.items():
+        if k.lower() not in output_params or not isinstance(v, str):
+            continue
+
+        # Drop ISIS cube attributes, e.g. out.cub+8bit
+        name = normpath(v.split("+")[0])
+        if name.startswith(("/", "..")):
+            continue
+
+        outputs[name] = redirected.get(name, path_join(work_dir, name))
+        # ISIS adds .cub to cube names given without an extension
+        if splitext(name)[1] == "":
+            outputs["{}.cub".format(name)] = "{}.cub".format(outputs[name])
+
+    return outputs
+
+
+@contextmanager
+def producing(job_id, outputs, work_dir):
+    """
+    Marks the job as running, and its outputs, from output_paths, as being
+    written by it, while the block runs, so they can be tailed. The marks
+    are on disk so a tail in any worker sees them.
+    """
+    written = list()
+    job_path = _job_path(work_dir, job_id)
+    try:
+        # Tails of outputs that aren't known up front wait on the job
+        makedirs(dirname(job_path), exist_ok=True)
+        with atomic_writer(job_path, "w") as f:
+            json.dump({"pid": getpid()}, f)
+        for name, file_path in outputs.items():
+            with atomic_writer(_entry_path(work_dir, name), "w") as f:
+                json.dump({"job_id": job_id, "path": file_path, "pid": getpid()}, f)
+            written.append(name)
+        yield
+    finally:
+        for name in written:
+            entry_path = _entry_path(work_dir, name)
+            # A later job may have taken the name over
+            if (producer(name, work_dir) or dict()).get("job_id") == job_id:
+                try:
+                    remove(entry_path)
+                except FileNotFoundError:
+                    pass
+        try:
+            remove(job_path)
+        except FileNotFoundError:
+            pass
+
+
+def job_running(job_id, work_dir):
+    # Whether the job is between starting and finishing in any worker
+    try:
+        with open(_job_path(work_dir, job_id)) as f:
+            return _alive(json.load(f)["pid"])
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def producer(name, work_dir):
+    # The running job writing name, None if there isn't one
+    try:
+        with open(_entry_path(work_dir, name)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not _alive(entry["pid"]):
+        return None
+    return entry
+
+
+def expire_producers(work_dirs):
+    # Drops marks left by workers that died mid-job
+    for work_dir in work_dirs:
+        for entry_path in [
+            *glob(path_join(_producing_dir(work_dir), "*.json")),
+            *glob(path_join(_producing_dir(work_dir), "jobs", "*.json"))
+        ]:
+            try:
+                with open(entry_path) as f:
+                    pid = json.load(f)["pid"]
+                if not _alive(pid):
+                    remove(entry_path)
+            except (OSError, ValueError, KeyError):
+                continue
+
+
+def _frame(offset, data=b""):
+    return _FRAME.pack(offset, len(data)) + data
+
+
+def tail_stream(name, work_dir):
+    """
+    Streams a file as frames while a job writes it, and finishes once the
+    job has. Programs rewrite a cube's label when they close it, and may
+    write other parts out of order, so every block that was sent is checked
+    against the finished file and sent again if it changed.
+    """
+    sent = 0
+    digests = list()
+    block = blake2b(digest_size=16)
+
+    while True:
+        entry = producer(name, work_dir)
+        file_path = entry["path"] if entry is not None else path_join(work_dir, name)
+
+        try:
+            with open(file_path, "rb") as f:
+                f.seek(sent)
+                while True:
+                    # Reads stop at block boundaries so each block's digest
+                    # covers exactly its bytes
+                    chunk = f.read(_BLOCK_SIZE - sent % _BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    yield _frame(sent, chunk)
+                    block.update(chunk)
+                    sent += len(chunk)
+                    if sent % _BLOCK_SIZE == 0:
+                        digests.append(block.digest())
+                        block = blake2b(digest_size=16)
+        except FileNotFoundError:
+            # Not created yet, or the job failed before writing it
+            if entry is None:
+                yield _frame(ERROR_OFFSET, "'{}' wasn't written".format(name).encode("utf-8"))
+                return
+
+        if entry is None:
+            break
+        sleep(POLL_INTERVAL)
+
+    if sent % _BLOCK_SIZE:
+        digests.append(block.digest())
+
+    # The job has finished, so this is the final file
+    try:
+        f = open(path_join(work_dir, name), "rb")
+    except FileNotFoundError:
+        yield _frame(ERROR_OFFSET, "'{}' was removed".format(name).encode("utf-8"))
+        return
+
+    with f:
+        for i, digest in enumerate(digests):
+            f.seek(i * _BLOCK_SIZE)
+            data = f.read(min(_BLOCK_SIZE, sent - i * _BLOCK_SIZE))
+            if data and _digest(data) != digest:
+                yield _frame(i * _BLOCK_SIZE, data)
+
+        size = f.seek(0, 2)
+        # Anything written between the last read and the job ending
+        f.seek(sent)
+        for chunk in iter(lambda: f.read(_BLOCK_SIZE), b""):
+            yield _frame(f.tell() - len(chunk), chunk)
+
+    yield _frame(size)
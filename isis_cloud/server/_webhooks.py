@@ -0,0 +1,245 @@
+import hmac
+import json
+from glob import glob
+from hashlib import sha256
+from logging import getLogger
+from os import makedirs, remove, rename, stat as file_stat
+from os.path import commonpath, join as path_join, realpath
+from socket import socket, AF_UNIX, SOCK_STREAM
+from threading import Thread
+from time import time
+from urllib.parse import urlparse
+from urllib.request import HTTPRedirectHandler, Request, build_opener
+from uuid import uuid4
+
+from flask import copy_current_request_context, g
+
+from .. import tracing
+from ._cache import atomic_writer
+from ._config import ISISServerConfig
+from ._namespaces import QuotaExceeded
+
+_SCHEMES = ("http", "https", "unix")
+
+# Seconds to wait on a receiver
+_DELIVERY_TIMEOUT = 10
+
+
+def sign(secret, timestamp, body):
+    # Receivers recompute this over the raw body to check the sender and
+    # reject replays with old timestamps
+    return hmac.new(
+        secret.encode("utf-8"),
+        "{}.".format(timestamp).encode("utf-8") + body,
+        sha256
+    ).hexdigest()
+
+
+class _NoRedirects(HTTPRedirectHandler):
+    # A redirect could lead a callback to a host that isn't allowed
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_OPENER = build_opener(_NoRedirects)
+
+
+def _allowed(url):
+    # Callbacks only reach the hosts and sockets the operator allows, so a
+    # client can't have the server write to internal services
+    if url.startswith("unix://"):
+        socket_dir = ISISServerConfig.webhook_socket_dir()
+        if socket_dir is None:
+            return False
+        socket_dir = realpath(socket_dir)
+        socket_path = realpath(url[len("unix://"):])
+        return socket_path != socket_dir and commonpath([socket_dir, socket_path]) == socket_dir
+
+    return (urlparse(url).hostname or "").lower() in ISISServerConfig.webhook_hosts()
+
+
+def _deliver(url, secret, payload):
+    # Checked again, as the allowed callbacks may have changed since
+    if not _allowed(url):
+        raise ValueError("Callbacks to {} aren't allowed".format(url))
+
+    body = json.dumps(payload).encode("utf-8")
+    timestamp = str(int(time()))
+    signature = "sha256={}".format(sign(secret, timestamp, body))
+
+    if url.startswith("unix://"):
+        # One JSON line per notification, with the signed body as a string
+        message = json.dumps({
+            "timestamp": timestamp,
+            "signature": signature,
+            "body": body.decode("utf-8"),
+        })
+        with socket(AF_UNIX, SOCK_STREAM) as s:
+            s.settimeout(_DELIVERY_TIMEOUT)
+            s.connect(url[len("unix://"):])
+            s.sendall(message.encode("utf-8") + b"\n")
+        return
+
+    request = Request(url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "X-ISIS-Timestamp": timestamp,
+        "X-ISIS-Signature": signature,
+    })
+    # Anything but a 2xx raises
+    with _OPENER.open(request, timeout=_DELIVERY_TIMEOUT):
+        pass
+
+
+class ISISWebhooks:
+    """
+    Job completion notifications. Each one is written to an outbox in the
+    job's work dir before it is first sent, and stays there until a
+    delivery succeeds, so none are lost to failures or restarts.
+    """
+    _LOGGER = getLogger("ISISWebhooks")
+
+    # How often the outbox is checked for retries
+    RETRY_INTERVAL = 5
+
+    # Delays double from the base up to the cap, about a day in total
+    _BASE_DELAY = 5
+    _MAX_DELAY = 3600
+    _MAX_ATTEMPTS = 30
+
+    # Claims older than this were left by a worker that died mid-delivery
+    _CLAIM_TIMEOUT = 300
+
+    @staticmethod
+    def _outbox_dir(work_dir=None):
+        return path_join(work_dir or ISISServerConfig.work_dir(), ".outbox")
+
+    @staticmethod
+    def validate(callback):
+        # Returns the callback as {"url", "secret"}
+        if isinstance(callback, str):
+            callback = {"url": callback}
+
+        url = callback.get("url", "")
+        if urlparse(url).scheme not in _SCHEMES:
+            raise ValueError("Callback URLs must be one of {}".format(
+                ", ".join("{}://".format(s) for s in _SCHEMES)
+            ))
+        if not _allowed(url):
+            raise ValueError("Callbacks to {} aren't allowed by the server".format(url))
+
+        secret = callback.get("secret") or ISISServerConfig.webhook_secret()
+        if secret is None:
+            raise ValueError("Callbacks need a secret, none is configured on the server")
+
+        return {"url": url, "secret": secret}
+
+    @staticmethod
+    def notify(callback, payload):
+        outbox = ISISWebhooks._outbox_dir()
+        makedirs(outbox, mode=0o700, exist_ok=True)
+
+        entry = {
+            "url": callback["url"],
+            "secret": callback["secret"],
+            "payload": payload,
+            "attempts": 0,
+            "next_attempt": time(),
+        }
+        entry_file = path_join(outbox, "{}.json".format(uuid4().hex))
+        with atomic_writer(entry_file, "w") as f:
+            json.dump(entry, f)
+
+        ISISWebhooks._attempt(entry_file)
+
+    @staticmethod
+    def run_in_background(job_id, program, execute, callback):
+        # Calls execute, which returns a response body and status like a
+        # route, after the request has returned, and notifies the callback
+        # with the result
+        namespace = g.get("namespace")
+
+        @copy_current_request_context
+        @tracing.wrap
+        def run():
+            # The copied request context comes with a fresh g
+            g.namespace = namespace
+            try:
+                with tracing.span("isis.job.background", **{"isis.job_id": job_id}):
+                    response, status = execute()
+            except QuotaExceeded as e:
+                response, status = {"message": str(e)}, 507
+            except Exception as e:
+                ISISWebhooks._LOGGER.exception("Job {} failed".format(job_id))
+                response, status = {"message": str(e)}, 500
+
+            ISISWebhooks.notify(callback, {
+                "job_id": job_id,
+                "program": program,
+                "status": status,
+                **response,
+            })
+
+        Thread(target=run, daemon=True).start()
+
+    @staticmethod
+    def _attempt(entry_file):
+        # Renaming is atomic, so only one worker delivers each entry
+        claimed_file = "{}.claimed".format(entry_file)
+        try:
+            rename(entry_file, claimed_file)
+            with open(claimed_file) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        try:
+            _deliver(entry["url"], entry["secret"], entry["payload"])
+        except Exception as e:
+            entry["attempts"] += 1
+            if entry["attempts"] >= ISISWebhooks._MAX_ATTEMPTS:
+                ISISWebhooks._LOGGER.error("Giving up on {} for job {}: {}".format(
+                    entry["url"],
+                    entry["payload"].get("job_id"),
+                    e
+                ))
+                remove(claimed_file)
+                return
+
+            delay = min(
+                ISISWebhooks._BASE_DELAY * 2 ** (entry["attempts"] - 1),
+                ISISWebhooks._MAX_DELAY
+            )
+            entry["next_attempt"] = time() + delay
+            ISISWebhooks._LOGGER.warning("Delivery to {} failed, retrying in {}s: {}".format(
+                entry["url"],
+                delay,
+                e
+            ))
+
+            with atomic_writer(entry_file, "w") as f:
+                json.dump(entry, f)
+
+        remove(claimed_file)
+
+    @staticmethod
+    def deliver_pending():
+        now = time()
+        for work_dir in ISISServerConfig.work_dirs():
+            outbox = ISISWebhooks._outbox_dir(work_dir)
+
+            for claimed_file in glob(path_join(outbox, "*.json.claimed")):
+                try:
+                    if now - file_stat(claimed_file).st_mtime > ISISWebhooks._CLAIM_TIMEOUT:
+                        rename(claimed_file, claimed_file[:-len(".claimed")])
+                except OSError:
+                    continue
+
+            for entry_file in glob(path_join(outbox, "*.json")):
+                try:
+                    with open(entry_file) as f:
+                        due = json.load(f)["next_attempt"] <= now
+                except (OSError, ValueError):
+                    continue
+
+                if due:
+                    ISISWebhooks._attempt(entry_file)
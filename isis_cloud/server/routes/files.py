@@ -1,42 +1,245 @@
-from flask import request, send_from_directory
-from os.path import exists as path_exists, join as path_join
-from os import makedirs, remove
-from pvl import load as pvl_load
+from flask import Response, request, send_file
+from glob import glob
+from os.path import exists as path_exists, getsize, isfile, join as path_join, normpath, relpath
+from os import makedirs
+from time import sleep, time
 
+from ... import tracing
+from ...cube import read_label
+from .._browse import render_browse
+from .._bundle import MIMETYPES, available_compressions, bundle_stream, tar_size
+from .._cache import remove_sidecars
+from .._catalog import ISISCatalog
+from .._compare import compare_cubes
 from .._config import ISISServerConfig
+from .._jobs import ISISJobs
+from .._namespaces import ISISNamespaces
+from .._pending import ISISPendingJobs
+from .._stats import cube_stats
+from .._storage import ISISStorage
+from .._tail import (
+    MIMETYPE as TAIL_MIMETYPE, POLL_INTERVAL as TAIL_POLL_INTERVAL, job_running, producer,
+    tail_stream
+)
 
 
 def upload_file():
+    return save_uploads()
+
+
+def save_uploads():
+    # Saves the request's files to the work dir under their part names.
+    # Returns an error response for names outside the work dir.
+    with tracing.span("isis.upload", **{
+        "upload.files": len(request.files),
+        "upload.bytes": request.content_length
+    }):
+        return _save_uploads()
+
+
+def _save_uploads():
     if not path_exists(ISISServerConfig.work_dir()):
         makedirs(ISISServerConfig.work_dir(), mode=0o700)
 
+    file_paths = dict()
     for file_name in request.files.keys():
-        file_path = path_join(ISISServerConfig.work_dir(), file_name)
+        file_paths[file_name] = ISISStorage.work_path(file_name)
+        if file_paths[file_name] is None:
+            return {"message": "Invalid file name '{}'".format(file_name)}, 400
+
+    # The request size is an upper bound on what the files will take
+    ISISNamespaces.check(request.content_length or 0, len(request.files))
+
+    for file_name, file_path in file_paths.items():
+        previous_size = getsize(file_path) if isfile(file_path) else None
+
+        # Uploads are kept, so one replacing a scratch file goes to the
+        # durable tier rather than through the link
+        if ISISStorage.is_scratch(file_path):
+            ISISStorage.remove(file_path)
         request.files[file_name].save(file_path)
+        ISISNamespaces.charge(
+            getsize(file_path) - (previous_size or 0),
+            1 if previous_size is None else 0
+        )
+        ISISCatalog.record(normpath(file_name.strip("/")))
+
+
+def list_files(prefix=None, older_than=None, min_size=None, after=None, limit=100):
+    # One extra row tells whether there's another page
+    entries = ISISCatalog.search(prefix, older_than, min_size, after, limit + 1)
+
+    files = list()
+    for entry in entries[:limit]:
+        cube = None
+        if entry["samples"] is not None:
+            cube = {k: entry[k] for k in ["samples", "lines", "bands", "pixel_type"]}
+
+        files.append({
+            "name": entry["name"],
+            "size": entry["size"],
+            "mtime": entry["mtime_ns"] / 1e9,
+            "cube": cube,
+        })
 
+    return {
+        "files": files,
+        "next": files[-1]["name"] if len(entries) > limit else None,
+    }
 
-def retrieve_file(file_name):
-    file_path = path_join(ISISServerConfig.work_dir(), file_name.strip("/"))
-    if not path_exists(file_path):
+
+def retrieve_file(file_name, tail=False, wait=60, job=None):
+    if tail:
+        return _tail_file(normpath(file_name.strip("/")), wait, job)
+
+    file_path = ISISStorage.work_path(file_name)
+    if file_path is None or not path_exists(file_path):
+        return {"message": "File not found"}, 404
+
+    return send_file(file_path)
+
+
+def _tail_file(name, wait, job):
+    work_dir = ISISServerConfig.work_dir()
+    if ISISStorage.work_path(name) is None:
         return {"message": "File not found"}, 404
 
-    return send_from_directory(ISISServerConfig.work_dir(), file_name)
+    # The job that writes it may not have started yet. Clients tailing a
+    # job they've just sent wait for it while it's pending or running,
+    # rather than take an older file of the same name, and get the file as
+    # it stands once the job's finished.
+    deadline = time() + wait
+    while True:
+        entry = producer(name, work_dir)
+        if job is None:
+            if entry is not None or path_exists(path_join(work_dir, name)):
+                break
+        elif entry is not None and entry["job_id"] == job:
+            break
+        elif ISISJobs.get(job) is not None:
+            break
+        elif job_running(job, work_dir) or ISISPendingJobs.exists(job):
+            deadline = time() + wait
+
+        if time() > deadline:
+            return {"message": "File not found"}, 404
+        sleep(TAIL_POLL_INTERVAL)
+
+    return Response(tail_stream(name, work_dir), mimetype=TAIL_MIMETYPE)
 
 
 def retrieve_file_label(file_name):
-    file_path = path_join(ISISServerConfig.work_dir(), file_name.strip("/"))
-    if not path_exists(file_path):
+    file_path = ISISStorage.work_path(file_name)
+    if file_path is None or not path_exists(file_path):
         return {"message": "File not found"}, 404
 
     try:
-        return pvl_load(file_path)
+        return read_label(file_path)
     except:
         return {"message": "Invalid cube label for '{}'".format(file_name)}, 500
 
 
+def retrieve_file_stats(file_name, band=1):
+    label = retrieve_file_label(file_name)
+    if isinstance(label, tuple):
+        return label
+
+    file_path = ISISStorage.work_path(file_name)
+    try:
+        return cube_stats(file_path, label, band)
+    except IndexError:
+        return {"message": "Band {} not in '{}'".format(band, file_name)}, 400
+    except ValueError as e:
+        return {"message": "Cannot read '{}': {}".format(file_name, e)}, 400
+
+
+def compare_files(file_name, other_name, tolerance=0.0, max_tiles=100):
+    labels = [retrieve_file_label(name) for name in [file_name, other_name]]
+    for label in labels:
+        if isinstance(label, tuple):
+            return label
+
+    try:
+        return compare_cubes(
+            ISISStorage.work_path(file_name),
+            labels[0],
+            ISISStorage.work_path(other_name),
+            labels[1],
+            tolerance,
+            max_tiles
+        )
+    except ValueError as e:
+        return {"message": "Cannot compare '{}' and '{}': {}".format(file_name, other_name, e)}, 400
+
+
+def retrieve_file_browse(file_name, max_size=1024, band=1, format="png"):
+    file_path = ISISStorage.work_path(file_name)
+    if file_path is None or not path_exists(file_path):
+        return {"message": "File not found"}, 404
+
+    try:
+        image, mimetype = render_browse(file_path, band, max_size, format)
+    except IndexError:
+        return {"message": "Band {} not in '{}'".format(band, file_name)}, 400
+    except ValueError as e:
+        return {"message": "Cannot browse '{}': {}".format(file_name, e)}, 400
+
+    return send_file(image, mimetype=mimetype)
+
+
+def bundle_files():
+    body = request.json
+    compression = body.get("compression")
+    if compression not in available_compressions():
+        return {"message": "Unsupported compression '{}'".format(compression)}, 400
+
+    names = [normpath(f.strip("/")) for f in body.get("files", list())]
+    if "pattern" in body:
+        # Matches in hidden dirs, or that lead out of the work dir, are
+        # left out like any other file that isn't there
+        names.extend(
+            name for name in (
+                relpath(f, ISISServerConfig.work_dir())
+                for f in sorted(glob(path_join(ISISServerConfig.work_dir(), body["pattern"])))
+                if isfile(f)
+            )
+            if ISISStorage.work_path(name) is not None
+        )
+
+    if not names:
+        return {"message": "No files to bundle"}, 400
+
+    files = list()
+    for name in dict.fromkeys(names):
+        file_path = ISISStorage.work_path(name)
+        if file_path is None or not isfile(file_path):
+            return {"message": "File '{}' not found".format(name)}, 404
+        files.append((name, file_path))
+
+    response = Response(bundle_stream(files, compression), mimetype=MIMETYPES[compression])
+    if compression is None:
+        response.content_length = tar_size(files)
+    return response
+
+
 def delete_file(file_name):
-    file_path = path_join(ISISServerConfig.work_dir(), file_name.strip("/"))
-    if not path_exists(file_path):
+    file_path = ISISStorage.work_path(file_name)
+    if file_path is None or not path_exists(file_path):
+        return {"message": "File not found"}, 404
+
+    size = getsize(file_path)
+    ISISStorage.remove(file_path)
+    remove_sidecars(file_path)
+    ISISNamespaces.charge(-size, -1)
+    ISISCatalog.forget(normpath(file_name.strip("/")))
+
+
+def retain_file(file_name):
+    file_path = ISISStorage.work_path(file_name)
+    if file_path is None or not path_exists(file_path):
         return {"message": "File not found"}, 404
 
-    remove(file_path)
+    # Moved to durable storage and out of reach of job expiry
+    ISISStorage.promote(file_path)
+    ISISJobs.retain(normpath(file_name.strip("/")))
+    return {"message": "File retained"}
@@ -1,99 +1,292 @@
 import logging
-from os import chdir, getcwd, getenv
-from os.path import exists as path_exists, join as path_join, basename
-from os import remove
-from subprocess import run as sp_run, PIPE, DEVNULL
-from urllib.request import urlretrieve
+from os.path import isdir, join as path_join, lexists, splitext
+from os import makedirs, remove
+from shutil import rmtree
+from urllib.parse import urlparse
 from uuid import uuid4
 from logging import getLogger
-from tempfile import NamedTemporaryFile
 
 from flask import request, jsonify
 
 from .._config import ISISServerConfig
+from .._jobs import ISISJob, ISISJobs
+from .._lists import ISISLists
+from .._namespaces import ISISNamespaces, QuotaExceeded
+from .._pending import ISISPendingJobs
+from .._programs import ISISPrograms
+from .._remotes import ISISRemotes
+from .._scheduler import ISISScheduler
+from .._spice import ISISSpiceCache
+from .._storage import ISISStorage
+from .._tail import job_running, output_paths, producing
+from .._webhooks import ISISWebhooks
+from .files import save_uploads
 
 logger = getLogger("ISIS")
 
 
-def _serialize_command_args(arg_dict):
+def _job_dir(job_id):
+    # For a job's listfiles and remote downloads, on scratch when there's
+    # room and out of the work dir's listing and the scratch sweep either
+    # way. A job keeps the dir it started with.
+    if ISISStorage.scratch_dir() is not None:
+        scratch_job_dir = path_join(ISISStorage.scratch_dir(), ".jobs", job_id)
+        if isdir(scratch_job_dir) or ISISStorage.has_room():
+            return scratch_job_dir
+    return path_join(ISISServerConfig.work_dir(), ".scratch", "jobs", job_id)
+
+
+def _serialize_command_args(arg_dict, job_dir):
     args = list()
-    listfiles = list()
+    resolved = dict()
     for k, v in arg_dict.items():
         # If the argument is a list, isis wants a "listfile"
         if isinstance(v, list):
-            list_file = "{}.lis".format(uuid4())
+            makedirs(job_dir, exist_ok=True)
+            list_file = path_join(job_dir, "{}.lis".format(uuid4()))
             with open(list_file, 'w') as f:
                 for item in v:
                     print(item, file=f)
             v = list_file
-            listfiles.append(list_file)
+
+        # Stored lists are used as they are, queries are resolved now so
+        # they see the job's uploads
+        elif ISISLists.is_reference(v):
+            v, resolved[k] = ISISLists.resolve(v, job_dir)
 
         args.append("{}={}".format(k, str(v)))
 
-    # Return the listfiles too so we can clean them up
-    return args, listfiles
+    # Return the names in referenced lists too, for the job's manifest
+    return args, resolved
+
+
+def _cleanup(job_dir, temp_files):
+    # Auto-cleanup listfiles
+    if job_dir is not None:
+        rmtree(job_dir, ignore_errors=True)
+
+    # Clean up downloads, or the links to mirrored files
+    [remove(f) for f in temp_files if lexists(f)]
+
+
+def _execute(program, args, command_args, job, ttl, redirected, queue):
+    status = 200
+    response = {"message": "Command executed successfully"}
+
+    spice_cache = None
+    if program.name == "spiceinit":
+        spice_cache = ISISSpiceCache(args)
+
+    job.start()
+    # Outputs can be tailed until the job's finished with them
+    work_dir = ISISServerConfig.work_dir()
+    with producing(job.job_id, output_paths(program, args, redirected, work_dir), work_dir):
+        if spice_cache is not None and spice_cache.attach():
+            response["message"] = "Attached cached SPICE data"
+            response["job"] = job.finish(ttl=ttl)
+            return response, status
+
+        # Waits its turn for a slot, by lane and client
+        with ISISScheduler.slot(*queue):
+            proc = ISISPrograms.run(program, command_args)
+        ISISStorage.link_outputs(redirected)
+        response["job"] = job.finish(ttl=ttl)
+
+    try:
+        ISISNamespaces.check()
+    except QuotaExceeded:
+        ISISJobs.discard(response["job"])
+        raise
+
+    if spice_cache is not None and proc.returncode == 0:
+        spice_cache.store()
+
+    if not proc.returncode == 0:
+        status = 500
+        stderr = proc.stderr.decode("utf-8")
+        response["message"] = stderr
+
+        err_msg = "{} failed\n{}".format(
+            ' '.join([program.name, *command_args]),
+            stderr
+        )
+        logging.error(err_msg)
+
+    return response, status
+
+
+def _start(job_id, program, body, remote_files, temp_files, callback):
+    # Runs a job whose inputs have all landed. It owns the temp files from
+    # here on, and cleans them up once the job is done.
+    job_dir = _job_dir(job_id)
+    background = False
+
+    try:
+        # Short lived outputs are written to the scratch tier
+        run_args, redirected = ISISStorage.redirect_outputs(
+            program,
+            body["args"],
+            body.get("ttl"),
+            body.get("retain", False)
+        )
+        try:
+            command_args, resolved = _serialize_command_args(run_args, job_dir)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+
+        job = ISISJob(job_id, program.name, {
+            k: resolved.get(k, v) for k, v in body["args"].items() if k not in remote_files
+        })
+        queue = (ISISScheduler.lane(body), ISISScheduler.client())
+
+        if callback is None:
+            response, status = _execute(
+                program, body["args"], command_args, job, body.get("ttl"), redirected, queue
+            )
+            return jsonify(response), status
+
+        def execute():
+            try:
+                return _execute(
+                    program, body["args"], command_args, job, body.get("ttl"), redirected, queue
+                )
+            finally:
+                _cleanup(job_dir, temp_files)
+
+        # The job's result goes to the callback, which owns the cleanup
+        ISISWebhooks.run_in_background(job.job_id, program.name, execute, callback)
+        background = True
+
+        return jsonify({"message": "Job accepted", "job_id": job.job_id}), 202
+
+    finally:
+        if not background:
+            _cleanup(job_dir, temp_files)
 
 
 def run_isis():
+    job_id = uuid4().hex
     temp_files = list()
-    listfiles = list()
-
-    orig_dir = getcwd()
-    chdir(ISISServerConfig.work_dir())
+    handed_off = False
 
     try:
         body = request.get_json()
 
         # Only allow executables in the conda bin
-        command = path_join(
-            getenv("ISISROOT"),
-            "bin",
-            body["program"].strip("/")
-        )
+        program = ISISPrograms.get(body["program"].strip("/"))
 
-        if not path_exists(command):
+        if program is None:
             return jsonify({"message": "Command not found"}), 404
 
+        # Clients choose the ID to tail a job's outputs while it runs
+        chosen_id = body.pop("job_id", None)
+        if chosen_id is not None:
+            if (ISISJobs.get(chosen_id) is not None or ISISPendingJobs.exists(chosen_id)
+                    or job_running(chosen_id, ISISServerConfig.work_dir())):
+                return jsonify({"message": "Job '{}' already exists".format(chosen_id)}), 409
+            job_id = chosen_id
+
+        callback = body.get("callback")
+        try:
+            if callback is not None:
+                body["callback"] = callback = ISISWebhooks.validate(callback)
+            ISISScheduler.lane(body)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+
+        # Jobs can't start once a namespace is at its quota
+        ISISNamespaces.check()
+
         remote_files = body.pop("remotes", [])
+        uploads = body.pop("uploads", [])
 
-        # Download any arguments that are tagged as remote files
-        for arg_key in remote_files:
+        for arg_key in [*remote_files, *uploads]:
             if arg_key not in body["args"].keys():
                 return jsonify({
-                    "message": "remote '{}' not found in args".format(arg_key)
+                    "message": "'{}' not found in args".format(arg_key)
                 }), 400
 
+        # Downloads are only needed for the length of the job, and are
+        # removed with its dir
+        remotes = dict()
+        if remote_files:
+            makedirs(_job_dir(job_id), exist_ok=True)
+        for arg_key in remote_files:
             url = body["args"][arg_key]
-            dl_file = NamedTemporaryFile('r+', dir=getcwd())
-            urlretrieve(url, dl_file.name)
-            temp_files.append(dl_file)
-            body["args"][arg_key] = dl_file.name
+            # The extension is kept for programs that go by it
+            remotes[arg_key] = (url, path_join(_job_dir(job_id), "remote-{}{}".format(
+                uuid4().hex,
+                splitext(urlparse(url).path)[1]
+            )), program.writes_input(arg_key))
+            temp_files.append(remotes[arg_key][1])
 
-        command_args, listfiles = _serialize_command_args(body["args"])
+        # Files still to be uploaded go to /isis/{job_id}/inputs, and the
+        # remotes are fetched in the meantime
+        if uploads:
+            ISISPendingJobs.create(job_id, {**body, "remotes": remote_files}, uploads, remotes)
+            handed_off = True
+            return jsonify({"message": "Waiting for uploads", "job_id": job_id}), 202
 
-        status = 200
-        response = {"message": "Command executed successfully"}
-        proc = sp_run([command, *command_args], stdout=DEVNULL, stderr=PIPE)
+        # Download any arguments that are tagged as remote files
+        for arg_key, (url, dl_file, writable) in remotes.items():
+            try:
+                ISISRemotes.fetch(url, dl_file, writable)
+            except ValueError as e:
+                return jsonify({"message": str(e)}), 400
+            except OSError as e:
+                return jsonify({
+                    "message": "Couldn't fetch remote '{}': {}".format(arg_key, e)
+                }), 502
+            body["args"][arg_key] = dl_file
 
-        if not proc.returncode == 0:
-            status = 500
-            stderr = proc.stderr.decode("utf-8")
-            response["message"] = stderr
+        handed_off = True
+        return _start(job_id, program, body, remote_files, temp_files, callback)
 
-            err_msg = "{} failed\n{}".format(
-                ' '.join([basename(command), *command_args]),
-                stderr
-            )
-            logging.error(err_msg)
+    finally:
+        if not handed_off:
+            _cleanup(_job_dir(job_id), temp_files)
 
-        return jsonify(response), status
 
-    finally:
-        # Auto-cleanup listfiles
-        [remove(f) for f in listfiles if path_exists(f)]
+def upload_job_inputs(job_id):
+    job_id = job_id.strip("/")
+    record = ISISPendingJobs.get(job_id)
+    if record is None:
+        return jsonify({"message": "Job not found or already started"}), 404
+
+    body = record["body"]
+    expected = {body["args"][arg_key] for arg_key in record["uploads"]}
+    if set(request.files.keys()) != expected:
+        return jsonify({
+            "message": "Expected uploads of {}".format(", ".join(sorted(expected)))
+        }), 400
 
-        # Clean up temp files
-        [f.close() for f in temp_files]
+    if ISISPendingJobs.claim(job_id) is None:
+        return jsonify({"message": "Job not found or already started"}), 404
+
+    temp_files = list(record["remotes"].values())
+    handed_off = False
+
+    try:
+        error = save_uploads()
+        if error is not None:
+            return jsonify(error[0]), error[1]
 
-        # Change back to original working directory
-        chdir(orig_dir)
+        # Runs as soon as the last of the uploads and remotes lands
+        fetched = ISISPendingJobs.wait_for_remotes(job_id, record)
+        if fetched["status"] != 200:
+            return jsonify({"message": fetched["message"]}), fetched["status"]
+
+        program = ISISPrograms.get(body["program"].strip("/"))
+        if program is None:
+            return jsonify({"message": "Command not found"}), 404
+
+        remote_files = body.pop("remotes")
+        body["args"].update(record["remotes"])
+
+        handed_off = True
+        return _start(job_id, program, body, remote_files, temp_files, body.get("callback"))
+
+    finally:
+        ISISPendingJobs.release(job_id)
+        if not handed_off:
+            _cleanup(_job_dir(job_id), temp_files)
@@ -0,0 +1,9 @@
+from .._jobs import ISISJobs
+
+
+def retrieve_job(job_id):
+    manifest = ISISJobs.get(job_id.strip("/"))
+    if manifest is None:
+        return {"message": "Job not found"}, 404
+
+    return manifest
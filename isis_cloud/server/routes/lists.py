@@ -0,0 +1,34 @@
+from flask import request
+
+from .._lists import ISISLists
+
+
+def store_list():
+    try:
+        list_id, existed = ISISLists.store(request.get_json().get("items"))
+    except ValueError as e:
+        return {"message": str(e)}, 400
+
+    return {"list_id": list_id}, 200 if existed else 201
+
+
+def retrieve_list(list_id):
+    try:
+        items = ISISLists.items(list_id.strip("/"))
+    except ValueError as e:
+        return {"message": str(e)}, 400
+    if items is None:
+        return {"message": "List not found"}, 404
+
+    return {"list_id": list_id.strip("/"), "items": items}
+
+
+def delete_list(list_id):
+    try:
+        deleted = ISISLists.delete(list_id.strip("/"))
+    except ValueError as e:
+        return {"message": str(e)}, 400
+    if not deleted:
+        return {"message": "List not found"}, 404
+
+    return {"message": "List deleted"}
@@ -0,0 +1,70 @@
+from os import getpid, remove, replace
+from os.path import getsize, isfile, lexists, normpath
+from logging import getLogger
+from threading import get_ident
+from time import time
+
+from flask import request, jsonify
+
+from .._catalog import ISISCatalog
+from .._config import ISISServerConfig
+from .._namespaces import ISISNamespaces
+from .._pixelmath import evaluate_pixelmath
+from .._scheduler import ISISScheduler
+from .._storage import ISISStorage
+
+logger = getLogger("PixelMath")
+
+
+def run_pixelmath():
+    body = request.get_json()
+    start_time = time()
+
+    inputs = {
+        name: ISISStorage.work_path(spec)
+        for name, spec in body["inputs"].items()
+    }
+    for name, input_path in inputs.items():
+        if input_path is None:
+            return jsonify({"message": "Input not found: {}".format(body["inputs"][name])}), 404
+
+    output_path = ISISStorage.work_path(body["to"])
+    if output_path is None:
+        return jsonify({"message": "Invalid output name"}), 400
+
+    ISISNamespaces.check()
+
+    # Written beside the output and moved over it once done, so an output
+    # that's also an input isn't truncated before it's been read
+    tmp_path = "{}.{}.{}.tmp".format(output_path, getpid(), get_ident())
+    try:
+        # Shares the job slots with programs, by lane and client
+        with ISISScheduler.slot(ISISScheduler.lane(body), ISISScheduler.client()):
+            evaluate_pixelmath(
+                body["equation"],
+                inputs,
+                tmp_path,
+                define=body.get("define"),
+                workers=ISISServerConfig.pixelmath_workers()
+            )
+
+        # Checked before the output is replaced, so a run over the quota
+        # leaves a file that was already there as it was
+        previous_size = getsize(output_path) if isfile(output_path) else None
+        bytes_delta = getsize(tmp_path) - (previous_size or 0)
+        files_delta = 1 if previous_size is None else 0
+        ISISNamespaces.check(bytes_delta, files_delta)
+        replace(tmp_path, output_path)
+    except FileNotFoundError as e:
+        return jsonify({"message": "Input not found: {}".format(e.filename)}), 404
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    finally:
+        if lexists(tmp_path):
+            remove(tmp_path)
+
+    ISISNamespaces.charge(bytes_delta, files_delta)
+    ISISCatalog.record(normpath(body["to"].strip("/")))
+
+    logger.info("'{}' took {:.1f}s".format(body["equation"], time() - start_time))
+    return jsonify({"message": "Command executed successfully"}), 200
@@ -0,0 +1,47 @@
+import json
+from hashlib import sha1
+
+from flask import request, jsonify
+
+from .._programs import ISISPrograms
+
+_PROGRAM_LIST = None
+_PROGRAM_LIST_ETAG = None
+
+
+def _conditional(body, etag):
+    response = jsonify(body)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def list_programs():
+    global _PROGRAM_LIST, _PROGRAM_LIST_ETAG
+
+    if _PROGRAM_LIST is None:
+        program_list = [
+            {
+                "name": program.name,
+                "brief": program.definition["brief"],
+                "category": program.definition["category"],
+            }
+            for program in ISISPrograms.all()
+            if program.definition is not None
+        ]
+
+        # The list is published last so other threads never see it without
+        # its ETag
+        _PROGRAM_LIST_ETAG = sha1(
+            json.dumps(program_list, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        _PROGRAM_LIST = program_list
+
+    return _conditional(_PROGRAM_LIST, _PROGRAM_LIST_ETAG)
+
+
+def retrieve_program(program_name):
+    program = ISISPrograms.get(program_name.strip("/"))
+    if program is None or program.definition is None:
+        return {"message": "Program not found"}, 404
+
+    return _conditional(program.definition, program.etag)
@@ -0,0 +1,5 @@
+from .._scheduler import ISISScheduler
+
+
+def retrieve_queue():
+    return ISISScheduler.metrics()
@@ -0,0 +1,5 @@
+from .._namespaces import ISISNamespaces
+
+
+def retrieve_usage():
+    return ISISNamespaces.usage()
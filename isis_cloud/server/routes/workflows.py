@@ -0,0 +1,76 @@
+from os.path import normpath
+from uuid import uuid4
+
+from flask import request, jsonify
+
+from .._hirise import ISISHiRISEColor, WorkflowError
+from .._jobs import ISISJob, ISISJobs
+from .._namespaces import ISISNamespaces, QuotaExceeded
+from .._scheduler import ISISScheduler
+from .._storage import ISISStorage
+from .._webhooks import ISISWebhooks
+
+_WORKFLOW_NAME = "hirise-color"
+
+
+def _execute(workflow, job, ttl):
+    job.start()
+    try:
+        stages = workflow.run()
+    except (WorkflowError, OSError, ValueError) as e:
+        return {"message": str(e), "stages": workflow.stages}, 500
+
+    response = {
+        "message": "Workflow completed successfully",
+        "stages": stages,
+        "job": job.finish(ttl=ttl),
+    }
+
+    try:
+        ISISNamespaces.check()
+    except QuotaExceeded:
+        ISISJobs.discard(response["job"])
+        raise
+
+    return response, 200
+
+
+def run_hirise_color():
+    body = request.get_json()
+
+    to = normpath(body["to"].strip("/"))
+    if ISISStorage.work_path(to) is None:
+        return jsonify({"message": "Invalid output name"}), 400
+
+    try:
+        workflow = ISISHiRISEColor(
+            body["observation"],
+            to,
+            ISISScheduler.lane(body),
+            ISISScheduler.client()
+        )
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    callback = body.get("callback")
+    if callback is not None:
+        try:
+            callback = ISISWebhooks.validate(callback)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+
+    ISISNamespaces.check()
+
+    job = ISISJob(uuid4().hex, _WORKFLOW_NAME, {"to": to})
+
+    if callback is None:
+        response, status = _execute(workflow, job, body.get("ttl"))
+        return jsonify(response), status
+
+    ISISWebhooks.run_in_background(
+        job.job_id,
+        _WORKFLOW_NAME,
+        lambda: _execute(workflow, job, body.get("ttl")),
+        callback
+    )
+    return jsonify({"message": "Job accepted", "job_id": job.job_id}), 202
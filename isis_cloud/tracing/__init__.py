@@ -0,0 +1,4 @@
+from ._tracing import (
+    Span, SpanContext, configure, current, enabled, end_span, extract, flush,
+    inject, span, start_span, subprocess_env, wrap
+)
@@ -0,0 +1,297 @@
+import atexit
+import json
+import re
+from binascii import hexlify
+from contextlib import contextmanager
+from functools import wraps
+from logging import getLogger
+from os import O_APPEND, O_CREAT, O_WRONLY, close, getenv, getpid, open as os_open, urandom, write
+from threading import Lock, Thread, local
+from time import sleep, time
+from urllib.request import Request, urlopen
+
+logger = getLogger("Tracing")
+
+# W3C trace context, https://www.w3.org/TR/trace-context/
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# Seconds between exports, and how many spans are sent at most per export
+_EXPORT_INTERVAL = 1
+_MAX_BATCH = 512
+
+# Seconds to wait on the collector
+_EXPORT_TIMEOUT = 10
+
+
+class _Config:
+    # Tracing is off unless spans have somewhere to go. The file gets one
+    # OTLP/JSON export request per line, as the OpenTelemetry collector's
+    # file exporter writes them.
+    service_name = getenv("OTEL_SERVICE_NAME", "isis_cloud")
+    file = getenv("ISIS_TRACE_FILE")
+    endpoint = getenv(
+        "OTEL_EXPORTER_OTLP_TRACES_ENDPOINT",
+        "{}/v1/traces".format(getenv("OTEL_EXPORTER_OTLP_ENDPOINT").rstrip("/"))
+        if getenv("OTEL_EXPORTER_OTLP_ENDPOINT") else None
+    )
+
+
+def configure(service_name: str = None, file: str = None, endpoint: str = None):
+    # Overrides the environment, e.g. for client scripts
+    if service_name is not None:
+        _Config.service_name = service_name
+    if file is not None:
+        _Config.file = file
+    if endpoint is not None:
+        _Config.endpoint = endpoint
+
+
+def enabled():
+    return _Config.file is not None or _Config.endpoint is not None
+
+
+class SpanContext:
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    @property
+    def traceparent(self):
+        return "00-{}-{}-01".format(self.trace_id, self.span_id)
+
+
+class Span(SpanContext):
+    def __init__(self, name, parent=None, attributes=None):
+        super().__init__(
+            parent.trace_id if parent is not None else hexlify(urandom(16)).decode("ascii"),
+            hexlify(urandom(8)).decode("ascii")
+        )
+        self.name = name
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict()
+        self.start = time()
+        self.end = None
+        self.error = None
+
+        self.set_attributes(**(attributes or dict()))
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+
+class _NoopSpan:
+    # Stands in for spans while tracing is off, so callers needn't check
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+# The open spans of each thread, innermost last
+_context = local()
+
+
+def _stack():
+    if not hasattr(_context, "stack"):
+        _context.stack = list()
+    return _context.stack
+
+
+def current():
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def start_span(name: str, parent: SpanContext = None, **attributes):
+    """
+    Opens a span as a child of parent, or of the thread's current span, and
+    makes it current. Prefer span() unless it has to end somewhere else.
+    """
+    if not enabled():
+        return _NOOP_SPAN
+
+    new_span = Span(name, parent or current(), attributes)
+    _stack().append(new_span)
+    return new_span
+
+
+def end_span(ended: Span, error: BaseException = None):
+    if ended is _NOOP_SPAN:
+        return
+
+    ended.end = time()
+    if error is not None:
+        ended.error = "{}: {}".format(type(error).__name__, error)
+
+    stack = _stack()
+    if ended in stack:
+        stack.remove(ended)
+    _exporter.add(ended)
+
+
+@contextmanager
+def span(name: str, parent: SpanContext = None, **attributes):
+    opened = start_span(name, parent, **attributes)
+    try:
+        yield opened
+    except BaseException as e:
+        end_span(opened, e)
+        raise
+    end_span(opened)
+
+
+def wrap(func):
+    # Runs func under the caller's current span, e.g. in a thread pool,
+    # where it would otherwise start a trace of its own
+    parent = current()
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        if parent is None:
+            return func(*args, **kwargs)
+
+        stack = _stack()
+        stack.append(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.remove(parent)
+    return wrapped
+
+
+def inject(headers: dict = None):
+    # A copy of headers that carries the current span to the server
+    headers = dict(headers or dict())
+    parent = current()
+    if parent is not None:
+        headers["traceparent"] = parent.traceparent
+    return headers
+
+
+def extract(headers):
+    # The span a request came from, if it says
+    match = _TRACEPARENT.match(headers.get("traceparent", "").strip())
+    if match is None:
+        return None
+    return SpanContext(*match.groups())
+
+
+def subprocess_env(env: dict):
+    # The environment for a subprocess, with the current span as its
+    # TRACEPARENT so anything traced in it joins the trace
+    parent = current()
+    if parent is None:
+        return env
+    return dict(env, TRACEPARENT=parent.traceparent)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()]
+
+
+def _otlp_span(exported):
+    otlp = {
+        "traceId": exported.trace_id,
+        "spanId": exported.span_id,
+        "name": exported.name,
+        "kind": 1,
+        "startTimeUnixNano": str(int(exported.start * 1e9)),
+        "endTimeUnixNano": str(int(exported.end * 1e9)),
+        "attributes": _otlp_attributes(exported.attributes),
+        "status": {"code": 1},
+    }
+    if exported.parent_id is not None:
+        otlp["parentSpanId"] = exported.parent_id
+    if exported.error is not None:
+        otlp["status"] = {"code": 2, "message": exported.error}
+    return otlp
+
+
+class _Exporter:
+    # Batches ended spans and exports them from a background thread
+
+    def __init__(self):
+        self._spans = list()
+        self._lock = Lock()
+        self._pid = None
+
+    def add(self, ended):
+        with self._lock:
+            self._spans.append(ended)
+            # Threads don't survive a fork, so each process starts its own
+            if self._pid != getpid():
+                self._pid = getpid()
+                Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            sleep(_EXPORT_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        while True:
+            with self._lock:
+                batch = self._spans[:_MAX_BATCH]
+                self._spans = self._spans[_MAX_BATCH:]
+            if not batch:
+                return
+
+            request = {"resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({
+                    "service.name": _Config.service_name,
+                    "process.pid": getpid(),
+                })},
+                "scopeSpans": [{
+                    "scope": {"name": "isis_cloud"},
+                    "spans": [_otlp_span(s) for s in batch],
+                }],
+            }]}
+            body = json.dumps(request).encode("utf-8")
+
+            try:
+                if _Config.file is not None:
+                    # One write per line, so processes sharing the file
+                    # don't interleave
+                    fd = os_open(_Config.file, O_WRONLY | O_APPEND | O_CREAT, 0o644)
+                    try:
+                        write(fd, body + b"\n")
+                    finally:
+                        close(fd)
+
+                if _Config.endpoint is not None:
+                    post = Request(_Config.endpoint, data=body, method="POST", headers={
+                        "Content-Type": "application/json",
+                    })
+                    with urlopen(post, timeout=_EXPORT_TIMEOUT):
+                        pass
+            except OSError as e:
+                logger.warning("Dropped {} spans: {}".format(len(batch), e))
+
+
+_exporter = _Exporter()
+
+# Spans ended just before exit are still exported
+atexit.register(_exporter.flush)
+
+
+def flush():
+    _exporter.flush()
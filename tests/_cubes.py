@@ -0,0 +1,89 @@
+import numpy as np
+
+_LABEL_BYTES = 65536
+
+_PIXEL_TYPES = {
+    "UnsignedByte": "u1",
+    "SignedWord": "i2",
+    "UnsignedWord": "u2",
+    "SignedInteger": "i4",
+    "Real": "f4",
+}
+
+_LABEL = """Object = IsisCube
+  Object = Core
+    StartByte   = {start_byte}
+    Format      = {fmt}
+{tiles}
+    Group = Dimensions
+      Samples = {samples}
+      Lines   = {lines}
+      Bands   = {bands}
+    End_Group
+
+    Group = Pixels
+      Type       = {pixel_type}
+      ByteOrder  = {byte_order}
+      Base       = {base}
+      Multiplier = {multiplier}
+    End_Group
+  End_Object
+
+  Group = Instrument
+    SpacecraftName = "MARS RECONNAISSANCE ORBITER"
+  End_Group
+End_Object
+
+Object = Label
+  Bytes = {label_bytes}
+End_Object
+End
+"""
+
+
+def write_cube(file_path, raw, fmt="Tile", tile_samples=128, tile_lines=128,
+               pixel_type="Real", byte_order="Lsb", base=0.0, multiplier=1.0, padding=b" "):
+    """
+    Writes raw, a (bands, lines, samples) array of DNs, as an ISIS cube
+    with an attached label padded out to 64KiB with padding.
+    """
+    bands, lines, samples = raw.shape
+    tiles = ""
+    if fmt == "Tile":
+        tiles = "    TileSamples = {}\n    TileLines   = {}\n".format(tile_samples, tile_lines)
+
+    label = _LABEL.format(
+        start_byte=_LABEL_BYTES + 1,
+        fmt=fmt,
+        tiles=tiles,
+        samples=samples,
+        lines=lines,
+        bands=bands,
+        pixel_type=pixel_type,
+        byte_order=byte_order,
+        base=base,
+        multiplier=multiplier,
+        label_bytes=_LABEL_BYTES
+    ).encode("utf-8")
+
+    dtype = np.dtype({"Lsb": "<", "Msb": ">"}[byte_order] + _PIXEL_TYPES[pixel_type])
+    raw = np.asarray(raw).astype(dtype)
+
+    if fmt == "Tile":
+        tile_rows = -(-lines // tile_lines)
+        tile_cols = -(-samples // tile_samples)
+        padded = np.zeros((bands, tile_rows * tile_lines, tile_cols * tile_samples), dtype=dtype)
+        padded[:, :lines, :samples] = raw
+        core = padded.reshape(bands, tile_rows, tile_lines, tile_cols, tile_samples)
+        core = core.transpose(0, 1, 3, 2, 4)
+    else:
+        core = raw
+
+    with open(file_path, "wb") as f:
+        f.write(label + padding * (_LABEL_BYTES - len(label)))
+        f.write(np.ascontiguousarray(core).tobytes())
+
+
+def real_special(bits):
+    # A Real special pixel value from its bit pattern
+    return np.array([bits], dtype=np.uint32).view(np.float32)[0]
@@ -0,0 +1,12 @@
+import pytest
+
+from isis_cloud.server._config import ISISServerConfig
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # A fresh data dir for the server's shared state, with no namespaces
+    work_dir = tmp_path / "data"
+    work_dir.mkdir()
+    monkeypatch.setattr(ISISServerConfig, "_WORK_DIR", str(work_dir))
+    return work_dir
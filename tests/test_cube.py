@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+from isis_cloud.cube import Cube, read_label
+
+from ._cubes import real_special, write_cube
+
+
+@pytest.fixture
+def raw():
+    return np.random.RandomState(0).uniform(-100, 100, (2, 300, 200)).astype(np.float32)
+
+
+def test_tile_reads_match_the_pixels(tmp_path, raw):
+    # Tiles that don't divide the cube leave partial tiles at the edges
+    file_path = str(tmp_path / "tiled.cub")
+    write_cube(file_path, raw, tile_samples=64, tile_lines=90)
+
+    with Cube(file_path) as cube:
+        assert cube.shape == (2, 300, 200)
+        assert np.array_equal(cube[:, :, :], raw)
+        assert np.array_equal(cube[1, 85:95, 60:130], raw[1, 85:95, 60:130])
+        assert np.array_equal(cube[0, 299, :], raw[0, 299])
+        assert np.array_equal(cube[:, 10, 199], raw[:, 10, 199])
+
+
+def test_band_sequential_reads_match_the_pixels(tmp_path, raw):
+    file_path = str(tmp_path / "bsq.cub")
+    write_cube(file_path, raw, fmt="BandSequential", byte_order="Msb")
+
+    with Cube(file_path) as cube:
+        assert np.array_equal(cube[:, :, :], raw)
+        assert np.array_equal(cube[1, 100:110, 5:7], raw[1, 100:110, 5:7])
+        # Big-endian cores are read in native byte order
+        assert cube.raw[0].dtype == np.float32
+
+
+def test_iter_chunks_covers_every_line(tmp_path, raw):
+    file_path = str(tmp_path / "tiled.cub")
+    write_cube(file_path, raw, tile_samples=64, tile_lines=90)
+
+    with Cube(file_path) as cube:
+        chunks = list(cube.iter_chunks(1))
+
+    assert [c.shape[0] for c in chunks] == [90, 90, 90, 30]
+    assert np.array_equal(np.concatenate(chunks), raw[1])
+
+
+def test_base_and_multiplier_scale_integer_pixels(tmp_path):
+    dns = np.arange(-100, 100, dtype=np.int16).reshape(1, 10, 20)
+    file_path = str(tmp_path / "word.cub")
+    write_cube(file_path, dns, pixel_type="SignedWord", base=10.0, multiplier=0.5)
+
+    with Cube(file_path) as cube:
+        assert np.array_equal(cube.raw[0], dns[0])
+        assert np.allclose(cube[0], dns[0] * 0.5 + 10.0)
+
+
+def test_real_special_pixels(tmp_path):
+    specials = [0xFF7FFFFB, 0xFF7FFFFC, 0xFF7FFFFD, 0xFF7FFFFE, 0xFF7FFFFF]
+    raw = np.ones((1, 2, 6), dtype=np.float32)
+    for i, bits in enumerate(specials):
+        raw[0, 0, i] = real_special(bits)
+
+    file_path = str(tmp_path / "specials.cub")
+    write_cube(file_path, raw, tile_samples=4, tile_lines=1)
+
+    with Cube(file_path) as cube:
+        codes = cube.special_codes(cube.raw[0])
+        values = cube[0]
+
+    assert list(codes[0]) == [Cube.NULL, Cube.LRS, Cube.LIS, Cube.HIS, Cube.HRS, Cube.VALID]
+    assert not codes[1].any()
+    assert np.isnan(values[0, 0])
+    assert list(values[0, 1:5]) == [-np.inf, -np.inf, np.inf, np.inf]
+    assert np.all(values[1] == 1)
+
+
+def test_integer_special_pixels(tmp_path):
+    dns = np.array([[[-32768, -32767, -32766, -32765, -32764, 7]]], dtype=np.int16)
+    file_path = str(tmp_path / "word.cub")
+    write_cube(file_path, dns, fmt="BandSequential", pixel_type="SignedWord")
+
+    with Cube(file_path) as cube:
+        codes = cube.special_codes(cube.raw[0])
+        values = cube[0]
+
+    assert list(codes[0]) == [Cube.NULL, Cube.LRS, Cube.LIS, Cube.HIS, Cube.HRS, Cube.VALID]
+    assert np.isnan(values[0, 0])
+    assert values[0, 5] == 7
+
+
+def test_read_label_stops_at_end_before_nul_padding(tmp_path, monkeypatch, raw):
+    # Cube.create ends its label with End followed straight away by NUL
+    # padding rather than a newline
+    file_path = str(tmp_path / "padded.cub")
+    write_cube(file_path, raw, padding=b"\0")
+    with open(file_path, "r+b") as f:
+        end = f.read(65536).rindex(b"\nEnd\n")
+        f.seek(end + len(b"\nEnd"))
+        f.write(b"\0")
+
+    def load_whole_file(*args, **kwargs):
+        raise AssertionError("The whole cube was parsed as a label")
+    monkeypatch.setattr("pvl.load", load_whole_file)
+
+    label = read_label(file_path)
+
+    assert label["IsisCube"]["Core"]["Dimensions"]["Samples"] == 200
+    assert label["IsisCube"]["Instrument"]["SpacecraftName"] == "MARS RECONNAISSANCE ORBITER"
+    assert label["Label"]["Bytes"] == 65536
+
+
+def test_writes_round_trip_through_special_pixels(tmp_path):
+    file_path = str(tmp_path / "out.cub")
+    values = np.arange(200, dtype=np.float32).reshape(10, 20)
+    values[3, 4] = np.nan
+    values[5, 6] = np.inf
+    values[5, 7] = -np.inf
+    with Cube.create(file_path, 20, 10) as cube:
+        cube[0, 0:10] = values
+        cube.flush()
+
+    with Cube(file_path) as cube:
+        codes = cube.special_codes(cube.raw[0])
+        read = cube[0]
+
+    assert codes[3, 4] == Cube.NULL
+    assert codes[5, 6] == Cube.HRS
+    assert codes[5, 7] == Cube.LRS
+    assert np.array_equal(read, values, equal_nan=True)
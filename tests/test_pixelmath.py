@@ -0,0 +1,65 @@
+import numpy as np
+from flask import Flask
+
+from isis_cloud.cube import Cube
+from isis_cloud.server import _pixelmath
+from isis_cloud.server._pixelmath import evaluate_pixelmath
+from isis_cloud.server.routes.pixelmath import run_pixelmath
+
+from ._cubes import real_special, write_cube
+
+
+def _naive_lowpass(values, samples, lines):
+    # The mean of the finite pixels in each window, one window at a time
+    half_lines, half_samples = lines // 2, samples // 2
+    result = np.full(values.shape, np.nan)
+    for line in range(values.shape[0]):
+        for sample in range(values.shape[1]):
+            window = values[
+                max(0, line - half_lines):line + half_lines + 1,
+                max(0, sample - half_samples):sample + half_samples + 1
+            ]
+            window = window[np.isfinite(window)]
+            if window.size:
+                result[line, sample] = window.mean()
+    return result
+
+
+def test_lowpass_matches_a_naive_boxcar(tmp_path, monkeypatch):
+    raw = np.random.RandomState(3).uniform(1, 10, (1, 300, 40)).astype(np.float32)
+    raw[0, 100:103, 10:14] = real_special(0xFF7FFFFB)
+    raw[0, 128, :] = real_special(0xFF7FFFFB)
+    raw[0, 250, 5] = real_special(0xFF7FFFFF)
+    input_path = str(tmp_path / "in.cub")
+    write_cube(input_path, raw, tile_samples=16, tile_lines=16)
+
+    # Small tasks, so windows cross the lines each task evaluates
+    monkeypatch.setattr(_pixelmath, "_TASK_PIXELS", 1)
+
+    output_path = str(tmp_path / "out.cub")
+    evaluate_pixelmath("lowpass(a, 5, 7) * 2", {"a": input_path}, output_path, workers=2)
+
+    with Cube(input_path) as cube:
+        values = cube[0].astype(np.float64)
+    values[~np.isfinite(values)] = np.nan
+    with Cube(output_path) as cube:
+        result = cube[0]
+
+    expected = _naive_lowpass(values, 5, 7) * 2
+    assert result.shape == expected.shape
+    assert np.array_equal(np.isnan(result), np.isnan(expected))
+    assert np.allclose(result, expected, rtol=1e-5, equal_nan=True)
+
+
+def test_output_can_be_an_input(data_dir):
+    raw = np.arange(300 * 40, dtype=np.float32).reshape(1, 300, 40)
+    write_cube(str(data_dir / "a.cub"), raw)
+
+    body = {"equation": "a + 1", "inputs": {"a": "a.cub"}, "to": "a.cub"}
+    with Flask(__name__).test_request_context(json=body):
+        response, status = run_pixelmath()
+
+    assert status == 200
+    with Cube(str(data_dir / "a.cub")) as cube:
+        assert np.array_equal(cube[0], raw[0] + 1)
+    assert sorted(p.name for p in data_dir.iterdir() if not p.name.startswith(".")) == ["a.cub"]
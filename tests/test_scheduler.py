@@ -0,0 +1,88 @@
+from os import getpid
+from threading import local
+
+import pytest
+
+from isis_cloud.server._config import ISISServerConfig
+from isis_cloud.server._scheduler import LANES, ISISScheduler
+
+
+@pytest.fixture
+def scheduler(data_dir, monkeypatch):
+    # One slot, this test's own queue, and no polling thread, so tickets
+    # only start when the test releases the one before
+    monkeypatch.setattr(ISISServerConfig, "_JOB_SLOTS", "1")
+    monkeypatch.setattr(ISISScheduler, "_LOCAL", local())
+    monkeypatch.setattr(ISISScheduler, "_waiting", set())
+    monkeypatch.setattr(ISISScheduler, "_admitted", set())
+    monkeypatch.setattr(ISISScheduler, "_pid", getpid())
+    return ISISScheduler
+
+
+def _enqueue(scheduler, lane, client, member=""):
+    return scheduler._enqueue(LANES.index(lane), client, member)
+
+
+def _start_order(scheduler, tickets):
+    # Releases whichever ticket holds the slot until all have run
+    names = {ticket: name for name, ticket in tickets.items()}
+    order = list()
+    scheduler._dispatch()
+    while True:
+        running = scheduler._connect().execute(
+            "SELECT ticket FROM tickets WHERE admitted IS NOT NULL"
+        ).fetchall()
+        if not running:
+            return order
+        assert len(running) == 1
+        order.append(names[running[0][0]])
+        scheduler._release(running[0][0])
+
+
+def test_clients_take_turns(scheduler):
+    tickets = dict()
+    for i in range(4):
+        tickets["flood{}".format(i)] = _enqueue(scheduler, "batch", "flood")
+    tickets["other0"] = _enqueue(scheduler, "batch", "other")
+    tickets["other1"] = _enqueue(scheduler, "batch", "other")
+
+    assert _start_order(scheduler, tickets) == [
+        "flood0", "other0", "flood1", "other1", "flood2", "flood3"
+    ]
+
+
+def test_interactive_lane_goes_first(scheduler):
+    tickets = {"batch0": _enqueue(scheduler, "batch", "flood")}
+    scheduler._dispatch()
+    tickets["batch1"] = _enqueue(scheduler, "batch", "flood")
+    tickets["interactive"] = _enqueue(scheduler, "interactive", "other")
+
+    # The first batch job already has the slot, and isn't interrupted
+    assert _start_order(scheduler, tickets) == ["batch0", "interactive", "batch1"]
+
+
+def test_members_share_their_clients_turns(scheduler):
+    tickets = dict()
+    for i in range(3):
+        tickets["a{}".format(i)] = _enqueue(scheduler, "batch", "flood", "a")
+    tickets["b0"] = _enqueue(scheduler, "batch", "flood", "b")
+    tickets["other0"] = _enqueue(scheduler, "batch", "other")
+    tickets["other1"] = _enqueue(scheduler, "batch", "other")
+
+    # More members don't get flood more turns than other
+    assert _start_order(scheduler, tickets) == [
+        "a0", "other0", "b0", "other1", "a1", "a2"
+    ]
+
+
+def test_weights_scale_a_clients_share(scheduler, monkeypatch):
+    monkeypatch.setattr(ISISServerConfig, "_CLIENT_WEIGHTS", "heavy=2")
+    tickets = dict()
+    for i in range(4):
+        tickets["heavy{}".format(i)] = _enqueue(scheduler, "batch", "heavy")
+    for i in range(2):
+        tickets["light{}".format(i)] = _enqueue(scheduler, "batch", "light")
+
+    assert _start_order(scheduler, tickets) == [
+        "heavy0", "light0", "heavy1", "heavy2", "light1", "heavy3"
+    ]
@@ -0,0 +1,58 @@
+import numpy as np
+
+from isis_cloud.cube import Cube
+from isis_cloud.server._stats import PERCENTILES, _compute_stats, _StreamingHistogram
+
+from ._cubes import real_special, write_cube
+
+
+def test_chunked_moments_match_numpy(tmp_path):
+    # Far from zero, so a naive sum of squares would lose the variance
+    raw = np.random.RandomState(1).normal(1e4, 3.0, (1, 250, 120)).astype(np.float32)
+    raw[0, 3, :7] = real_special(0xFF7FFFFB)
+    raw[0, 200, 50] = real_special(0xFF7FFFFF)
+
+    file_path = str(tmp_path / "stats.cub")
+    write_cube(file_path, raw, tile_samples=64, tile_lines=16)
+
+    with Cube(file_path) as cube:
+        stats = _compute_stats(cube, 0)
+
+    mask = np.ones(raw.shape[1:], dtype=bool)
+    mask[3, :7] = False
+    mask[200, 50] = False
+    valid = raw[0][mask].astype(np.float64)
+
+    assert stats["TotalPixels"] == 250 * 120
+    assert stats["ValidPixels"] == valid.size
+    assert stats["NullPixels"] == 7
+    assert stats["HrsPixels"] == 1
+    assert stats["Minimum"] == valid.min()
+    assert stats["Maximum"] == valid.max()
+    assert np.isclose(stats["Average"], valid.mean(), rtol=0, atol=1e-9)
+    assert np.isclose(stats["Variance"], valid.var(ddof=1), rtol=1e-9)
+
+
+def test_histogram_percentiles_after_growing_both_ways():
+    values = np.random.RandomState(2).standard_normal(200000) * 10
+    histogram = _StreamingHistogram()
+
+    # The first chunk sets a narrow range which later chunks double below
+    # and above
+    order = np.argsort(np.abs(values))
+    for chunk in np.array_split(values[order], 50):
+        histogram.add(chunk)
+
+    minimum, maximum = values.min(), values.max()
+    # Each doubling halves the resolution, so allow a few bins of error
+    tolerance = 4 * (maximum - minimum) / _StreamingHistogram._BINS
+    for p in PERCENTILES:
+        expected = np.percentile(values, p)
+        assert abs(histogram.percentile(p, minimum, maximum) - expected) < tolerance
+
+
+def test_histogram_of_a_constant():
+    histogram = _StreamingHistogram()
+    histogram.add(np.full(100, 5.0))
+
+    assert histogram.percentile(50, 5.0, 5.0) == 5.0
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from isis_cloud.server import _tail
+from isis_cloud.server._tail import ERROR_OFFSET, _FRAME, producing, tail_stream
+
+_MIB = 1024 * 1024
+
+
+def _apply(frames, data=None):
+    # Writes frames to a copy of data the way a client would, returning it
+    # and whether the end was reached
+    data = bytearray(data or b"")
+    for frame in frames:
+        offset, length = _FRAME.unpack(frame[:_FRAME.size])
+        assert len(frame) == _FRAME.size + length
+        assert offset != ERROR_OFFSET, frame[_FRAME.size:].decode("utf-8")
+        if length == 0:
+            del data[offset:]
+            return bytes(data), True
+        data[len(data):offset] = bytes(max(0, offset - len(data)))
+        data[offset:offset + length] = frame[_FRAME.size:]
+    return bytes(data), False
+
+
+@pytest.fixture
+def no_polling(monkeypatch):
+    monkeypatch.setattr(_tail, "POLL_INTERVAL", 0)
+
+
+def test_frames_rebuild_a_file_rewritten_while_tailed(tmp_path, no_polling):
+    content = np.random.RandomState(4).bytes(3 * _MIB)
+    file_path = tmp_path / "out.cub"
+
+    with producing("job", {"out.cub": str(file_path)}, str(tmp_path)):
+        file_path.write_bytes(content[:_MIB + _MIB // 2])
+        stream = tail_stream("out.cub", str(tmp_path))
+        # One frame per block, and one for the rest
+        received, _ = _apply([next(stream), next(stream)])
+        assert received == content[:_MIB + _MIB // 2]
+
+        with open(str(file_path), "ab") as f:
+            f.write(content[_MIB + _MIB // 2:2 * _MIB + 100])
+        received, _ = _apply([next(stream), next(stream)], received)
+        assert received == content[:2 * _MIB + 100]
+
+        # The label is rewritten when the cube's closed, as are a few bytes
+        # in the middle of the last block sent, and the rest is written
+        # after the last read
+        final = bytearray(content[:2 * _MIB + 300])
+        final[:100] = bytes(100)
+        final[2 * _MIB + 50] ^= 0xFF
+        file_path.write_bytes(bytes(final))
+
+    received, done = _apply(list(stream), received)
+    assert done
+    assert received == bytes(final)
+
+
+def test_frames_truncate_a_file_that_shrank(tmp_path, no_polling):
+    file_path = tmp_path / "out.cub"
+
+    with producing("job", {"out.cub": str(file_path)}, str(tmp_path)):
+        file_path.write_bytes(b"x" * 1000)
+        stream = tail_stream("out.cub", str(tmp_path))
+        received, _ = _apply([next(stream)])
+        file_path.write_bytes(b"y" * 10)
+
+    received, done = _apply(list(stream), received)
+    assert done
+    assert received == b"y" * 10
+
+
+def test_a_file_that_was_never_written_ends_with_an_error(tmp_path, no_polling):
+    frames = list(tail_stream("missing.cub", str(tmp_path)))
+
+    assert len(frames) == 1
+    offset, length = _FRAME.unpack(frames[0][:_FRAME.size])
+    assert offset == ERROR_OFFSET
+    assert frames[0][_FRAME.size:] == b"'missing.cub' wasn't written"
@@ -14,7 +14,11 @@ log_config(
     level=INFO
 )
 
-app = ISISServer()
+# Pixel math pool workers are spawned, and re-import the script the server
+# was started with as __mp_main__. They don't need an app of their own.
+if __name__ != "__mp_main__":
+    app = ISISServer()
 
 if __name__ == "__main__":
+    app.start_background()
     app.run(8080, debug=True)